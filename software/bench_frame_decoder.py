@@ -0,0 +1,128 @@
+#micro-benchmark of the telemetry line handling: generic json.loads inside try/except
+#against classify_line + decode_frame, on frames rebuilt from recorded SD logs
+#usage: python software/bench_frame_decoder.py [log.csv ...] [--text-ratio 0.1] [--repeat 5]
+import argparse
+import csv
+import glob
+import json
+import os
+import time
+
+from frame_decoder import classify_line, decode_frame, format_frame, LINE_FRAME
+
+DEFAULT_LOGS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Example_logs', '*.CSV')
+
+TEXT_LINES = ["Set target_block_temp to 95.00", "ack", "ack 12", "Writing log to:05181124.csv", "SD card connected!"]
+
+
+#telemetry lines as the firmware would have sent them for every row of a log
+def recorded_frames(paths):
+    lines = []
+    for path in paths:
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                try:
+                    frame = {
+                        'block_temperature': float(row['block_temp_1']),
+                        'target_block_temp': float(row['target_temp_block']),
+                        'block_gradient': float(row['block_gradient']),
+                        'cap_temperature': float(row['temp_cap']),
+                        'target_cap_temp': float(row['target_temp_cap']),
+                        'cap_gradient': float(row['cap_gradient']),
+                        'redundant_temp': float(row['block_temp_2']),
+                        'buttons': [int(row['l_btn']), int(row['r_btn'])],
+                        'H_pwm': int(row['H70_pwm']),
+                        'H_CAP_pwm': int(row['H_CAP_pwm']),
+                        'H_act': row['H70_act'] == '1',
+                        'H_CAP_act': row['H_CAP_act'] == '1',
+                        'FAN_act': row['FAN_act'] == '1',
+                        'AZ_5': row['AZ_5'] == '1',
+                        'heat_act': row['heat_act'] == '1',
+                        'temp_reached': False,
+                        'holding_temp': False,
+                        'program_active': False,
+                        'timers': [0, 30],
+                        'end_timers': [0, 600],
+                    }
+                except (KeyError, TypeError, ValueError):
+                    continue  #truncated or AZ_5 rows
+                lines.append(format_frame(frame))
+    return lines
+
+
+def with_text(frames, text_ratio):
+    if text_ratio <= 0:
+        return list(frames)
+    every = max(1, int(round(1 / text_ratio)))
+    lines = []
+    for i, frame in enumerate(frames):
+        lines.append(frame)
+        if i % every == 0:
+            lines.append(TEXT_LINES[i % len(TEXT_LINES)])
+    return lines
+
+
+#what read_from_serial used to do for every line
+def handle_generic(lines):
+    frames = 0
+    for line in lines:
+        try:
+            data = json.loads(line)
+            if isinstance(data, dict):
+                frames += 1
+        except json.JSONDecodeError:
+            pass
+    return frames
+
+
+def handle_specialized(lines):
+    frames = 0
+    for line in lines:
+        if classify_line(line) == LINE_FRAME and decode_frame(line) is not None:
+            frames += 1
+    return frames
+
+
+VARIANTS = (("json.loads + try/except", handle_generic),
+            ("classify + decode_frame", handle_specialized))
+
+
+#all variants run one after the other in every round, so drift (CPU clock, other load) hits
+#them equally, the ratio is against the json.loads time of the same rounds
+def best_times(lines, repeat):
+    best = {name: None for name, _ in VARIANTS}
+    results = {}
+    for _ in range(repeat):
+        for name, func in VARIANTS:
+            start = time.perf_counter()
+            results[name] = func(lines)
+            elapsed = time.perf_counter() - start
+            best[name] = elapsed if best[name] is None else min(best[name], elapsed)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark telemetry frame decoding")
+    parser.add_argument('logs', nargs='*', help="SD CSV logs to rebuild frames from (default: Example_logs)")
+    parser.add_argument('--text-ratio', type=float, default=0.1, help="console text lines per frame")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    paths = args.logs or sorted(glob.glob(DEFAULT_LOGS))
+    frames = recorded_frames(paths)
+    if not frames:
+        print("No frames could be rebuilt from", paths)
+        return
+
+    for label, lines in (("frames only", frames), (f"frames + {args.text_ratio:.0%} text", with_text(frames, args.text_ratio))):
+        print(f"{label}: {len(lines)} lines")
+        best, results = best_times(lines, args.repeat)
+        baseline = best[VARIANTS[0][0]]
+        expected = results[VARIANTS[0][0]]
+        for name, _ in VARIANTS:
+            assert results[name] == expected, f"{name} decoded {results[name]} frames, expected {expected}"
+            print(f"  {name:<26} {best[name] / len(lines) * 1e6:7.2f} us/line  x{baseline / best[name]:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import binascii
+import math
+import struct
+
+import numpy as np
+
+#binary frames sent by Thermocycler.ino when the host accepts "bin" in the handshake
+#  sync (2) | type (1) | length (1) | payload (length) | crc16 (2, little-endian)
+#the CRC is CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) over type, length and payload
+SYNC = b'\xa5\x5a'
+HEADER_SIZE = 4
+CRC_SIZE = 2
+
+FRAME_TELEMETRY = 0x01
+FRAME_SD_ENTRY = 0x02  # one file of the SD card: size (uint32) | name
+FRAME_SD_DATA = 0x03  # file bytes: offset (uint32) | data (up to SD_DATA_SIZE bytes)
+FRAME_SD_END = 0x04  # end of a listing or of a read: status (uint8) | offset (uint32) | size (uint32)
+
+SD_DATA_SIZE = 192  # file bytes per data frame (the firmware reads the card into a buffer of this size)
+SD_OFFSET_STRUCT = struct.Struct('<I')
+SD_END_STRUCT = struct.Struct('<BII')  # a listing ends with the number of entries as offset
+
+#status of FRAME_SD_END
+SD_OK = 0
+SD_NO_CARD = 1
+SD_NOT_FOUND = 2
+SD_BUSY = 3  # refused while heating, the firmware loop stops while a file is sent
+SD_BAD_REQUEST = 4
+
+TEMP_SCALE = 100  # temperatures and gradients are sent as int16 hundredths of a degree
+TEMP_INVALID = -32768  # NaN readings
+
+#telemetry payload, little-endian and packed like the firmware struct
+TELEMETRY_STRUCT = struct.Struct('<I7hBBH4H')
+TELEMETRY_DTYPE = np.dtype([
+    ('millis', '<u4'),
+    ('block_temperature', '<i2'),
+    ('target_block_temp', '<i2'),
+    ('block_gradient', '<i2'),
+    ('cap_temperature', '<i2'),
+    ('target_cap_temp', '<i2'),
+    ('cap_gradient', '<i2'),
+    ('redundant_temp', '<i2'),
+    ('H_pwm', 'u1'),
+    ('H_CAP_pwm', 'u1'),
+    ('flags', '<u2'),
+    ('timer', '<u2'),
+    ('timer_total', '<u2'),
+    ('end_timer', '<u2'),
+    ('end_timer_total', '<u2'),
+])
+
+TEMP_FIELDS = ['block_temperature', 'target_block_temp', 'block_gradient', 'cap_temperature',
+               'target_cap_temp', 'cap_gradient', 'redundant_temp']
+
+#bit positions in the flags field
+FLAG_BITS = ['l_btn', 'r_btn', 'H_act', 'H_CAP_act', 'FAN_act', 'AZ_5', 'heat_act', 'temp_reached',
+             'holding_temp', 'program_active']
+
+
+def frame_crc(body):
+    return binascii.crc_hqx(body, 0xFFFF)
+
+
+#build a complete frame (used by the simulator and tools)
+def encode_frame(frame_type, payload):
+    body = bytes((frame_type, len(payload))) + payload
+    return SYNC + body + struct.pack('<H', frame_crc(body))
+
+
+def _temp(value):
+    return math.nan if value == TEMP_INVALID else value / TEMP_SCALE
+
+
+def _centi(value):
+    if math.isnan(value):
+        return TEMP_INVALID
+    return max(-32767, min(32767, int(round(value * TEMP_SCALE))))
+
+
+#decode a telemetry payload into the same dict the JSON frame gives (plus 'millis')
+def decode_telemetry(payload):
+    (millis, block, target_block, block_gradient, cap, target_cap, cap_gradient, redundant,
+     h_pwm, h_cap_pwm, flags, timer, timer_total, end_timer, end_timer_total) = TELEMETRY_STRUCT.unpack(payload)
+    return {
+        'block_temperature': _temp(block),
+        'target_block_temp': _temp(target_block),
+        'block_gradient': _temp(block_gradient),
+        'cap_temperature': _temp(cap),
+        'target_cap_temp': _temp(target_cap),
+        'cap_gradient': _temp(cap_gradient),
+        'redundant_temp': _temp(redundant),
+        'buttons': [flags & 1, (flags >> 1) & 1],
+        'H_pwm': h_pwm,
+        'H_CAP_pwm': h_cap_pwm,
+        'H_act': bool(flags & 4),
+        'H_CAP_act': bool(flags & 8),
+        'FAN_act': bool(flags & 16),
+        'AZ_5': bool(flags & 32),
+        'heat_act': bool(flags & 64),
+        'temp_reached': bool(flags & 128),
+        'holding_temp': bool(flags & 256),
+        'program_active': bool(flags & 512),
+        'timers': [timer, timer_total],
+        'end_timers': [end_timer, end_timer_total],
+        'millis': millis,
+    }
+
+
+def encode_telemetry(frame, millis=0):
+    buttons = frame.get('buttons', [0, 0])
+    flags = 0
+    for bit, value in enumerate([buttons[0], buttons[1]] + [frame.get(name, False) for name in FLAG_BITS[2:]]):
+        if value:
+            flags |= 1 << bit
+    timers = frame.get('timers', [0, 0])
+    end_timers = frame.get('end_timers', [0, 0])
+    payload = TELEMETRY_STRUCT.pack(
+        millis & 0xFFFFFFFF,
+        *(_centi(float(frame.get(name, 0))) for name in TEMP_FIELDS),
+        int(frame.get('H_pwm', 0)) & 0xFF,
+        int(frame.get('H_CAP_pwm', 0)) & 0xFF,
+        flags,
+        *(int(v) & 0xFFFF for v in (timers[0], timers[1], end_timers[0], end_timers[1])),
+    )
+    return encode_frame(FRAME_TELEMETRY, payload)
+
+
+#SD transfer frames (used by the simulator and tools)
+def encode_sd_entry(name, size):
+    return encode_frame(FRAME_SD_ENTRY, SD_OFFSET_STRUCT.pack(size) + name.encode('ascii', 'replace')[:12])
+
+
+def encode_sd_data(offset, data):
+    return encode_frame(FRAME_SD_DATA, SD_OFFSET_STRUCT.pack(offset) + data)
+
+
+def encode_sd_end(status, offset=0, size=0):
+    return encode_frame(FRAME_SD_END, SD_END_STRUCT.pack(status, offset, size))
+
+
+#vectorized decode of many telemetry payloads (concatenated) into float columns
+def decode_telemetry_batch(payloads):
+    records = np.frombuffer(payloads, dtype=TELEMETRY_DTYPE)
+    columns = {'millis': records['millis'].astype(np.float64)}
+    for name in TEMP_FIELDS:
+        raw = records[name]
+        values = raw / TEMP_SCALE
+        values[raw == TEMP_INVALID] = np.nan
+        columns[name] = values
+    for name in ('H_pwm', 'H_CAP_pwm', 'timer', 'timer_total', 'end_timer', 'end_timer_total'):
+        columns[name] = records[name].astype(np.float64)
+    flags = records['flags']
+    for bit, name in enumerate(FLAG_BITS):
+        columns[name] = ((flags >> bit) & 1).astype(np.float64)
+    return columns
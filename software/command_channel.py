@@ -0,0 +1,129 @@
+import collections
+import threading
+import time
+
+from metrics import Histogram
+
+
+#outgoing command channel with ACK verification
+#pipelined mode (firmware advertised "seq" in its syn): commands are sent as "#<id> <cmd>",
+#up to `window` of them are in flight and each "ack <id>" releases exactly that command,
+#commands that time out are retransmitted on their own
+#compatibility mode (older firmware): one command in flight, answered by a bare "ack"
+class CommandChannel:
+
+    def __init__(self, write, window=3, ack_timeout=2, max_retries=3, on_event=None):
+        self.write = write
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.on_event = on_event
+        self.pipelined = False
+
+        self._queue = collections.deque()
+        self._in_flight = collections.OrderedDict()  # id -> [message, last_sent, tries]
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+        self.stats = {'sent': 0, 'acked': 0, 'retries': 0, 'failed': 0, 'rtt_ms': 0.0}
+        self.rtt = Histogram()  # ms from the last (re)transmission to the ACK
+
+    def set_pipelined(self, pipelined):
+        with self._lock:
+            self.pipelined = pipelined
+        self.pump()
+
+    #queue a command (without trailing newline), returns its id
+    def submit(self, message):
+        with self._lock:
+            command_id = self._next_id
+            self._next_id = self._next_id % 9999 + 1
+            self._queue.append((command_id, message.strip()))
+        self.pump()
+        return command_id
+
+    def pending(self):
+        return len(self._queue)
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def clear(self):
+        with self._lock:
+            self._queue.clear()
+            self._in_flight.clear()
+
+    #send queued commands while the window has room
+    def pump(self):
+        events = []
+        with self._lock:
+            window = self.window if self.pipelined else 1
+            while self._queue and len(self._in_flight) < window:
+                command_id, message = self._queue.popleft()
+                now = time.monotonic()
+                self._in_flight[command_id] = [message, now, 1]
+                self.write(self._format(command_id, message))
+                self.stats['sent'] += 1
+                events.append(('sent', command_id, message, 1))
+        self._emit(events)
+
+    #handle an "ack" / "ack <id>" line, returns True if it matched a command in flight
+    def handle_ack(self, line):
+        words = line.split()
+        if not words or words[0].lower() != "ack":
+            return False
+
+        with self._lock:
+            if len(words) == 1:
+                #bare ack: only meaningful in compatibility mode (one command in flight)
+                if self.pipelined or not self._in_flight:
+                    return False
+                command_id = next(iter(self._in_flight))
+            elif len(words) == 2 and words[1].isdigit():
+                command_id = int(words[1])
+                if command_id not in self._in_flight:
+                    return False  #late ACK of a retransmitted command
+            else:
+                return False
+
+            message, last_sent, tries = self._in_flight.pop(command_id)
+            self.stats['acked'] += 1
+            self.stats['rtt_ms'] = (time.monotonic() - last_sent) * 1000
+            self.rtt.record(self.stats['rtt_ms'])
+
+        self._emit([('ack', command_id, message, tries)])
+        self.pump()
+        return True
+
+    #retransmit (or give up on) every command whose ACK is overdue
+    def check_timeouts(self, now=None):
+        now = time.monotonic() if now is None else now
+        events = []
+        with self._lock:
+            for command_id, entry in list(self._in_flight.items()):
+                message, last_sent, tries = entry
+                if now - last_sent <= self.ack_timeout:
+                    continue
+                if tries < self.max_retries:
+                    self.write(self._format(command_id, message))
+                    entry[1] = now
+                    entry[2] = tries + 1
+                    self.stats['retries'] += 1
+                    events.append(('retry', command_id, message, tries))
+                else:
+                    del self._in_flight[command_id]
+                    self.stats['failed'] += 1
+                    events.append(('failed', command_id, message, tries))
+        self._emit(events)
+        if events:
+            self.pump()
+
+    def _format(self, command_id, message):
+        if self.pipelined:
+            return f"#{command_id} {message}\n"
+        return message + "\n"
+
+    def _emit(self, events):
+        if self.on_event:
+            for event in events:
+                self.on_event(*event)
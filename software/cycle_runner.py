@@ -0,0 +1,277 @@
+import threading
+import time
+
+from protocol import Timeline, PHASE_FINAL, load_timeline
+
+TARGET_TOLERANCE = 0.01  # telemetry targets are rounded to hundredths
+SETTLE_FRAMES = 2  # frames to wait for when the step does not set a block target
+
+PAUSED_INFO = "Cycle paused. Press 'Resume' to continue."
+
+
+#runs a protocol Timeline (protocol.py, the default protocol file if none is given) on an Instrument
+#from its own thread, no GUI involved
+#the thread sleeps on a single condition variable until a hold deadline (monotonic clock) passes,
+#the telemetry reports the step temperature, or pause/stop/end is requested, there is no polling
+#progress is reported through the optional callbacks (called from the cycle thread):
+#  on_info(msg), on_last_message(msg), on_next_message(msg), on_cycle(num, cycles), on_step(index, step),
+#  on_finished()
+#the hold timer and the remaining time can be read at any time with timer() and remaining()
+#`time_scale` > 1 shortens every hold by that factor (for a virtual thermocycler running faster
+#than real time, see thermocycler_sim.py), reported times stay in protocol seconds
+class CycleRunner:
+
+    def __init__(self, instrument, timeline=None, time_scale=1.0):
+        self.instrument = instrument
+        self.timeline = timeline if isinstance(timeline, Timeline) else load_timeline(timeline)
+        self.time_scale = time_scale
+
+        self.on_info = None
+        self.on_last_message = None
+        self.on_next_message = None
+        self.on_cycle = None
+        self.on_step = None
+        self.on_finished = None
+
+        self.pause_flag = threading.Event()
+        self.stop_flag = threading.Event()
+        self.end_flag = threading.Event()
+        self.started_at = None
+        self._thread = None
+        self._status = ""
+
+        #everything below is guarded by _cond, which is notified on every change a wait depends on
+        self._cond = threading.Condition()
+        self._frames = 0
+        self._frame_target = None
+        self._frame_reached = False
+        self._waiting_frames = False
+        self._index = 0
+        self._hold_interval = 0
+        self._deadline = None
+        self._paused_at = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return False
+        self.stop_flag.clear()
+        self.pause_flag.clear()
+        self.end_flag.clear()
+        self.started_at = time.time()
+        self._index = 0
+        self._thread = threading.Thread(target=self._run, name="cycle-runner", daemon=True)
+        self._thread.start()
+        return True
+
+    def _notify(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def stop(self):
+        self.stop_flag.set()
+        self.pause_flag.clear()
+        self.end_flag.clear()
+        self._notify()
+
+    #pause/resume, returns True if the cycle is now paused
+    def toggle_pause(self):
+        if self.pause_flag.is_set():
+            self.pause_flag.clear()
+            paused = False
+        else:
+            self.pause_flag.set()
+            paused = True
+        self._notify()
+        if self.is_running():
+            self.info(PAUSED_INFO if paused else self._status)
+        return paused
+
+    #go to the final extension now (the current step hold or temperature wait is cut short)
+    def end(self):
+        self.end_flag.set()
+        self._notify()
+        if self.is_running():
+            self.info(PAUSED_INFO if self.pause_flag.is_set() else self._status)
+
+    def wait(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def elapsed(self):
+        if self.started_at is None or not self.is_running():
+            return 0.0
+        return (time.time() - self.started_at) * self.time_scale
+
+    #(elapsed, remaining) protocol seconds of the current hold, None between holds
+    def timer(self):
+        with self._cond:
+            if self._deadline is None:
+                return None
+            now = self._paused_at or time.monotonic()
+            remaining = max(0.0, (self._deadline - now) * self.time_scale)
+            return self._hold_interval - remaining, remaining
+
+    #expected protocol seconds left (ramps included), the whole protocol when not running
+    def remaining(self):
+        if not self.is_running():
+            return self.timeline.total()
+        block_temp = self.instrument.last_frame.get('block_temperature')
+        with self._cond:
+            index = self._index
+            hold_elapsed = None
+            if self._deadline is not None:
+                now = self._paused_at or time.monotonic()
+                hold_elapsed = self._hold_interval - max(0.0, (self._deadline - now) * self.time_scale)
+        if self.end_flag.is_set() and index < self.timeline.final_index:
+            return self.timeline.remaining_after_end()
+        return self.timeline.remaining(index, hold_elapsed, block_temp)
+
+    def send(self, message):
+        self.instrument.send(message)
+
+    def _emit(self, callback, *args):
+        if callback is not None:
+            callback(*args)
+
+    def info(self, msg):
+        if self.end_flag.is_set():
+            msg += "\n\nEnding cycle set..."
+        self._emit(self.on_info, msg)
+
+    #progress message, shown again when the cycle is resumed
+    def _set_status(self, msg):
+        self._status = msg
+        if not self.pause_flag.is_set():
+            self.info(msg)
+
+    #telemetry hook (I/O thread): only wakes the cycle thread when something it waits for changed
+    def _on_frame(self, frame, rx_time):
+        target = frame.get('target_block_temp')
+        reached = frame.get('temp_reached', False)
+        with self._cond:
+            self._frames += 1
+            if target != self._frame_target or reached != self._frame_reached or self._waiting_frames:
+                self._frame_target = target
+                self._frame_reached = reached
+                self._cond.notify_all()
+
+    # main cycle function
+    def _run(self):
+        self.instrument.add_frame_hook(self._on_frame)
+        try:
+            self._cycle_messages()
+        finally:
+            self.instrument.remove_frame_hook(self._on_frame)
+            self._emit(self.on_finished)
+
+    def _cycle_messages(self):
+        timeline = self.timeline
+        steps = timeline.steps
+
+        #send startup messages (pipelined by the command channel, no need to space them out)
+        for message in timeline.startup:
+            self.send(message)
+            self._emit(self.on_last_message, message)
+        self._emit(self.on_next_message, steps[0].commands[0])
+
+        i = 0
+        while i < len(steps):
+            if self.stop_flag.is_set():
+                return
+
+            #end: skip the rest of the main program
+            if self.end_flag.is_set() and i < timeline.final_index:
+                i = timeline.final_index
+                continue
+
+            step = steps[i]
+            if i == timeline.final_index:
+                self._set_status("Ending... Final extension started.")
+
+            #send the step
+            with self._cond:
+                self._index = i
+                sent_at_frame = self._frames
+            for message in step.commands:
+                self.send(message)
+                self._emit(self.on_last_message, message)
+            self._emit(self.on_next_message, steps[i + 1].commands[0] if i + 1 < len(steps) else ", ".join(timeline.finish))
+            self._emit(self.on_step, i, step)
+            if step.cycle:
+                self._emit(self.on_cycle, step.cycle, step.cycles)
+
+            # if needed, wait for the target temperature to be reached
+            #the final steps are not cut short by "end"
+            interruptible = step.phase != PHASE_FINAL
+            if step.wait:
+                self._set_status("Waiting for target temperature to be reached...")
+                if not self._wait_for_temp(step.temp, sent_at_frame, interruptible):
+                    continue
+                self._set_status("Holding at target temperature...")
+            elif i != timeline.final_index:
+                self._set_status(f"{step.name}...")
+
+            #pause interval
+            self._hold(step.hold, interruptible)
+            i += 1
+
+        #final message
+        for message in timeline.finish:
+            self.send(message)
+
+        self.stop_flag.set()
+
+        self.info("Cycle completed. Press 'Start' to begin again.")
+
+    #block until the telemetry reports `target` reached, False if stopped (or ended, if `interruptible`)
+    #the firmware only recalculates temp_reached on its next loop, so the reported target has to be the
+    #new one (or, without a target, a few frames must have arrived since the send)
+    def _wait_for_temp(self, target, sent_at_frame, interruptible=True):
+        with self._cond:
+            self._waiting_frames = target is None
+            try:
+                while True:
+                    if self.stop_flag.is_set() or (interruptible and self.end_flag.is_set()):
+                        return False
+                    if self._frame_reached:
+                        if target is None:
+                            if self._frames - sent_at_frame >= SETTLE_FRAMES:
+                                return True
+                        elif self._frame_target is not None and abs(self._frame_target - target) < TARGET_TOLERANCE:
+                            return True
+                    self._cond.wait()
+            finally:
+                self._waiting_frames = False
+
+    #wait `interval` protocol seconds not counting pauses, False if the cycle was stopped
+    #(or ended, if `interruptible`), the deadline is moved by the length of each pause
+    def _hold(self, interval, interruptible=False):
+        with self._cond:
+            self._hold_interval = interval
+            self._deadline = time.monotonic() + interval / self.time_scale
+            self._paused_at = None
+            try:
+                while True:
+                    if self.stop_flag.is_set() or (interruptible and self.end_flag.is_set()):
+                        return False
+
+                    now = time.monotonic()
+                    if self.pause_flag.is_set():
+                        if self._paused_at is None:
+                            self._paused_at = now
+                        self._cond.wait()
+                        continue
+                    if self._paused_at is not None:
+                        self._deadline += now - self._paused_at
+                        self._paused_at = None
+
+                    remaining = self._deadline - now
+                    if remaining <= 0:
+                        return True
+                    self._cond.wait(remaining)
+            finally:
+                self._deadline = None
+                self._paused_at = None
@@ -0,0 +1,293 @@
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+import serial
+import serial.tools.list_ports
+
+from instrument import BAUD_RATE, DEVICE_HWID, DEVICE_VID_PID
+from frame_decoder import classify_line, decode_frame, LINE_FRAME, LINE_SYNC
+from serial_engine import SerialEngine
+
+#finds the thermocycler without knowing its port: candidate ports are opened and the first one that
+#talks like the firmware (a "syn" of the handshake, a JSON or binary telemetry frame) wins
+#opening a port resets the board, its first "syn" follows in about 2 s, a board that was not reset
+#(already running) is recognized by its telemetry within a frame period
+#so other boards are not reset for nothing, the port with the device's exact hwid is probed on its own,
+#else its cached port (PORT_CACHE, only while the same USB device is listed on it), and only when
+#neither is there every board with the VID:PID is probed at once (every USB serial port with `any_usb`)
+#ports are opened with exclusive=True, like Instrument and Supervisor open them, so a port held by
+#another instrument (e.g. a unit driven by `bank`) fails to open and is skipped, not read
+#the bytes read while probing are returned with the open port: Instrument.start(received=...)
+#handles them so the "syn" that identified the board is the one answered (or, for a board found by its
+#telemetry, the frame marks the instrument connected without a handshake)
+#  probe = discover()                          Probe(port, ser, kind, received) or None
+#  PortWatcher(on_added, on_removed).start()   hot-plug notifications, e.g. to reconnect after a USB glitch
+
+PROBE_TIMEOUT = 3.0  # s a port is given to identify itself (board reset + first "syn")
+PROBE_READ_TIMEOUT = 0.05  # s per read while probing
+PROBE_WORKERS = 16  # ports probed at once
+PROBE_BUFFER = 8192  # bytes kept while probing, a port talking that much without a frame is not ours
+HOTPLUG_INTERVAL = 0.2  # s between checks of the port list
+PORT_CACHE = os.path.join(os.path.expanduser('~'), '.thermocycler', 'ports.json')
+
+KIND_HANDSHAKE = 'handshake'  # the board is waiting for "syn ack" (it was just reset)
+KIND_TELEMETRY = 'telemetry'  # the board was already running
+
+
+#a port that answered like the firmware, `ser` is open and `received` holds everything read from it
+class Probe:
+
+    def __init__(self, port, ser, kind, received, elapsed):
+        self.port = port
+        self.ser = ser
+        self.kind = kind
+        self.received = received
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return f"Probe({self.port!r}, {self.kind}, {self.elapsed * 1000:.0f} ms)"
+
+
+#ports worth probing, most likely first: the device's hwid, then any board with its VID:PID,
+#then (with `any_usb`) every other USB serial port, e.g. a board that enumerates with another PID
+def candidate_ports(hwid=DEVICE_HWID, vid_pid=DEVICE_VID_PID, any_usb=False):
+    match = f"VID:PID={vid_pid}".upper()
+    ranked = []
+    for port, port_hwid in listed_ports().items():
+        if hwid and port_hwid == hwid.upper():
+            rank = 0
+        elif match in port_hwid:
+            rank = 1
+        elif any_usb and "VID:PID=" in port_hwid:
+            rank = 2
+        else:
+            continue
+        ranked.append((rank, port))
+    return [device for _, device in sorted(ranked)]
+
+
+#hwid (upper case) of every listed serial port
+def listed_ports():
+    return {port.device: (port.hwid or "").upper() for port in serial.tools.list_ports.comports()}
+
+
+#ports to probe for the device, see the header: its exact hwid port, else its cached port, else every candidate
+def probe_targets(device=DEVICE_HWID, vid_pid=DEVICE_VID_PID, extra_ports=(), any_usb=False):
+    listed = listed_ports()
+    exact = [port for port, port_hwid in listed.items() if device and port_hwid == device.upper()]
+    if exact:
+        return exact
+    for port in extra_ports:
+        listed.setdefault(port, "")
+    cached = _cache_entry(device)
+    if cached.get('port') in listed and listed[cached['port']] == cached.get('hwid'):
+        return [cached['port']]
+    return list(dict.fromkeys(candidate_ports(device, vid_pid, any_usb) + list(extra_ports)))
+
+
+#open `port` and wait up to `timeout` for the firmware to show up, returns a Probe or None
+#(the port is closed again unless it is returned), `cancel` (an Event) aborts the wait
+def probe_port(port, baud=BAUD_RATE, timeout=PROBE_TIMEOUT, cancel=None):
+    start = time.monotonic()
+    try:
+        ser = serial.Serial(port, baud, timeout=PROBE_READ_TIMEOUT, exclusive=True)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+
+    found = []
+    received = bytearray()
+    engine = SerialEngine(ser, on_line=lambda line, now: _identify_line(line, found),
+                          on_binary=lambda frame_type, payload, now: found.append(KIND_TELEMETRY))
+    try:
+        while not found and time.monotonic() - start < timeout:
+            if cancel is not None and cancel.is_set():
+                break
+            data = ser.read(max(1, ser.in_waiting))
+            if data:
+                received += data
+                engine.feed(data, time.monotonic())
+                if len(received) > PROBE_BUFFER:
+                    break
+    except (serial.SerialException, OSError, TypeError):
+        found = []
+
+    if found and not (cancel is not None and cancel.is_set()):
+        return Probe(port, ser, found[0], bytes(received), time.monotonic() - start)
+    ser.close()
+    return None
+
+
+def _identify_line(line, found):
+    kind = classify_line(line)
+    if kind == LINE_SYNC and line.startswith("syn"):
+        found.append(KIND_HANDSHAKE)
+    elif kind == LINE_FRAME and decode_frame(line) is not None:
+        found.append(KIND_TELEMETRY)
+
+
+#probe every port at once, the first to identify itself wins (the others are cancelled and closed)
+def probe_ports(ports, baud=BAUD_RATE, timeout=PROBE_TIMEOUT):
+    if not ports:
+        return None
+    cancel = threading.Event()
+    winner = None
+    with concurrent.futures.ThreadPoolExecutor(min(len(ports), PROBE_WORKERS), thread_name_prefix="probe") as pool:
+        futures = [pool.submit(probe_port, port, baud, timeout, cancel) for port in ports]
+        for future in concurrent.futures.as_completed(futures):
+            probe = future.result()
+            if probe is None:
+                continue
+            if winner is None:
+                winner = probe
+                cancel.set()
+            else:
+                probe.ser.close()
+    return winner
+
+
+#find the device: the given port, else the ports of probe_targets() at once, the port found is cached for next time
+def discover(device=DEVICE_HWID, port=None, vid_pid=DEVICE_VID_PID, baud=BAUD_RATE, timeout=PROBE_TIMEOUT,
+             extra_ports=(), any_usb=False):
+    if port:
+        probe = probe_port(port, baud, timeout)
+    else:
+        probe = probe_ports(probe_targets(device, vid_pid, extra_ports, any_usb), baud, timeout)
+    if probe is not None:
+        save_port(device, probe.port)
+    return probe
+
+
+#discover() until the device shows up or `timeout` seconds have passed, None then
+def wait_for_device(device=DEVICE_HWID, port=None, baud=BAUD_RATE, timeout=20, extra_ports=(), any_usb=False):
+    deadline = time.monotonic() + timeout
+    while True:
+        probe = discover(device, port, baud=baud, timeout=min(PROBE_TIMEOUT, max(deadline - time.monotonic(), 0.5)),
+                         extra_ports=extra_ports, any_usb=any_usb)
+        if probe is not None or time.monotonic() >= deadline:
+            return probe
+        time.sleep(HOTPLUG_INTERVAL)
+
+
+#last port the device was found on, None if unknown
+def cached_port(device=DEVICE_HWID):
+    return _cache_entry(device).get('port')
+
+
+def _cache_entry(device):
+    try:
+        with open(PORT_CACHE, encoding='utf-8') as f:
+            entry = json.load(f).get(device, {})
+        return entry if isinstance(entry, dict) else {}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+#the hwid listed on the port is saved with it, the cached port is only trusted while it is the same
+def save_port(device, port):
+    try:
+        with open(PORT_CACHE, encoding='utf-8') as f:
+            ports = json.load(f)
+    except (OSError, ValueError):
+        ports = {}
+    ports[device] = {'port': port, 'hwid': listed_ports().get(port, ""), 'seen_at': time.strftime('%Y-%m-%d %H:%M:%S')}
+    try:
+        os.makedirs(os.path.dirname(PORT_CACHE), exist_ok=True)
+        with open(PORT_CACHE + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(ports, f, indent=1)
+        os.replace(PORT_CACHE + '.tmp', PORT_CACHE)
+    except OSError:
+        pass
+
+
+#polls the port list (plus `paths`, e.g. virtual ports, that exist) on its own thread and calls
+#`on_added(port)` / `on_removed(port)` when ports appear or disappear (pyserial has no hot-plug events,
+#listing the ports takes about a millisecond)
+class PortWatcher:
+
+    def __init__(self, on_added=None, on_removed=None, interval=HOTPLUG_INTERVAL, paths=()):
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.interval = interval
+        self.paths = list(paths)
+        self.ports = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.ports = self.scan()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="port-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def scan(self):
+        ports = {port.device for port in serial.tools.list_ports.comports()}
+        ports.update(path for path in self.paths if os.path.exists(path))
+        return ports
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            ports = self.scan()
+            added = ports - self.ports
+            removed = self.ports - ports
+            self.ports = ports
+            for port in sorted(removed):
+                if self.on_removed:
+                    self.on_removed(port)
+            for port in sorted(added):
+                if self.on_added:
+                    self.on_added(port)
+
+
+#keeps an instrument connected: when its port is lost, the port (or any candidate) is probed again
+#as soon as it reappears and the instrument is reopened on it, `on_reconnect(probe)` is called after
+class Reconnector:
+
+    def __init__(self, instrument, device=DEVICE_HWID, baud=BAUD_RATE, on_reconnect=None, paths=()):
+        self.instrument = instrument
+        self.device = device
+        self.baud = baud
+        self.on_reconnect = on_reconnect
+        self.lost = threading.Event()
+        self._lock = threading.Lock()
+        self.watcher = PortWatcher(on_added=self._port_added, paths=paths)
+
+    def start(self):
+        self.watcher.start()
+        return self
+
+    def stop(self):
+        self.watcher.stop()
+
+    #call when the connection is lost (Instrument on_error), ports already present are probed right away
+    def connection_lost(self):
+        self.lost.set()
+        threading.Thread(target=self._retry, args=(sorted(self.watcher.ports),), name="reconnect", daemon=True).start()
+
+    def _port_added(self, port):
+        if self.lost.is_set():
+            self._retry([port])
+
+    def _retry(self, ports):
+        with self._lock:
+            if not self.lost.is_set():
+                return
+            targets = probe_targets(self.device, extra_ports=self.watcher.paths)
+            probe = probe_ports([port for port in targets if port in ports], self.baud)
+            if probe is None:
+                return
+            save_port(self.device, probe.port)
+            self.lost.clear()
+            self.instrument.reconnect(probe.ser, probe.received)
+        if self.on_reconnect:
+            self.on_reconnect(probe)
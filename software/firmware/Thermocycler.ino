@@ -96,6 +96,52 @@ MAX6675 thermo_body_2(CLK, THRM_B2, MISO);
 
 bool serial = false;
 bool SD_b = true;
+bool bin_mode = false; //compact binary telemetry, enabled if the host answers "bin" in the handshake
+
+unsigned long sensor_interval = 500; //ms between thermocouple reads (MAX6675 needs ~220ms per conversion)
+#define LOG_INTERVAL 500 //ms between SD log rows, temperature rate updates and screen refreshes, whatever the telemetry format
+unsigned long last_read = 0;
+
+//binary telemetry frame: sync (2) | type (1) | length (1) | payload | crc16 (2)
+#define BIN_SYNC_1 0xA5
+#define BIN_SYNC_2 0x5A
+#define BIN_FRAME_TELEMETRY 0x01
+#define BIN_FRAME_SD_ENTRY 0x02
+#define BIN_FRAME_SD_DATA 0x03
+#define BIN_FRAME_SD_END 0x04
+#define TEMP_INVALID -32768
+
+//SD card transfer ("sd_list=/" and "sd_read=<file>,<offset>,<length>", always in binary frames)
+#define SD_DATA_SIZE 192
+#define SD_OK 0
+#define SD_NO_CARD 1
+#define SD_NOT_FOUND 2
+#define SD_BUSY 3
+#define SD_BAD_REQUEST 4
+
+struct __attribute__((packed)) TelemetryPayload {
+  uint32_t millis;
+  int16_t block_temperature;  //all temperatures and gradients in hundredths of a degree
+  int16_t target_block_temp;
+  int16_t block_gradient;
+  int16_t cap_temperature;
+  int16_t target_cap_temp;
+  int16_t cap_gradient;
+  int16_t redundant_temp;
+  uint8_t H_pwm;
+  uint8_t H_CAP_pwm;
+  uint16_t flags;  //l_btn, r_btn, H_act, H_CAP_act, FAN_act, AZ_5, heat_act, temp_reached, holding_temp, program_active
+  uint16_t timer;
+  uint16_t timer_total;
+  uint16_t end_timer;
+  uint16_t end_timer_total;
+};
+
+struct __attribute__((packed)) SDEndPayload {
+  uint8_t status;
+  uint32_t offset;  //next offset of a read, number of entries of a listing
+  uint32_t size;
+};
 
 //writes the header for the log file
 void writeLogHeader() {
@@ -177,18 +223,17 @@ void setup() {
   pinMode(L_BTN, INPUT_PULLUP);
 
   //try to connect to serial with handshake
+  //capabilities are advertised after "syn", the host echoes the ones it uses ("syn ack [no_sd] [seq] [bin]")
+  //every other attempt is a plain "syn" so hosts that only know the original handshake can still connect
   for(int i = 0; i<20;i++){
-    Serial.println("syn");
+    Serial.println(i % 2 == 0 ? "syn seq bin" : "syn");
     String response = "";
     response = Serial.readStringUntil('\n');
-    if(response.equals("syn ack")){
-      serial = true; 
-      Serial.println("ack tim");
-      break;
-    }
-    if(response.equals("syn ack no_sd")){
+    response.trim();
+    if(response.startsWith("syn ack")){
       serial = true; 
-      SD_b = false;
+      if(response.indexOf("no_sd") != -1){SD_b = false;}
+      if(response.indexOf(" bin") != -1){bin_mode = true;}
       Serial.println("ack tim");
       break;
     }
@@ -208,7 +253,10 @@ void setup() {
       Serial.println(String("Writing log to:")+def_filename);
     }
   }
-  Serial.setTimeout(50);
+  //binary frames are ~12x smaller, so the loop is no longer limited by the link and the frames can carry
+  //fresher readings, only the thermocouple reads speed up (logging and rates stay on LOG_INTERVAL)
+  Serial.setTimeout(bin_mode ? 10 : 50);
+  if(bin_mode){sensor_interval = 250;}
 
   lcd.clear();
   
@@ -334,6 +382,10 @@ void handleCommand(String cmd) {
   else if (var == "FAN_act") FAN_act = parseBool(val);
   else if (var == "AZ_5") {AZ_5 = parseBool(val);AZ_5_info="REMOTE SHUTDOWN";}
   else if (var == "heat_act") heat_act = parseBool(val);
+
+  // SD card transfer, answered with binary frames instead of the confirmation
+  else if (var == "sd_list") {listSD(val); return;}
+  else if (var == "sd_read") {readSD(val); return;}
   else {Serial.print("Unrecognized variable: ");Serial.println(var);return;}
   // confirm output
   Serial.print("Set ");
@@ -342,6 +394,180 @@ void handleCommand(String cmd) {
   Serial.println(val);
 }
 
+//acks and applies one command line
+//"#<id> <cmd>" (pipelined host) is acked with "ack <id>", a plain "<cmd>" with "ack"
+void processCommand(String command) {
+  if (command.startsWith("#")) {
+    int spaceIndex = command.indexOf(' ');
+    if (spaceIndex == -1) return;
+    Serial.print("ack ");
+    Serial.println(command.substring(1, spaceIndex));
+    handleCommand(command.substring(spaceIndex + 1));
+  }
+  else {
+    Serial.println("ack");
+    handleCommand(command);
+  }
+}
+
+//wait for input, then handle every command already in the buffer (the host can pipeline them)
+void readCommands() {
+  String command = Serial.readStringUntil('\n');
+  while (true) {
+    command.trim();
+    if (command.length() > 0) {
+      processCommand(command);
+    }
+    if (Serial.available() <= 0) break;
+    command = Serial.readStringUntil('\n');
+  }
+}
+
+//CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF)
+uint16_t crc16Update(uint16_t crc, uint8_t data) {
+  crc ^= (uint16_t)data << 8;
+  for (uint8_t i = 0; i < 8; i++) {
+    crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+  }
+  return crc;
+}
+
+int16_t toCenti(float value) {
+  if (isnan(value)) return TEMP_INVALID;
+  return (int16_t)constrain(lround(value * 100.0), -32767L, 32767L);
+}
+
+//sends the telemetry as a binary frame (same content as the JSON one)
+void sendBinaryFrame() {
+  TelemetryPayload payload;
+  payload.millis = millis();
+  payload.block_temperature = toCenti(temp_body_1);
+  payload.target_block_temp = toCenti(target_temp_block);
+  payload.block_gradient = toCenti(avg_rate_body);
+  payload.cap_temperature = toCenti(temp_cap);
+  payload.target_cap_temp = toCenti(target_temp_cap);
+  payload.cap_gradient = toCenti(avg_rate_cap);
+  payload.redundant_temp = toCenti(temp_body_2);
+  payload.H_pwm = H70_pwm;
+  payload.H_CAP_pwm = H_CAP_pwm;
+  payload.flags = (l_btn ? 1 : 0) | (r_btn ? 2 : 0) | (H70_act ? 4 : 0) | (H_CAP_act ? 8 : 0) |
+                  (FAN_act ? 16 : 0) | (AZ_5 ? 32 : 0) | (heat_act ? 64 : 0) | (arrived_at_temp ? 128 : 0) |
+                  (holding ? 256 : 0) | (program_start ? 512 : 0);
+  payload.timer = (holding && !program_end_phase) ? (millis() - step_start_time)/1000 : 0;
+  payload.timer_total = hold_times[program_step]/1000;
+  payload.end_timer = (program_end_phase && !cooling_started) ? (millis() - end_hold_start)/1000 : 0;
+  payload.end_timer_total = end_hold/1000;
+
+  sendFrame(BIN_FRAME_TELEMETRY, (const uint8_t*)&payload, sizeof(payload));
+}
+
+//sends a binary frame, the CRC covers type, length and payload
+void sendFrame(uint8_t type, const uint8_t* payload, uint8_t length) {
+  uint8_t header[4] = {BIN_SYNC_1, BIN_SYNC_2, type, length};
+  uint16_t crc = 0xFFFF;
+  crc = crc16Update(crc, type);
+  crc = crc16Update(crc, length);
+  for (uint8_t i = 0; i < length; i++) {
+    crc = crc16Update(crc, payload[i]);
+  }
+
+  Serial.write(header, sizeof(header));
+  Serial.write(payload, length);
+  Serial.write((uint8_t)(crc & 0xFF));
+  Serial.write((uint8_t)(crc >> 8));
+}
+
+void sendSDEnd(uint8_t status, uint32_t offset, uint32_t size) {
+  SDEndPayload payload = {status, offset, size};
+  sendFrame(BIN_FRAME_SD_END, (const uint8_t*)&payload, sizeof(payload));
+}
+
+//sd_list=<dir>: one entry frame (size, 8.3 name) per file, then an end frame with the number of entries
+void listSD(String dir) {
+  if (!SD_b || !SD.begin(2)) {
+    SD.end();
+    digitalWrite(SD_cs, HIGH);
+    sendSDEnd(SD_NO_CARD, 0, 0);
+    return;
+  }
+
+  uint8_t status = SD_NOT_FOUND;
+  uint32_t count = 0;
+  File root = SD.open(dir.length() > 0 ? dir : String("/"));
+  if (root) {
+    status = SD_OK;
+    uint8_t entry[4 + 12];
+    File file = root.openNextFile();
+    while (file) {
+      if (!file.isDirectory()) {
+        uint32_t size = file.size();
+        uint8_t length = min(strlen(file.name()), (size_t)12);
+        memcpy(entry, &size, 4);
+        memcpy(entry + 4, file.name(), length);
+        sendFrame(BIN_FRAME_SD_ENTRY, entry, 4 + length);
+        count++;
+      }
+      file.close();
+      file = root.openNextFile();
+    }
+    root.close();
+  }
+  digitalWrite(SD_cs, HIGH);
+  SD.end();  // Free SPI bus
+  sendSDEnd(status, count, 0);
+}
+
+//sd_read=<file>,<offset>,<length>: up to length bytes from offset in data frames (each with its offset),
+//then an end frame with the next offset and the file size, the host asks again from its last good offset
+//if a frame was lost, the loop (control, telemetry, logging) waits meanwhile so it is refused while heating
+void readSD(String args) {
+  int first = args.indexOf(',');
+  int second = args.indexOf(',', first + 1);
+  if (first <= 0 || second == -1) {
+    sendSDEnd(SD_BAD_REQUEST, 0, 0);
+    return;
+  }
+  String name = args.substring(0, first);
+  uint32_t offset = args.substring(first + 1, second).toInt();
+  uint32_t length = args.substring(second + 1).toInt();
+
+  if (heat_act || program_start) {
+    sendSDEnd(SD_BUSY, offset, 0);
+    return;
+  }
+  if (!SD_b || !SD.begin(2)) {
+    SD.end();
+    digitalWrite(SD_cs, HIGH);
+    sendSDEnd(SD_NO_CARD, offset, 0);
+    return;
+  }
+
+  File dataFile = SD.open(name, FILE_READ);
+  if (!dataFile) {
+    digitalWrite(SD_cs, HIGH);
+    SD.end();
+    sendSDEnd(SD_NOT_FOUND, offset, 0);
+    return;
+  }
+  uint32_t size = dataFile.size();
+  uint32_t end = (length < size - min(offset, size)) ? offset + length : size;
+  if (offset < end) {
+    dataFile.seek(offset);
+  }
+  uint8_t payload[4 + SD_DATA_SIZE];
+  while (offset < end) {
+    int count = dataFile.read(payload + 4, min(end - offset, (uint32_t)SD_DATA_SIZE));
+    if (count <= 0) break;
+    memcpy(payload, &offset, 4);
+    sendFrame(BIN_FRAME_SD_DATA, payload, 4 + count);
+    offset += count;
+  }
+  dataFile.close();
+  digitalWrite(SD_cs, HIGH);
+  SD.end();  // Free SPI bus
+  sendSDEnd(SD_OK, offset, size);
+}
+
 bool parseBool(String val) {
   val.toLowerCase();
   return (val == "1" || val == "true");
@@ -463,9 +689,10 @@ void loop() {
 
   }
 
-  bool time_since_upd = (millis()-last_update)>500;
+  bool time_since_upd = (millis()-last_update)>LOG_INTERVAL;
+  bool time_since_read = (millis()-last_read)>sensor_interval;
 
-  if(time_since_upd){
+  if(time_since_read){
 
     //needed to resolve spi bus conflict
     MAX6675 thermo_cap(CLK, THRM_CAP, MISO);
@@ -476,6 +703,12 @@ void loop() {
     temp_body_1 = thermo_body_1.readCelsius();
     temp_body_2 = thermo_body_2.readCelsius();
 
+    last_read=millis();
+
+  }
+
+  if(time_since_upd){
+
     logToSD();
 
     updateTemperatureRate();  
@@ -943,6 +1176,13 @@ void loop() {
     Serial.println("-------------");
     delay(50);
   }
+  else if(bin_mode){
+
+    sendBinaryFrame();
+
+    readCommands();
+
+  }
   else{
 
     String response = String("{") +
@@ -975,13 +1215,7 @@ void loop() {
 
     Serial.println(response);
 
-    //wait for input
-    String command = Serial.readStringUntil('\n');
-    command.trim();
-    if (command.length() > 0) {
-      Serial.println("ack");
-      handleCommand(command);
-    }
+    readCommands();
 
   }
 
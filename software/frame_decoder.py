@@ -0,0 +1,128 @@
+import json
+import math
+
+#classification and decoding of the lines received from the firmware
+#a line is classified by its first characters (classify_line), without parsing, and telemetry frames
+#are decoded with the C scanner behind json.loads into the dict every consumer (Instrument hooks,
+#panel, graph, recorder) works with, the values already have the FRAME_SCHEMA types
+#a decoder specialized on FRAME_SCHEMA into typed fields of a preallocated record is not provided:
+#every Python version of it measured slower than decode_frame (copying the dict into a record about
+#x0.97 of json.loads, one regex over the firmware layout with a single C scan of the captured values
+#x1.14, decode_frame x1.28, bench_frame_decoder.py, frames rebuilt from Example_logs)
+#RECORD_FIELDS is the flat layout the session recorder stores frames in
+
+#line kinds returned by classify_line
+LINE_TEXT = 0
+LINE_FRAME = 1
+LINE_SYNC = 2
+LINE_ACK = 3
+
+#field types of the telemetry frame
+FLOAT = 'float'
+INT = 'int'
+BOOL = 'bool'
+PAIR = 'pair'  # two element int array
+
+#telemetry frame sent by Thermocycler.ino every loop, in the exact order (and types) it is built
+FRAME_SCHEMA = [
+    ('block_temperature', FLOAT),
+    ('target_block_temp', FLOAT),
+    ('block_gradient', FLOAT),
+    ('cap_temperature', FLOAT),
+    ('target_cap_temp', FLOAT),
+    ('cap_gradient', FLOAT),
+    ('redundant_temp', FLOAT),
+    ('buttons', PAIR),
+    ('H_pwm', INT),
+    ('H_CAP_pwm', INT),
+    ('H_act', BOOL),
+    ('H_CAP_act', BOOL),
+    ('FAN_act', BOOL),
+    ('AZ_5', BOOL),
+    ('heat_act', BOOL),
+    ('temp_reached', BOOL),
+    ('holding_temp', BOOL),
+    ('program_active', BOOL),
+    ('timers', PAIR),
+    ('end_timers', PAIR),
+]
+
+FRAME_KEYS = tuple(key for key, _ in FRAME_SCHEMA)
+
+#flat numeric layout of a frame (pairs take two slots, booleans are 0/1)
+RECORD_FIELDS = []
+for _key, _kind in FRAME_SCHEMA:
+    if _kind == PAIR:
+        RECORD_FIELDS += [_key + '_0', _key + '_1']
+    else:
+        RECORD_FIELDS.append(_key)
+RECORD_SIZE = len(RECORD_FIELDS)
+
+#the C scanner behind json.loads, called directly: the frame is already known to be a
+#stripped JSON object so the wrapper (type checks, trailing whitespace regex) is skipped
+_scan_once = json.JSONDecoder().scan_once
+
+
+#firmware prints invalid floats with String(x, 2) as "nan", "inf" or "ovf", which are not valid JSON
+def _normalize_floats(line):
+    return line.replace(": nan", ": NaN").replace(": inf", ": Infinity").replace(": -inf", ": -Infinity").replace(": ovf", ": Infinity")
+
+
+#cheap classification of a received line, no parsing and no exceptions
+def classify_line(line):
+    if not line:
+        return LINE_TEXT
+    first = line[0]
+    if first == '{':
+        return LINE_FRAME
+    if first == 's' and (line == "syn" or line.startswith("syn ")):
+        return LINE_SYNC
+    if first == 'a' and line.startswith("ack"):
+        rest = line[3:]
+        if not rest:
+            return LINE_ACK
+        if rest == " tim":
+            return LINE_SYNC
+        if rest[0] == ' ' and rest[1:].isdigit():
+            return LINE_ACK
+    return LINE_TEXT
+
+
+#decode a telemetry line (classified as LINE_FRAME) into a dict, None if it is not a JSON object
+#frames with other keys (e.g. the reduced AZ_5 diagnostics frame) are returned as they are
+def decode_frame(line):
+    try:
+        frame, end = _scan_once(line, 0)
+    except (StopIteration, ValueError):
+        #invalid float readings are rare, only normalize them when the fast path fails
+        normalized = _normalize_floats(line)
+        if normalized == line:
+            return None
+        try:
+            frame, end = _scan_once(normalized, 0)
+        except (StopIteration, ValueError):
+            return None
+        line = normalized
+    if end != len(line) or type(frame) is not dict:
+        return None
+    return frame
+
+
+#build a telemetry line exactly like Thermocycler.ino does (used by tools and benchmarks),
+#keys missing from the frame are left out (like the reduced AZ_5 diagnostics frame)
+def format_frame(frame):
+    parts = []
+    for key, kind in FRAME_SCHEMA:
+        if key not in frame:
+            continue
+        value = frame[key]
+        if kind == FLOAT:
+            text = f"{value:.2f}" if math.isfinite(value) else ("nan" if math.isnan(value) else "inf")
+        elif kind == BOOL:
+            text = "true" if value else "false"
+        elif kind == INT:
+            text = str(int(value))
+        else:
+            text = f"[{int(value[0])}, {int(value[1])}]"
+        parts.append(f'"{key}": {text}')
+    return "{" + ", ".join(parts) + " }"
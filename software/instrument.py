@@ -0,0 +1,332 @@
+import threading
+import time
+
+import serial
+import serial.tools.list_ports
+
+from serial_engine import SerialEngine
+from command_channel import CommandChannel
+from frame_decoder import classify_line, decode_frame, LINE_FRAME, LINE_SYNC, LINE_ACK
+from binary_frame import decode_telemetry, FRAME_TELEMETRY, TELEMETRY_STRUCT
+from session_recorder import SessionRecorder, new_session_path
+from metrics import Histogram
+
+# Serial config
+DEVICE_HWID = "USB VID:PID=2341:1002 SER=F412FA9C9F1C"
+DEVICE_VID_PID = "2341:1002"  # any unit of the bank, whatever its serial number
+BAUD_RATE = 115200
+ACK_TIMEOUT = 2  # seconds to wait for ACK before retrying
+MAX_RETRIES = 3  # max number of retries per message
+DRAIN_TIMEOUT = 30  # s drain() waits by default for the queued commands to be acked
+COMMAND_WINDOW = 3  # max commands in flight when the firmware supports sequence numbers (its RX buffer is 64 bytes)
+SERIAL_READ_TIMEOUT = 0.02  # seconds a blocking read waits before servicing ACK timeouts
+
+
+#answer the firmware handshake, newer firmware lists its capabilities after "syn" (e.g. "syn seq")
+#and the ones we want to use are echoed back in the "syn ack"
+def handle_sync(message, sd_mode, capabilities=()):
+    message = message.strip()
+    words = message.lower().split()
+    if words and words[0] == "syn":
+        response = "syn ack" if sd_mode else "syn ack no_sd"
+        for flag in words[1:]:
+            if flag in capabilities:
+                response += " " + flag
+        return response + "\n"
+    if message.lower() == "ack tim":
+        return time.strftime("%m%d%H%M") + "\n"
+    return None
+
+
+#one connected thermocycler: serial engine, handshake, command channel and telemetry decoding,
+#no GUI involved, consumers get everything through the callbacks (called on the I/O thread):
+#  on_frame(frame, rx_time)   decoded telemetry frame (same dict for JSON and binary frames)
+#  on_console(text, tag)      console line (already timestamped if enabled), tag is None/'green'/'orange'/'red'
+#  on_error(error)            the serial connection was lost
+#with a recorder (record(), session_recorder.py) every frame and every line received or sent is saved
+class Instrument:
+
+    def __init__(self, ser, name=None, sd_mode=True, pipelined=True, binary=True, timestamps=True,
+                 window=COMMAND_WINDOW, ack_timeout=ACK_TIMEOUT, max_retries=MAX_RETRIES,
+                 read_timeout=SERIAL_READ_TIMEOUT, on_frame=None, on_console=None, on_error=None):
+        self.ser = ser
+        self.name = name or getattr(ser, 'port', None) or "thermocycler"
+        self.sd_mode = sd_mode
+        self.pipelined = pipelined
+        self.binary = binary
+        self.timestamps = timestamps
+        self.on_frame = on_frame
+        self.on_console = on_console
+        self.on_error = on_error
+        self.recorder = None
+
+        self.last_frame = {}
+        self.temp_reached = False  # last "temp_reached" reported by the firmware
+        self._frame_hooks = []
+        self._console_hooks = []
+        self._command_hooks = []
+        self._binary_hooks = {}  # frame type -> func
+        self.connected = threading.Event()  # set once the handshake has been answered (or the board was running)
+        self.ready = threading.Event()  # set by the first telemetry frame: the firmware loop reads commands
+        self._handshake_seen = False  # a "syn" or "ack tim" was received since the port was opened
+        self.decode_time = Histogram()  # ms to decode a telemetry frame
+
+        self.engine = SerialEngine(ser, on_line=self.handle_line, on_binary=self.handle_binary,
+                                   on_error=self._engine_error, read_timeout=read_timeout)
+        self.commands = CommandChannel(self._write, window=window, ack_timeout=ack_timeout,
+                                       max_retries=max_retries, on_event=self._command_event)
+        self.engine.on_wakeup = self.commands.check_timeouts
+
+    #the serial engine runs on its own thread, or on a shared SerialMultiplexer if one is given,
+    #`received` (bytes already read from the port, e.g. by discovery.probe_port) is handled first
+    def start(self, mux=None, received=b''):
+        if received:
+            self.engine.feed(received, time.monotonic())
+        if mux is not None:
+            mux.add(self.engine)
+        else:
+            self.engine.start()
+        return self
+
+    def stop(self):
+        self.engine.stop()
+
+    def close(self):
+        self.stop()
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+        if self.recorder is not None:
+            self.recorder.close()
+
+    #continue on a reopened port (e.g. after a USB glitch), the firmware handshake is answered again
+    def reconnect(self, ser, received=b'', mux=None):
+        self.stop()
+        try:
+            self.ser.close()
+        except (serial.SerialException, OSError):
+            pass
+        self.ser = ser
+        self.connected.clear()
+        self.ready.clear()
+        self._handshake_seen = False
+        self.engine.set_port(ser)
+        self.log(f"Reconnected on {getattr(ser, 'port', ser)}\n", 'green')
+        return self.start(mux, received)
+
+    #record the session to `path` (a new file in session_recorder.SESSION_DIR by default)
+    def record(self, path=None):
+        self.recorder = SessionRecorder(path or new_session_path(self.name), self.name)
+        return self.recorder
+
+    def _write(self, text):
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.sent(text)
+        self.engine.write(text)
+
+    #register the link and command metrics (metrics.py), names start with `prefix`
+    def add_metrics(self, metrics, prefix=''):
+        engine = self.engine
+        metrics.add_stats(prefix + 'link', engine.stats,
+                          rates=('wakeups', 'bytes_in', 'bytes_out', 'lines', 'frames', 'crc_errors'))
+        metrics.add_histogram(prefix + 'read_bytes', engine.wakeup_bytes)
+        metrics.add_histogram(prefix + 'decode_ms', self.decode_time)
+        metrics.add_histogram(prefix + 'frame_latency_ms', engine.latency)
+        metrics.add_stats(prefix + 'commands', self.commands.stats, rates=('sent', 'retries'))
+        metrics.add_gauge(prefix + 'commands.queued', self.commands.pending)
+        metrics.add_gauge(prefix + 'commands.in_flight', self.commands.in_flight)
+        metrics.add_histogram(prefix + 'ack_rtt_ms', self.commands.rtt)
+
+    #`func(frame, rx_time)` is called on the I/O thread for every frame, besides on_frame
+    #(the list is replaced, not modified, so the I/O thread can iterate it without a lock)
+    def add_frame_hook(self, func):
+        self._frame_hooks = self._frame_hooks + [func]
+
+    def remove_frame_hook(self, func):
+        self._frame_hooks = [hook for hook in self._frame_hooks if hook != func]
+
+    #`func(text, tag)` is called for every console line, besides on_console (same rules as frame hooks)
+    def add_console_hook(self, func):
+        self._console_hooks = self._console_hooks + [func]
+
+    def remove_console_hook(self, func):
+        self._console_hooks = [hook for hook in self._console_hooks if hook != func]
+
+    #`func(kind, command_id, message, tries)` is called for every command channel event
+    #('sent', 'ack', 'retry', 'failed')
+    def add_command_hook(self, func):
+        self._command_hooks = self._command_hooks + [func]
+
+    def remove_command_hook(self, func):
+        self._command_hooks = [hook for hook in self._command_hooks if hook != func]
+
+    #`func(frame_type, payload, rx_time)` is called on the I/O thread for the binary frames of `frame_type`
+    #besides telemetry (e.g. the SD card transfer frames, sd_transfer.py), one function per type
+    def add_binary_hook(self, frame_type, func):
+        self._binary_hooks = {**self._binary_hooks, frame_type: func}
+
+    def remove_binary_hook(self, frame_type):
+        self._binary_hooks = {key: hook for key, hook in self._binary_hooks.items() if key != frame_type}
+
+    #queue a command (e.g. "target_block_temp=95"), returns its id
+    def send(self, command):
+        return self.commands.submit(command)
+
+    #wait until every queued command was acked (or given up after its retries), e.g. the final
+    #"heat_act=false" before closing, False if `timeout` passed first or the link is down
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        commands = self.commands
+        while commands.pending() or commands.in_flight():
+            if time.monotonic() > deadline or not self.engine.is_running():
+                return False
+            time.sleep(0.05)
+        return True
+
+    #capabilities of the firmware handshake this host wants to use
+    def capabilities(self):
+        capabilities = []
+        if self.pipelined:
+            capabilities.append("seq")
+        if self.binary:
+            capabilities.append("bin")
+        return capabilities
+
+    #write a line to the console, with a timestamp if enabled
+    def log(self, text, tag=None, untimed_prefix=""):
+        hooks = self._console_hooks
+        if self.on_console is None and not hooks:
+            return
+        if self.timestamps:
+            text = f"{time.strftime('%H:%M:%S')} > {text}"
+        else:
+            text = f"{untimed_prefix}{text}"
+        for hook in hooks:
+            hook(text, tag)
+        if self.on_console is not None:
+            self.on_console(text, tag)
+
+    #handle one complete line received by the serial engine (runs on the I/O thread)
+    def handle_line(self, incoming_data, rx_time):
+
+        kind = classify_line(incoming_data)
+
+        if kind == LINE_FRAME:
+            start = time.perf_counter()
+            frame = decode_frame(incoming_data)
+            self.decode_time.record((time.perf_counter() - start) * 1000)
+            if frame is not None:
+                self._frame(frame, rx_time, incoming_data)
+                return
+
+        #frames are recorded decoded, everything else as received
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.received(incoming_data, rx_time)
+
+        if kind == LINE_SYNC:
+            response = handle_sync(incoming_data, self.sd_mode, self.capabilities())
+            if response:
+                self._handshake_seen = True
+                self._write(response)
+                self.log(f"Sent: {response}")
+                if response.startswith("syn ack"):
+                    self.commands.set_pipelined("seq" in response.split())
+                else:
+                    self.connected.set()
+
+        elif kind == LINE_ACK:
+            if self.commands.handle_ack(incoming_data):
+                return
+
+        # Anything else is displayed as a regular string
+        self.log(f"{incoming_data}\n", untimed_prefix="Received: ")
+
+    #handle one binary frame received by the serial engine (runs on the I/O thread)
+    def handle_binary(self, frame_type, payload, rx_time):
+        if frame_type == FRAME_TELEMETRY and len(payload) == TELEMETRY_STRUCT.size:
+            start = time.perf_counter()
+            frame = decode_telemetry(payload)
+            self.decode_time.record((time.perf_counter() - start) * 1000)
+            self._frame(frame, rx_time)
+        else:
+            hook = self._binary_hooks.get(frame_type)
+            if hook is not None:
+                hook(frame_type, payload, rx_time)
+            else:
+                self.log(f"Unknown binary frame type {frame_type} ({len(payload)} bytes)\n", 'orange')
+
+    #`raw` is the received line of a JSON frame (the recorder keeps it for frames outside FRAME_SCHEMA)
+    def _frame(self, frame, rx_time, raw=None):
+        if not self.connected.is_set() and not self._handshake_seen:
+            self._running_board()
+        if not self.ready.is_set():
+            self.ready.set()
+        self.last_frame = frame
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.frame(frame, rx_time, raw)
+        if 'temp_reached' in frame:
+            self.temp_reached = frame['temp_reached']
+        for hook in self._frame_hooks:
+            hook(frame, rx_time)
+        if self.on_frame:
+            self.on_frame(frame, rx_time)
+
+    #telemetry before any handshake: the board was already running when the port was opened (it was not
+    #reset, e.g. discovery.KIND_TELEMETRY), no "syn" will come, commands are sent without sequence
+    #numbers, which the firmware accepts at any time
+    def _running_board(self):
+        self.commands.set_pipelined(False)
+        self.connected.set()
+        self.log("Board already running (no handshake), commands are sent one at a time\n", 'orange')
+
+    #show the command channel activity in the console
+    def _command_event(self, kind, command_id, message, tries):
+        for hook in self._command_hooks:
+            hook(kind, command_id, message, tries)
+        label = f" #{command_id}" if self.commands.pipelined else ""
+        if kind == 'sent':
+            self.log(f"Sent{label}: {message}\n")
+        elif kind == 'ack':
+            self.log(f"ACK{label} received\n", 'green')
+        elif kind == 'retry':
+            self.log(f"Retrying{label} ({tries}): {message}\n", 'orange')
+        elif kind == 'failed':
+            self.log(f"Failed to send{label} after {tries} retries: {message}\n", 'red')
+
+    def _engine_error(self, error):
+        self.log(f"Serial connection lost: {error}\n", 'red')
+        if self.on_error:
+            self.on_error(error)
+
+
+#serial port of the device with the given hwid, None if it is not connected
+def find_port(hwid=DEVICE_HWID):
+    for port in serial.tools.list_ports.comports():
+        if port.hwid == hwid:
+            return port.device
+    return None
+
+
+#serial ports of every connected device with the given VID:PID
+def find_ports(vid_pid=DEVICE_VID_PID):
+    match = f"VID:PID={vid_pid}".upper()
+    return sorted(port.device for port in serial.tools.list_ports.comports() if match in (port.hwid or "").upper())
+
+
+#wait for the device to show up and open it, returns the serial.Serial or None after `timeout` seconds
+def connect(port=None, hwid=DEVICE_HWID, baud=BAUD_RATE, timeout=20):
+    deadline = time.time() + timeout
+    while True:
+        device = port or find_port(hwid)
+        if device:
+            try:
+                return serial.Serial(device, baud, timeout=1, exclusive=True)
+            except serial.SerialException:
+                pass
+        if time.time() > deadline:
+            return None
+        time.sleep(0.5)
@@ -0,0 +1,167 @@
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+LOD_FACTOR = 4  # samples per bucket grow by this factor from one level to the next
+LOD_LEVELS = 10  # level k holds buckets of LOD_FACTOR**k samples (4 .. ~1M)
+LEVEL_CAPACITY = 4096  # buckets kept per level (about 5 MB for the GUI channels), the coarsest levels cover days
+POINTS_PER_PIXEL = 2  # a min-max bucket is drawn as two points
+
+
+#telemetry history for plotting a whole run at any zoom level at a bounded cost
+#the last `capacity` samples are kept as they are (RingBuffer), older ones only as a min-max pyramid:
+#level k stores, for every bucket of LOD_FACTOR**k samples, its first/last time and the min and max
+#of every channel (and which of the two came first, so the envelope is drawn in the right order)
+#each sample updates the open bucket of every level with one vectorized operation, a bucket is
+#closed into its level's ring when it has collected its samples
+#query(start, end, max_points) returns the finest data that fits in max_points for a time range:
+#raw samples when zoomed in, the envelope of a coarser level when zoomed out
+#RingBuffer's interface (append, append_dict, view, last...) is available for the recent samples
+class LodHistory:
+
+    def __init__(self, channels, capacity=12000, time_channel='time', levels=LOD_LEVELS, factor=LOD_FACTOR,
+                 level_capacity=LEVEL_CAPACITY):
+        self.recent = RingBuffer(channels, capacity)
+        self.channels = self.recent.channels
+        self.time_channel = time_channel
+        self._time = self.channels.index(time_channel)
+        self.value_channels = tuple(name for name in self.channels if name != time_channel)
+        self._values = np.array([self.channels.index(name) for name in self.value_channels], dtype=np.intp)
+        self.levels = levels
+        self.level_capacity = level_capacity
+        self._sizes = factor ** np.arange(1, levels + 1, dtype=np.int64)
+
+        shape = (levels, level_capacity)
+        channels = len(self.value_channels)
+        self._times = np.zeros(shape + (2,))
+        self._mins = np.zeros(shape + (channels,))
+        self._maxs = np.zeros(shape + (channels,))
+        self._min_first = np.zeros(shape + (channels,), dtype=bool)
+        self._closed = np.zeros(levels, dtype=np.int64)  # buckets ever closed per level
+
+        #open bucket of every level
+        self._open_min = np.empty((levels, channels))
+        self._open_max = np.empty((levels, channels))
+        self._open_min_at = np.zeros((levels, channels), dtype=np.int64)
+        self._open_max_at = np.zeros((levels, channels), dtype=np.int64)
+        self._open_first = np.zeros(levels)
+        self._open_last = 0.0
+        self._open_count = np.zeros(levels, dtype=np.int64)
+        self.first_time = None
+        self.clear()
+
+    def __len__(self):
+        return len(self.recent)
+
+    def __contains__(self, name):
+        return name in self.recent
+
+    @property
+    def total(self):
+        return self.recent.total
+
+    def clear(self):
+        self.recent.clear()
+        self._closed[:] = 0
+        self._open_min[:] = np.inf
+        self._open_max[:] = -np.inf
+        self._open_count[:] = 0
+        self.first_time = None
+
+    #append one sample given as a sequence ordered like self.channels
+    def append(self, values):
+        n = self.recent.total
+        self.recent.append(values)
+        row = self.recent.last_row()
+        t = row[self._time]
+        v = row[self._values]
+        if self.first_time is None:
+            self.first_time = t
+
+        self._open_first[self._open_count == 0] = t
+        self._open_last = t
+        lower = v < self._open_min
+        np.copyto(self._open_min, v, where=lower)
+        self._open_min_at[lower] = n
+        higher = v > self._open_max
+        np.copyto(self._open_max, v, where=higher)
+        self._open_max_at[higher] = n
+        self._open_count += 1
+        for level in np.flatnonzero(self._open_count == self._sizes):
+            self._close(level)
+
+    def append_dict(self, data_dict, **extra):
+        self.append(self.recent.row_from_dict(data_dict, **extra))
+
+    def view(self, name, n=None):
+        return self.recent.view(name, n)
+
+    def views(self, n=None):
+        return self.recent.views(n)
+
+    def last(self, name):
+        return self.recent.last(name)
+
+    def _close(self, level):
+        slot = self._closed[level] % self.level_capacity
+        self._times[level, slot] = self._open_first[level], self._open_last
+        self._mins[level, slot] = self._open_min[level]
+        self._maxs[level, slot] = self._open_max[level]
+        self._min_first[level, slot] = self._open_min_at[level] <= self._open_max_at[level]
+        self._closed[level] += 1
+        self._open_min[level] = np.inf
+        self._open_max[level] = -np.inf
+        self._open_count[level] = 0
+
+    #(x, {channel: y}) covering [start, end] with at most max_points points (plus the neighbours just
+    #outside the range, so the lines reach the edges of the plot)
+    def query(self, start, end, max_points):
+        times = self.recent.view(self.time_channel)
+        if not len(times):
+            return times, {name: times for name in self.value_channels}
+        complete = self.recent.total == len(self.recent)
+        if complete or times[0] <= start:
+            first = max(int(np.searchsorted(times, start, 'left')) - 1, 0)
+            last = int(np.searchsorted(times, end, 'right')) + 1
+            if last - first <= max_points:
+                return times[first:last], {name: self.recent.view(name)[first:last] for name in self.value_channels}
+
+        for level in range(self.levels):
+            buckets = self._level_range(level, start, end)
+            if buckets is None:
+                continue
+            if POINTS_PER_PIXEL * len(buckets[0]) <= max_points or level == self.levels - 1:
+                return self._envelope(*buckets)
+        return self._envelope(*self._level_range(self.levels - 1, start, end, force=True))
+
+    #closed buckets of a level overlapping [start, end] (oldest first) plus the open one,
+    #None if the level does not go back to `start` anymore
+    def _level_range(self, level, start, end, force=False):
+        closed = int(self._closed[level])
+        count = min(closed, self.level_capacity)
+        order = (np.arange(count) + (closed - count)) % self.level_capacity
+        times = self._times[level, order]
+        if closed > count and times[0, 0] > start and not force:
+            return None
+        first = max(int(np.searchsorted(times[:, 1], start, 'left')) - 1, 0)
+        last = min(int(np.searchsorted(times[:, 0], end, 'right')) + 1, count)
+        order = order[first:last]
+        times = times[first:last]
+        mins = self._mins[level, order]
+        maxs = self._maxs[level, order]
+        min_first = self._min_first[level, order]
+        if self._open_count[level] and (not count or last == count):
+            times = np.vstack((times, [[self._open_first[level], self._open_last]]))
+            mins = np.vstack((mins, self._open_min[level]))
+            maxs = np.vstack((maxs, self._open_max[level]))
+            min_first = np.vstack((min_first, self._open_min_at[level] <= self._open_max_at[level]))
+        return times, mins, maxs, min_first
+
+    #two points per bucket: (first time, min or max), (last time, the other one)
+    def _envelope(self, times, mins, maxs, min_first):
+        x = times.ravel()
+        first = np.where(min_first, mins, maxs)
+        second = np.where(min_first, maxs, mins)
+        y = np.stack((first, second), axis=1).reshape(len(x), -1)
+        y[np.isinf(y)] = np.nan  # buckets without a valid reading of a channel
+        return x, {name: y[:, i] for i, name in enumerate(self.value_channels)}
@@ -0,0 +1,209 @@
+import bisect
+import csv
+import json
+import os
+import threading
+import time
+
+#always-on performance metrics of the host
+#the hot paths keep plain counters in their `stats` dicts and record durations in a Histogram
+#(one bisect and three additions, a few hundred ns), nothing is computed until someone reads:
+#a MetricsReader turns the registered counters, gauges and histograms into a flat snapshot
+#(rates and percentiles over the interval since that reader's previous snapshot), a SnapshotWriter
+#appends one to a JSON lines or CSV file every `interval` seconds
+#  metrics = Metrics()
+#  metrics.add_stats('engine', engine.stats, rates=('bytes_in', 'lines'))
+#  metrics.add_histogram('latency_ms', engine.latency)
+#  metrics.add_gauge('ui_queue', dispatcher.pending)
+#  SnapshotWriter(metrics, 'perf.csv', interval=10).start()
+
+HISTOGRAM_EDGES = tuple(0.001 * 2 ** (k / 2) for k in range(53))  # ms, 1 µs to ~67 s, sqrt(2) apart
+PERCENTILES = (50, 90, 99)
+SNAPSHOT_INTERVAL = 10  # s between snapshots written by a SnapshotWriter
+
+
+#histogram with fixed logarithmic buckets (1e-3 to ~67e3: ms for durations), cumulative since creation
+#written by one thread, read by any (a reader may see a record half done, which only skews one sample)
+class Histogram:
+
+    __slots__ = ('edges', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, edges=HISTOGRAM_EDGES):
+        self.edges = edges
+        self.counts = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    #(count, total, bucket counts) to diff a later state against
+    def state(self):
+        return self.count, self.total, list(self.counts)
+
+    #count, avg, percentiles and max of the values recorded since `previous` (a state(), None for all),
+    #percentiles are interpolated inside their bucket, the interval max is the upper bound of the
+    #highest bucket (both within sqrt(2) of the true value)
+    def summary(self, previous=None):
+        count, total, counts = self.state()
+        if previous is not None:
+            count -= previous[0]
+            total -= previous[1]
+            counts = [now - before for now, before in zip(counts, previous[2])]
+        result = {'count': count, 'avg': total / count if count else 0.0}
+        if not count:
+            result.update({f'p{p}': 0.0 for p in PERCENTILES}, max=0.0)
+            return result
+        targets = [(p, count * p / 100) for p in PERCENTILES]
+        seen = 0
+        top = 0
+        for i, n in enumerate(counts):
+            if not n:
+                continue
+            top = i
+            while targets and seen + n >= targets[0][1]:
+                p, target = targets.pop(0)
+                lower = self.edges[i - 1] if i else 0.0
+                result[f'p{p}'] = lower + (self._upper(i) - lower) * (target - seen) / n
+            seen += n
+        result['max'] = self._upper(top)
+        return result
+
+    def _upper(self, i):
+        return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+
+
+#what can be read: counters/gauges dicts (or functions returning one), single gauges and histograms
+class Metrics:
+
+    def __init__(self):
+        self._stats = []  # (prefix, dict or function, keys with a rate)
+        self._gauges = []  # (name, function)
+        self._histograms = []  # (name, Histogram)
+        self.started = time.monotonic()
+
+    #numeric entries of `stats` as `prefix.key`, a `prefix.key_per_s` rate is added for the keys in `rates`
+    def add_stats(self, prefix, stats, rates=()):
+        self._stats.append((prefix, stats, tuple(rates)))
+
+    def add_gauge(self, name, func):
+        self._gauges.append((name, func))
+
+    def add_histogram(self, name, histogram):
+        self._histograms.append((name, histogram))
+
+    def reader(self):
+        return MetricsReader(self)
+
+
+#snapshots of a Metrics registry, each reader keeps its own baseline for the rates and percentiles
+#(taken when it is created, so its first snapshot covers the time since then)
+class MetricsReader:
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._last_time = time.monotonic()
+        self._last_values = {}
+        self._last_histograms = {}
+        self.snapshot()
+
+    #flat {name: number} of everything registered
+    def snapshot(self):
+        metrics = self.metrics
+        now = time.monotonic()
+        dt = max(now - self._last_time, 1e-6)
+        snapshot = {'time': round(time.time(), 3), 'uptime_s': round(now - metrics.started, 3)}
+        values = {}
+        for prefix, stats, rates in metrics._stats:
+            stats = stats() if callable(stats) else dict(stats)
+            for key, value in stats.items():
+                if isinstance(value, (int, float)):
+                    snapshot[f"{prefix}.{key}"] = value
+            for key in rates:
+                name = f"{prefix}.{key}"
+                value = stats.get(key, 0)
+                values[name] = value
+                snapshot[f"{name}_per_s"] = (value - self._last_values.get(name, value)) / dt
+        for name, func in metrics._gauges:
+            snapshot[name] = func()
+        for name, histogram in metrics._histograms:
+            state = histogram.state()
+            for key, value in histogram.summary(self._last_histograms.get(name)).items():
+                snapshot[f"{name}.{key}"] = value
+            self._last_histograms[name] = state
+        self._last_time = now
+        self._last_values = values
+        return snapshot
+
+
+#text of a snapshot for the stats pane, one line per metric group
+def format_snapshot(snapshot):
+    groups = {}
+    for name, value in snapshot.items():
+        group, _, key = name.rpartition('.')
+        groups.setdefault(group, []).append(f"{key} {_format_value(value)}")
+    return "\n".join(f"{group or 'run'}: " + ", ".join(items) for group, items in groups.items())
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return f"{value:.3f}" if abs(value) < 10 else f"{value:.1f}"
+    return str(value)
+
+
+#appends a snapshot every `interval` seconds (and a last one on stop) to `path`:
+#CSV if it ends with .csv (columns of the file header or the first snapshot), JSON lines otherwise
+class SnapshotWriter:
+
+    def __init__(self, metrics, path, interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.reader = metrics.reader()
+        self.csv = path.lower().endswith('.csv')
+        self._columns = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="metrics-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.write()
+
+    def write(self, snapshot=None):
+        snapshot = snapshot or self.reader.snapshot()
+        with open(self.path, 'a', newline='') as f:
+            if not self.csv:
+                f.write(json.dumps(snapshot) + "\n")
+                return
+            if self._columns is None:
+                if f.tell() == 0:
+                    self._columns = list(snapshot)
+                    csv.writer(f).writerow(self._columns)
+                else:
+                    with open(self.path, newline='') as existing:
+                        self._columns = next(csv.reader(existing), None) or list(snapshot)
+            csv.writer(f).writerow([snapshot.get(name, '') for name in self._columns])
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError as e:
+                print(f"Metrics snapshot to {self.path} failed: {e}")
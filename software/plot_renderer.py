@@ -0,0 +1,202 @@
+import time
+
+from lod_history import POINTS_PER_PIXEL
+from metrics import Histogram
+
+
+#(channel, label, color, linestyle) of the lines drawn against the 'time' channel
+DEFAULT_TRACES = [
+    ('block_temperature', 'Block Temp', 'red', '-'),
+    ('target_block_temp', 'Block Target Temp', 'orange', '--'),
+    ('cap_temperature', 'Cap Temp', 'blue', '-'),
+    ('target_cap_temp', 'Cap Target Temp', 'green', '--'),
+]
+
+
+#incremental temperature plot: the line artists are created once and updated with set_data,
+#incoming samples only mark the plot dirty and a timer redraws at most `fps` times per second,
+#blitting the axes area unless the time axis has to grow (then a full redraw is done)
+#with a LodHistory (lod_history.py) the plot shows the whole run (or the last `window` seconds) and
+#draws at most POINTS_PER_PIXEL points per pixel of the axes whatever the zoom, a plain RingBuffer
+#is drawn as it is
+#the time axis follows the data until the user zooms or pans (set_window follows again)
+class PlotRenderer:
+
+    def __init__(self, fig, ax, canvas, history, fps=10, traces=DEFAULT_TRACES, ylim=(0, 120), show_stats=True,
+                 window=None):
+        self.fig = fig
+        self.ax = ax
+        self.canvas = canvas
+        self.history = history
+        self.fps = fps
+        self.window = window  # seconds shown while following, None for the whole run
+        self.follow = True
+
+        self.dirty = False
+        self.pending_samples = 0
+        self.stats = {
+            'frames': 0,
+            'full_redraws': 0,
+            'samples': 0,
+            'points': 0,
+            'last_draw_ms': 0.0,
+            'avg_draw_ms': 0.0,
+            'max_draw_ms': 0.0,
+            'fps': 0.0,
+        }
+        self.draw_time = Histogram()  # ms per render (blit or full redraw)
+        self._fps_window_start = time.perf_counter()
+        self._fps_window_frames = 0
+        self._background = None
+        self._timer = None
+        self._setting_xlim = False
+
+        ax.set_title("Temperature Over Time")
+        ax.set_xlabel("Time (s)")
+        ax.set_ylabel("Temperature (°C)")
+        ax.set_ylim(*ylim)
+        ax.set_xlim(0, 10)
+
+        self.lines = {}
+        for key, label, color, linestyle in traces:
+            line, = ax.plot([], [], label=label, color=color, linestyle=linestyle, animated=True)
+            self.lines[key] = line
+        ax.legend(loc='upper left')
+
+        self.stats_text = None
+        if show_stats:
+            self.stats_text = ax.text(0.99, 0.02, "", transform=ax.transAxes, ha='right', va='bottom',
+                                      fontsize=8, color='gray', animated=True)
+
+        self._artists = list(self.lines.values()) + ([self.stats_text] if self.stats_text else [])
+        self._blit = getattr(canvas, 'supports_blit', False)
+        self._draw_cid = canvas.mpl_connect('draw_event', self._on_draw)
+        ax.callbacks.connect('xlim_changed', self._on_xlim_changed)
+
+    #start the redraw timer (uses the backend timer, so it runs on the GUI thread)
+    def start(self):
+        if self._timer is None:
+            self._timer = self.canvas.new_timer(interval=max(1, int(1000 / self.fps)))
+            self._timer.add_callback(self.render)
+            self._timer.start()
+        self.canvas.draw()
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def set_fps(self, fps):
+        self.fps = fps
+        if self._timer is not None:
+            self._timer.interval = max(1, int(1000 / fps))
+
+    #follow the data again, showing the last `window` seconds (None for the whole run)
+    def set_window(self, window):
+        self.window = window
+        self.follow = True
+        self.dirty = True
+
+    #called for every new sample, the actual drawing happens on the next timer tick
+    def mark_dirty(self, samples=1):
+        self.pending_samples += samples
+        self.dirty = True
+
+    def render(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+
+        t0 = time.perf_counter()
+
+        full = self._update_xlim()
+        lo, hi = self.ax.get_xlim()
+        times, columns = self._data(lo, hi)
+        for key, line in self.lines.items():
+            line.set_data(times, columns[key])
+        self.stats['points'] = len(times)
+
+        full = full or self._background is None or not self._blit
+        if self.stats_text is not None:
+            self.stats_text.set_text(self._format_stats())
+
+        if full:
+            #draw_event handler recaptures the background and draws the lines
+            self.canvas.draw()
+            self.stats['full_redraws'] += 1
+        else:
+            self.canvas.restore_region(self._background)
+            self._draw_artists()
+            self.canvas.blit(self.ax.bbox)
+
+        self._record_frame((time.perf_counter() - t0) * 1000)
+
+    #points of the visible time range: decimated to the axes width if the history supports it
+    def _data(self, lo, hi):
+        history = self.history
+        if hasattr(history, 'query'):
+            return history.query(lo, hi, max(int(self.ax.bbox.width * POINTS_PER_PIXEL), 2))
+        return history.view('time'), {key: history.view(key) for key in self.lines}
+
+    #grow the time axis with some headroom so most frames can be blitted
+    def _update_xlim(self):
+        times = self.history.view('time')
+        if len(times) == 0 or not self.follow:
+            return False
+        lo, hi = self.ax.get_xlim()
+        t_first = getattr(self.history, 'first_time', None)
+        if t_first is None:
+            t_first = float(times[0])
+        t_last = float(times[-1])
+        if self.window is not None:
+            t_first = max(t_first, t_last - self.window)
+        span = max(t_last - t_first, 1.0)
+        if t_last <= hi and t_first - lo <= span * 0.25 and lo <= t_first:
+            return False
+        self._setting_xlim = True
+        try:
+            self.ax.set_xlim(t_first, t_last + max(span * 0.25, 10.0))
+        finally:
+            self._setting_xlim = False
+        return True
+
+    #zoom or pan from the user (navigation toolbar): stop following and redraw the new range
+    def _on_xlim_changed(self, ax):
+        if not self._setting_xlim:
+            self.follow = False
+            self.dirty = True
+
+    def _on_draw(self, event):
+        if self._blit:
+            self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self._artists:
+            self.ax.draw_artist(artist)
+
+    def _record_frame(self, draw_ms):
+        stats = self.stats
+        stats['frames'] += 1
+        stats['samples'] += self.pending_samples
+        self.pending_samples = 0
+        stats['last_draw_ms'] = draw_ms
+        self.draw_time.record(draw_ms)
+        stats['max_draw_ms'] = max(stats['max_draw_ms'], draw_ms)
+        if stats['frames'] == 1:
+            stats['avg_draw_ms'] = draw_ms
+        else:
+            stats['avg_draw_ms'] += (draw_ms - stats['avg_draw_ms']) * 0.05
+
+        self._fps_window_frames += 1
+        now = time.perf_counter()
+        if now - self._fps_window_start >= 1.0:
+            stats['fps'] = self._fps_window_frames / (now - self._fps_window_start)
+            self._fps_window_start = now
+            self._fps_window_frames = 0
+
+    def _format_stats(self):
+        stats = self.stats
+        return (f"draw {stats['last_draw_ms']:.1f} ms (avg {stats['avg_draw_ms']:.1f}, max {stats['max_draw_ms']:.1f}) "
+                f"| {stats['fps']:.1f} fps | {stats['samples']} samples, {stats['points']} points, "
+                f"{stats['full_redraws']} full redraws")
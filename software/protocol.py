@@ -0,0 +1,236 @@
+import json
+import math
+import os
+
+#PCR protocol files (JSON, or YAML if PyYAML is installed), compiled once into a flat Timeline
+#
+#  {
+#    "name": "Touchdown PCR",
+#    "lid_temp": 110,                         target_cap_temp for the whole run (default 110)
+#    "ramp": {"heat": 2.0, "cool": 0.8},      degrees per second, only used for the time estimates
+#    "steps": [                               main program, "end" skips what is left of it
+#      {"name": "Initial denaturation", "temp": 95, "hold": 180},
+#      {"cycles": 10, "steps": [              repeated block (blocks can be nested)
+#        {"name": "Denaturation", "temp": 95, "hold": 30},
+#        {"name": "Annealing", "temp": 65, "hold": 30, "temp_step": -1},    touchdown: -1 degree per cycle
+#        {"name": "Extension", "temp": 72, "hold": 45, "hold_step": 5}      +5 s per cycle
+#      ]}
+#    ],
+#    "final": [                               always run, also after "end"
+#      {"name": "Final extension", "temp": 72, "hold": 600, "wait": false},
+#      {"name": "Cooling", "temp": 0, "hold": 120, "wait": false, "commands": ["target_cap_temp=0"]}
+#    ],
+#    "finish": ["heat_act=false"]
+#  }
+#
+#a step sets target_block_temp to `temp`, waits for the temperature to be reached (unless "wait" is
+#false) and holds it for `hold` seconds, "commands" are extra firmware commands sent with it
+#"temp_step"/"hold_step" change the step on every cycle of its block (touchdown, gradient over cycles),
+#clamped by "temp_limit"
+
+DEFAULT_LID_TEMP = 110
+DEFAULT_HEAT_RATE = 0.65  # degrees per second while heating the block, for the time estimates (median of the Example_logs steps)
+DEFAULT_COOL_RATE = 0.9  # degrees per second while cooling it (same logs)
+START_TEMP = 22.0  # block temperature assumed before the first step
+DEFAULT_FINISH = ["heat_act=false"]
+
+PHASE_MAIN = 'main'
+PHASE_FINAL = 'final'
+
+PROTOCOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'protocols')
+DEFAULT_PROTOCOL_FILE = os.path.join(PROTOCOL_DIR, 'default.json')
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+#expected seconds to bring the block from `start` to `end`
+def ramp_time(start, end, heat_rate=DEFAULT_HEAT_RATE, cool_rate=DEFAULT_COOL_RATE):
+    if end >= start:
+        return (end - start) / heat_rate
+    return (start - end) / cool_rate
+
+
+#one entry of the timeline, everything the runner needs is precomputed
+class Step:
+
+    def __init__(self, name, temp, hold, wait, commands, phase, cycle=0, cycles=0, ramp=0.0):
+        self.name = name
+        self.temp = temp
+        self.hold = hold
+        self.wait = wait
+        self.commands = commands
+        self.phase = phase
+        self.cycle = cycle  # 1-based cycle of the innermost block, 0 outside of blocks
+        self.cycles = cycles
+        self.ramp = ramp  # expected seconds to reach `temp` from the previous step
+
+    def expected(self):
+        return self.hold + (self.ramp if self.wait else 0.0)
+
+    def __repr__(self):
+        return f"Step({self.name!r}, {self.temp}, {self.hold}s, cycle {self.cycle}/{self.cycles}, {self.phase})"
+
+
+class Timeline:
+
+    def __init__(self, name, steps, startup, finish, heat_rate=DEFAULT_HEAT_RATE, cool_rate=DEFAULT_COOL_RATE,
+                 ramp_model=None):
+        self.name = name
+        self.steps = steps
+        self.startup = startup
+        self.finish = finish
+        self.heat_rate = heat_rate
+        self.cool_rate = cool_rate
+        self.ramp_model = ramp_model
+        self.cycles = max((step.cycles for step in steps), default=0)
+        self.final_index = next((i for i, step in enumerate(steps) if step.phase == PHASE_FINAL), len(steps))
+
+        #_after[i]: expected seconds from the start of step i to the end of the run
+        self._after = [0.0] * (len(steps) + 1)
+        for i in range(len(steps) - 1, -1, -1):
+            self._after[i] = self._after[i + 1] + steps[i].expected()
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, index):
+        return self.steps[index]
+
+    #expected seconds to bring the block from `start` to `end`, from the instrument's fitted ramp rates
+    #if there is a model (thermal_fit.py), from the protocol ramp rates otherwise
+    def ramp_time(self, start, end):
+        if self.ramp_model is not None:
+            return self.ramp_model.ramp_time(start, end)
+        return ramp_time(start, end, self.heat_rate, self.cool_rate)
+
+    def total(self):
+        return self._after[0]
+
+    #expected seconds left, O(1): `index` is the current step, `hold_elapsed` the seconds already held
+    #(None while still ramping to the step temperature, measured from `block_temp` if known)
+    def remaining(self, index, hold_elapsed=None, block_temp=None):
+        if index >= len(self.steps):
+            return 0.0
+        step = self.steps[index]
+        if hold_elapsed is not None:
+            current = max(0.0, step.hold - hold_elapsed)
+        elif step.wait and block_temp is not None and not math.isnan(block_temp):
+            current = self.ramp_time(block_temp, step.temp) + step.hold
+        else:
+            current = step.expected()
+        return current + self._after[index + 1]
+
+    #remaining time if the run is ended now (the rest of the main program is skipped)
+    def remaining_after_end(self):
+        return self._after[self.final_index]
+
+
+def _format_temp(temp):
+    return f"{temp:g}"
+
+
+def _number(entry, key, default=None, minimum=None):
+    value = entry.get(key, default)
+    if value is None:
+        raise ProtocolError(f"step {entry.get('name', entry)!r} needs '{key}'")
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ProtocolError(f"'{key}' of step {entry.get('name', entry)!r} must be a number")
+    if minimum is not None and value < minimum:
+        raise ProtocolError(f"'{key}' of step {entry.get('name', entry)!r} must be at least {minimum}")
+    return float(value)
+
+
+#expand a list of steps and blocks, `cycle_path` holds (cycle index, cycles) of the enclosing blocks
+def _expand(entries, phase, out, cycle_path=()):
+    if not isinstance(entries, list):
+        raise ProtocolError("'steps' must be a list")
+    for entry in entries:
+        if not isinstance(entry, dict):
+            raise ProtocolError(f"invalid step {entry!r}")
+        if 'steps' in entry:
+            cycles = int(_number(entry, 'cycles', 1, minimum=1))
+            for cycle in range(cycles):
+                _expand(entry['steps'], phase, out, cycle_path + ((cycle, cycles),))
+            continue
+
+        cycle, cycles = cycle_path[-1] if cycle_path else (0, 0)
+        temp = _number(entry, 'temp') + _number(entry, 'temp_step', 0) * cycle
+        limit = entry.get('temp_limit')
+        if limit is not None:
+            temp = max(temp, limit) if entry.get('temp_step', 0) < 0 else min(temp, limit)
+        hold = _number(entry, 'hold', minimum=0) + _number(entry, 'hold_step', 0) * cycle
+        commands = [f"target_block_temp={_format_temp(round(temp, 2))}"] + list(entry.get('commands', []))
+        out.append(Step(entry.get('name', f"{_format_temp(temp)} C"), round(temp, 2), max(0.0, hold),
+                        bool(entry.get('wait', True)), commands, phase,
+                        cycle + 1 if cycle_path else 0, cycles))
+
+
+#compile a protocol dict into a Timeline, `cycles` overrides the repeat count of the outermost blocks
+#`ramp_model` (anything with ramp_time(start, end), see thermal_fit.py) replaces the protocol ramp rates
+def compile_protocol(protocol, cycles=None, ramp_model=None):
+    if not isinstance(protocol, dict):
+        raise ProtocolError("a protocol must be an object")
+    if cycles is not None:
+        protocol = dict(protocol)
+        protocol['steps'] = [dict(entry, cycles=cycles) if isinstance(entry, dict) and 'steps' in entry else entry
+                             for entry in protocol.get('steps', [])]
+
+    steps = []
+    _expand(protocol.get('steps', []), PHASE_MAIN, steps)
+    _expand(protocol.get('final', []), PHASE_FINAL, steps)
+    if not steps:
+        raise ProtocolError("the protocol has no steps")
+
+    ramp = protocol.get('ramp', {})
+    heat_rate = float(ramp.get('heat', DEFAULT_HEAT_RATE))
+    cool_rate = float(ramp.get('cool', DEFAULT_COOL_RATE))
+    if heat_rate <= 0 or cool_rate <= 0:
+        raise ProtocolError("ramp rates must be positive")
+
+    lid_temp = protocol.get('lid_temp', DEFAULT_LID_TEMP)
+    startup = ["heat_act=true", f"target_cap_temp={_format_temp(lid_temp)}"] + list(protocol.get('startup', []))
+    finish = list(protocol.get('finish', DEFAULT_FINISH))
+
+    previous = START_TEMP
+    for step in steps:
+        if ramp_model is not None:
+            step.ramp = ramp_model.ramp_time(previous, step.temp)
+        else:
+            step.ramp = ramp_time(previous, step.temp, heat_rate, cool_rate)
+        previous = step.temp
+    return Timeline(protocol.get('name', "Protocol"), steps, startup, finish, heat_rate, cool_rate, ramp_model)
+
+
+#read a protocol file, YAML needs PyYAML (pip install pyyaml)
+def load_protocol(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if path.lower().endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ProtocolError("YAML protocols need PyYAML (pip install pyyaml)")
+        try:
+            return yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ProtocolError(f"{path}: {e}")
+    try:
+        return json.loads(text)
+    except ValueError as e:
+        raise ProtocolError(f"{path}: {e}")
+
+
+def load_timeline(path=None, cycles=None, ramp_model=None):
+    return compile_protocol(load_protocol(path or DEFAULT_PROTOCOL_FILE), cycles, ramp_model)
+
+
+#"1h 02m", "3m 05s", "42s"
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
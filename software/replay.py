@@ -0,0 +1,377 @@
+import argparse
+import collections
+import sys
+import threading
+import time
+
+import numpy as np
+
+from binary_frame import encode_telemetry
+from frame_decoder import format_frame
+from run_analysis import log_time
+from sd_log import LogStream
+from session_recorder import SessionReader, SESSION_SUFFIX, KIND_FRAME, KIND_RX, KIND_RAW, FRAME_ALL, frame_mask
+
+#plays a recorded session (session_recorder.py) or an SD card log back through the live pipeline:
+#ReplaySerial stands in for the serial.Serial given to Instrument / serial_comm.main and hands out the
+#recorded telemetry and console lines at their original pace, `speed` times faster, or as fast as the
+#host handles them (speed None), what the host writes is counted and dropped (commands are never ACKed)
+#frames are sent as JSON lines like the firmware does, or as binary frames (binary_frame.py)
+#  python replay.py bench ../Example_logs/LOG.CSV --speed max    headless parse -> panel -> graph throughput
+#  python serial_comm.py --replay SESSION.tcs --speed 10          the Tk app fed by the recording
+
+REPLAY_WINDOW = 5000  # frames handed out ahead of the consumer at max speed (one UIDispatcher batch)
+READ_CHUNK = 65536  # max bytes returned by one read
+BACKPRESSURE_POLL = 0.001  # s between checks of the consumer when the window is full
+
+#SD log column of every frame field (the log has no hold/program state nor timers)
+LOG_FRAME_FIELDS = {
+    'block_temperature': 'block_temp_1',
+    'target_block_temp': 'target_temp_block',
+    'block_gradient': 'block_gradient',
+    'cap_temperature': 'temp_cap',
+    'target_cap_temp': 'target_temp_cap',
+    'cap_gradient': 'cap_gradient',
+    'redundant_temp': 'block_temp_2',
+    'H_pwm': 'H70_pwm',
+    'H_CAP_pwm': 'H_CAP_pwm',
+}
+LOG_FLAG_FIELDS = ['H_act', 'H_CAP_act', 'FAN_act', 'AZ_5', 'heat_act']  # 0/1 columns, H_act is H70_act
+REACHED_BAND = 1.0  # °C, temp_reached is rebuilt from the log as |block - target| below this while heating
+LOG_FRAME_DEFAULTS = {'holding_temp': False, 'program_active': False, 'timers': [0, 0], 'end_timers': [0, 0]}
+
+
+#(time, bytes, frames) of a recorded session, frames encoded again in the wire format (or sent as they
+#were received when the session kept their line, frames outside FRAME_SCHEMA), commands sent by the host
+#are left out
+def session_events(path, start=None, end=None, binary=False):
+    with SessionReader(path) as reader:
+        pending = None  # frame record waiting to see if its raw line follows
+        for t, kind, payload in reader.events(start, end):
+            if kind == KIND_RAW:
+                pending = None
+                yield t, (payload + "\n").encode('utf-8'), 1
+                continue
+            if pending is not None:
+                yield pending[0], _encode(pending[1], pending[0], binary), 1
+                pending = None
+            if kind == KIND_FRAME:
+                pending = (t, payload)
+            elif kind == KIND_RX:
+                yield t, (payload + "\n").encode('utf-8'), 0
+        if pending is not None:
+            yield pending[0], _encode(pending[1], pending[0], binary), 1
+
+
+#(time, bytes, frames) of an SD card log: every row becomes the telemetry frame sent along with it,
+#event lines (AZ_5 reasons) are sent as console lines at the time of the row before them
+#the time keeps increasing across reboots (run_analysis.log_time), standalone logs span several boots
+def log_events(path, start=None, end=None, binary=False):
+    stream = LogStream(path)
+    first = None
+    previous = None  # (millis, seconds) of the last row of the previous chunk
+    rows = 0
+    sent = 0
+    t = 0.0
+    for chunk in stream:
+        millis = chunk['millis']
+        if not len(millis):
+            continue
+        seconds = log_time(millis, previous)
+        previous = (float(millis[-1]), float(seconds[-1]))
+        if first is None:
+            first = float(seconds[0])
+        times = (seconds - first).tolist()
+        mean = (chunk['block_temp_1'].astype(np.float64) + chunk['block_temp_2']) / 2
+        columns = {key: chunk[column].tolist() for key, column in LOG_FRAME_FIELDS.items()}
+        columns['H_act'] = chunk['H70_act'].astype(bool).tolist()
+        for key in LOG_FLAG_FIELDS[1:]:
+            columns[key] = chunk[key].astype(bool).tolist()
+        columns['temp_reached'] = ((chunk['heat_act'] == 1) &
+                                   (np.abs(mean - chunk['target_temp_block']) < REACHED_BAND)).tolist()
+        buttons = np.stack((chunk['l_btn'], chunk['r_btn']), axis=1).tolist()
+        keys = list(columns)
+
+        #events are sent before the first row that follows them in the log
+        events = stream.events
+        event_rows = stream.event_rows
+        for i, values in enumerate(zip(*columns.values())):
+            t = times[i]
+            while sent < len(events) and event_rows[sent] <= rows + i:
+                if _in_range(t, start, end):
+                    yield t, (events[sent][1] + "\n").encode('utf-8'), 0
+                sent += 1
+            if not _in_range(t, start, end):
+                continue
+            frame = dict(zip(keys, values), buttons=buttons[i], **LOG_FRAME_DEFAULTS)
+            yield t, _encode(frame, t, binary), 1
+        rows += len(millis)
+
+    #lines after the last row (e.g. the AZ_5 reason at the end of a log)
+    for _, text in stream.events[sent:]:
+        if _in_range(t, start, end):
+            yield t, (text + "\n").encode('utf-8'), 0
+
+
+#events of a recording: session files by their suffix, anything else is read as an SD card log
+def open_source(path, start=None, end=None, binary=False):
+    if path.lower().endswith(SESSION_SUFFIX):
+        return session_events(path, start, end, binary)
+    return log_events(path, start, end, binary)
+
+
+def _in_range(t, start, end):
+    return (start is None or t >= start) and (end is None or t <= end)
+
+
+#frames missing keys go as JSON lines in binary mode too, like the firmware's AZ_5 diagnostics frame
+def _encode(frame, t, binary):
+    if binary and frame_mask(frame) == FRAME_ALL:
+        return encode_telemetry(frame, int(t * 1000))
+    return (format_frame(frame) + "\n").encode('ascii')
+
+
+#serial.Serial stand-in reading from a recording
+#an event is due `(t - t0) / speed` seconds after the first read, read() blocks until something is due
+#(or `timeout` passes, like a quiet port) and in_waiting counts what is due
+#with speed None events are due right away, `consumed()` (frames the host has handled so far, e.g.
+#lambda: instrument.engine.stats['frames']) then keeps at most `window` frames in flight so a fast
+#replay measures what the pipeline sustains instead of filling its queues
+#clock() is the recorded time (s from the start of the recording) of the last frame handed out
+class ReplaySerial:
+
+    def __init__(self, events, speed=1.0, timeout=1, consumed=None, window=REPLAY_WINDOW, port="replay"):
+        if speed is not None and speed <= 0:
+            raise ValueError("speed must be positive")
+        self.port = port
+        self.timeout = timeout
+        self.speed = speed
+        self.consumed = consumed
+        self.window = window
+        self.is_open = True
+        self.finished = threading.Event()  # set once the last event has been handed out
+
+        self._events = iter(events)
+        self._next = None  # next event not handed out yet
+        self._buffer = bytearray()
+        self._t0 = None
+        self._start = None
+        self._clock = 0.0
+        self.stats = {
+            'frames': 0,
+            'lines': 0,
+            'bytes': 0,
+            'bytes_written': 0,
+            'started': None,
+            'ended': None,
+        }
+
+    @property
+    def in_waiting(self):
+        self._fill()
+        return len(self._buffer)
+
+    def read(self, size=1):
+        if not self.is_open:
+            raise OSError("replay closed")
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            delay = self._fill()
+            if self._buffer:
+                data = bytes(self._buffer[:size])
+                del self._buffer[:size]
+                return data
+            if not self.is_open:
+                raise OSError("replay closed")
+            now = time.monotonic()
+            if deadline is not None:
+                if now >= deadline:
+                    return b''
+                delay = min(delay, deadline - now)
+            time.sleep(delay)
+
+    def write(self, data):
+        self.stats['bytes_written'] += len(data)
+        return len(data)
+
+    def reset_input_buffer(self):
+        self._buffer.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    def clock(self):
+        return self._clock
+
+    #seconds spent replaying and recorded seconds handed out, frames/s and the speed achieved
+    def summary(self):
+        stats = self.stats
+        if stats['started'] is None:
+            return dict(stats, elapsed=0.0, recorded=0.0, frames_per_s=0.0, speed=0.0)
+        elapsed = max((stats['ended'] or time.monotonic()) - stats['started'], 1e-9)
+        return dict(stats, elapsed=elapsed, recorded=self._clock, frames_per_s=stats['frames'] / elapsed,
+                    speed=self._clock / elapsed)
+
+    #move the due events to the read buffer, returns the time to wait for the next one
+    def _fill(self):
+        stats = self.stats
+        now = time.monotonic()
+        if self._start is None:
+            self._start = now
+            stats['started'] = now
+        while len(self._buffer) < READ_CHUNK:
+            if self._next is None:
+                self._next = next(self._events, None)
+                if self._next is None:
+                    if not self.finished.is_set():
+                        stats['ended'] = now
+                        self.finished.set()
+                    return 0.05
+            t, data, frames = self._next
+            if self._t0 is None:
+                self._t0 = t
+            if self.speed is not None:
+                due = self._start + (t - self._t0) / self.speed
+                if due > now:
+                    return due - now
+            elif frames and self.consumed is not None and stats['frames'] - self.consumed() >= self.window:
+                return BACKPRESSURE_POLL
+            self._buffer += data
+            self._next = None
+            self._clock = t - self._t0
+            stats['bytes'] += len(data)
+            if frames:
+                stats['frames'] += frames
+            else:
+                stats['lines'] += 1
+        return 0.0
+
+
+#headless run of the live pipeline on a recording: the Instrument decodes on its I/O thread, the main
+#thread plays the Tk side (variables panel changes, graph history, Agg plot redrawn at `fps`), draining
+#up to `max_batch` frames every `interval` seconds like the UI dispatcher does; returns the throughput figures
+def bench(path, speed=None, binary=False, plot=True, start=None, end=None, fps=None, interval=None,
+          max_batch=5000, stats=False, out=sys.stdout):
+    from instrument import Instrument
+    from lod_history import LodHistory
+    from variables_panel import PanelModel
+    from metrics import Metrics, format_snapshot
+    import serial_comm
+
+    fps = fps or serial_comm.PLOT_FPS
+    interval = interval or serial_comm.UI_DISPATCH_INTERVAL / 1000
+    history = LodHistory(serial_comm.HISTORY_CHANNELS, serial_comm.HISTORY_CAPACITY)
+    pending = collections.deque()
+    instrument = None
+    ser = ReplaySerial(open_source(path, start, end, binary), speed,
+                       consumed=lambda: instrument.engine.stats['frames'], port=f"replay:{path}")
+    instrument = Instrument(ser, binary=binary, timestamps=False,
+                            on_frame=lambda frame, rx_time: pending.append((frame, rx_time)),
+                            on_error=lambda error: print(f"replay stopped: {error!r}", file=sys.stderr))
+
+    metrics = Metrics()
+    instrument.add_metrics(metrics)
+    renderer = None
+    if plot:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from plot_renderer import PlotRenderer
+
+        fig = Figure(figsize=(15, 4), dpi=100)
+        ax = fig.add_subplot(111)
+        renderer = PlotRenderer(fig, ax, FigureCanvasAgg(fig), history, fps=fps)
+        metrics.add_histogram('draw_ms', renderer.draw_time)
+
+    panel = PanelModel()
+    metrics.add_stats('panel', panel.stats)
+    reader = metrics.reader()
+    labels = {}
+    backlog = 0
+    next_render = next_panel = 0.0
+    instrument.start()
+    try:
+        while not (ser.finished.is_set() and not pending and instrument.engine.stats['frames'] >= ser.stats['frames']):
+            time.sleep(interval)
+            backlog = max(backlog, len(pending))
+            for _ in range(min(len(pending), max_batch)):
+                frame, rx_time = pending.popleft()
+                panel.update(frame)
+                history.append_dict(frame, time=ser.clock())
+                if renderer is not None:
+                    renderer.mark_dirty()
+                instrument.engine.record_frame(rx_time)
+            now = time.monotonic()
+            if now >= next_panel:
+                labels.update(panel.changes())
+                next_panel = now + serial_comm.PANEL_REFRESH / 1000
+            if renderer is not None and now >= next_render:
+                renderer.render()
+                next_render = now + 1 / fps
+            if not instrument.engine.is_running():
+                break
+    finally:
+        instrument.close()
+
+    result = ser.summary()
+    engine = instrument.engine.stats
+    result['handled'] = engine['frames']
+    result['latency_avg_ms'] = engine['latency_sum_ms'] / engine['frames'] if engine['frames'] else 0.0
+    result['latency_max_ms'] = engine['latency_max_ms']
+    result['backlog'] = backlog
+    result['panel_updates'] = panel.stats['changes']
+    if renderer is not None:
+        result['draws'] = renderer.stats['frames']
+        result['draw_avg_ms'] = renderer.stats['avg_draw_ms']
+        result['draw_max_ms'] = renderer.stats['max_draw_ms']
+    if out is not None:
+        print(format_summary(result), file=out)
+        if stats:
+            print(format_snapshot(reader.snapshot()), file=out)
+    return result
+
+
+def format_summary(result):
+    text = (f"{result['frames']} frames, {result['lines']} lines, {result['recorded']:.1f} s recorded "
+            f"in {result['elapsed']:.2f} s: {result['frames_per_s']:.0f} frames/s ({result['speed']:.1f}x)")
+    if 'handled' in result:
+        text += (f"\nlatency avg {result['latency_avg_ms']:.1f} ms, max {result['latency_max_ms']:.1f} ms, "
+                 f"max backlog {result['backlog']} frames, {result['panel_updates']} panel label updates")
+    if 'draws' in result:
+        text += (f"\n{result['draws']} draws, avg {result['draw_avg_ms']:.1f} ms, "
+                 f"max {result['draw_max_ms']:.1f} ms")
+    return text
+
+
+#"max" (as fast as possible) or a speed-up factor
+def parse_speed(text):
+    if text.lower() in ('max', 'asap', 'inf'):
+        return None
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive")
+    return speed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded sessions and SD card logs through the host pipeline")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    bench_parser = sub.add_parser('bench', help="frames/s sustained by parse -> panel -> graph, without a window")
+    bench_parser.add_argument('path', help="session file (.tcs) or SD card log (.CSV)")
+    bench_parser.add_argument('--speed', type=parse_speed, default=None, help="speed-up factor or 'max' (default)")
+    bench_parser.add_argument('--binary', action='store_true', help="replay the frames in the binary format")
+    bench_parser.add_argument('--no-plot', action='store_true', help="leave out the graph redraws")
+    bench_parser.add_argument('--start', type=float, help="seconds from the start of the recording")
+    bench_parser.add_argument('--end', type=float, help="seconds from the start of the recording")
+    bench_parser.add_argument('--stats', action='store_true', help="print every metric (metrics.py) at the end")
+
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        bench(args.path, args.speed, args.binary, not args.no_plot, args.start, args.end, stats=args.stats)
+
+
+if __name__ == "__main__":
+    main()
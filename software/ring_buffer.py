@@ -0,0 +1,82 @@
+import numpy as np
+
+
+#fixed capacity multi-channel ring buffer for the live telemetry history
+#every sample is written twice (at i and i+capacity) so the last n samples
+#are always one contiguous slice and views can be handed out without copying
+class RingBuffer:
+
+    def __init__(self, channels, capacity=12000, dtype=np.float64):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+
+        self.channels = tuple(channels)
+        self.capacity = capacity
+        self._index = {name: i for i, name in enumerate(self.channels)}
+        self._data = np.zeros((len(self.channels), 2 * capacity), dtype=dtype)
+        self._last = np.zeros(len(self.channels), dtype=dtype)
+        self._pos = 0  #next write position in [0, capacity)
+        self._size = 0
+        self.total = 0  #number of samples ever appended
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def clear(self):
+        self._last[:] = 0
+        self._pos = 0
+        self._size = 0
+        self.total = 0
+
+    #append one sample given as a sequence ordered like self.channels
+    def append(self, values):
+        pos = self._pos
+        self._data[:, pos] = values
+        self._data[:, pos + self.capacity] = values
+        self._last[:] = self._data[:, pos]
+        self._pos = pos + 1 if pos + 1 < self.capacity else 0
+        if self._size < self.capacity:
+            self._size += 1
+        self.total += 1
+
+    #append one sample from a dict (plus optional keyword channels),
+    #channels missing from both keep their previous value
+    def append_dict(self, data_dict, **extra):
+        self.append(self.row_from_dict(data_dict, **extra))
+
+    #sample ordered like self.channels built from a dict, missing channels keep their previous value
+    def row_from_dict(self, data_dict, **extra):
+        row = self._last.copy()
+        for name, value in (*data_dict.items(), *extra.items()):
+            i = self._index.get(name)
+            if i is not None:
+                try:
+                    row[i] = float(value)
+                except (TypeError, ValueError):
+                    pass
+        return row
+
+    #zero-copy view of the last n samples (all of them by default) of one channel
+    def view(self, name, n=None):
+        start, end = self._window(n)
+        return self._data[self._index[name], start:end]
+
+    #zero-copy 2D view (channels x samples) of the last n samples
+    def views(self, n=None):
+        start, end = self._window(n)
+        return self._data[:, start:end]
+
+    def last(self, name):
+        return self._last[self._index[name]]
+
+    #last sample ordered like self.channels, not a copy: it is overwritten by the next append
+    def last_row(self):
+        return self._last
+
+    def _window(self, n):
+        size = self._size if n is None else max(0, min(n, self._size))
+        end = self._pos + self.capacity if self._size else 0
+        return end - size, end
@@ -0,0 +1,277 @@
+import argparse
+import csv
+import sys
+
+import numpy as np
+
+#quality metrics of a PCR run computed from its temperature trace (SD card log or recorded telemetry)
+#the run is cut into steps wherever the block target changes and every metric is computed for all
+#steps at once with segment reductions (np.*.reduceat), there is no Python loop over samples or steps
+#  ramp       time from the target change until the block is within ARRIVAL_BAND (what the firmware
+#             calls temp_reached), and the mean rate over it
+#  overshoot  worst excursion past the target after arrival, in the ramp direction
+#  settling   time from the target change until the block enters SETTLE_BAND for good
+#  hold       mean, std and error of the block temperature from arrival to the next target change
+#  sensors    disagreement of the two block thermocouples
+#cycles are counted at every step that targets the highest temperature of the run (denaturation),
+#steps with a target of 0 (heater off, idle, cooling down) are left out
+#  python run_analysis.py ../Example_logs/05181124.CSV --steps
+
+ARRIVAL_BAND = 1.0  # degrees, same as the firmware's temp_reached
+SETTLE_BAND = 0.5  # degrees
+CYCLE_TOLERANCE = 0.5  # degrees from the highest target that still counts as a denaturation step
+
+#one row per step
+STEP_DTYPE = np.dtype([
+    ('cycle', np.int32),
+    ('start', np.float64),  # seconds from the start of the trace
+    ('duration', np.float64),
+    ('target', np.float64),
+    ('start_temp', np.float64),
+    ('ramp_time', np.float64),  # NaN if the target was never reached
+    ('ramp_rate', np.float64),  # degrees per second, negative while cooling
+    ('overshoot', np.float64),
+    ('settling_time', np.float64),  # NaN if the block never settled
+    ('hold_time', np.float64),
+    ('hold_mean', np.float64),
+    ('hold_std', np.float64),
+    ('hold_error', np.float64),
+    ('sensor_diff_mean', np.float64),
+    ('sensor_diff_max', np.float64),
+])
+
+
+#trace of an SD card log (sd_log.read_log columns)
+def trace_from_log(columns):
+    return _trace(log_time(columns['millis']), columns['target_temp_block'], columns['block_temp_1'],
+                  columns['block_temp_2'], columns['temp_cap'])
+
+
+#seconds of every row of a log, kept increasing across reboots: millis restarts at every boot, so the
+#rows after a restart are offset to continue from the row before it (like sd_log.summarize_log)
+#`previous` is (millis, seconds) of the row before, for a log read in chunks
+def log_time(millis, previous=None):
+    millis = np.asarray(millis, dtype=np.float64)
+    if not len(millis):
+        return millis
+    previous_millis, previous_time = (millis[0], millis[0] / 1000) if previous is None else previous
+    dt = np.diff(millis, prepend=previous_millis)
+    dt[dt < 0] = 0
+    return previous_time + np.cumsum(dt) / 1000
+
+
+#trace of recorded telemetry (frame keys plus 'time' in seconds, e.g. the serial_comm history)
+def trace_from_telemetry(columns):
+    return _trace(columns['time'], columns['target_block_temp'], columns['block_temperature'],
+                  columns['redundant_temp'], columns['cap_temperature'])
+
+
+def _trace(time, target, block_1, block_2, cap):
+    time = np.asarray(time, dtype=np.float64)
+    block_1 = np.asarray(block_1, dtype=np.float64)
+    block_2 = np.asarray(block_2, dtype=np.float64)
+    block = (block_1 + block_2) / 2
+    keep = ~np.isnan(block)  # sensor faults
+    return {
+        'time': time[keep] - (time[keep][0] if keep.any() else 0),
+        'target': np.asarray(target, dtype=np.float64)[keep],
+        'block': block[keep],
+        'block_1': block_1[keep],
+        'block_2': block_2[keep],
+        'cap': np.asarray(cap, dtype=np.float64)[keep],
+    }
+
+
+class RunAnalysis:
+
+    def __init__(self, steps, duration):
+        self.steps = steps  # STEP_DTYPE array
+        self.duration = duration
+
+    @property
+    def cycles(self):
+        return int(self.steps['cycle'].max()) if len(self.steps) else 0
+
+    #per cycle: start, duration, mean ramp rates, worst overshoot and hold error
+    def cycle_table(self):
+        steps = self.steps[self.steps['cycle'] > 0]
+        rows = []
+        if not len(steps):
+            return rows
+        cycle = steps['cycle']
+        starts = np.flatnonzero(np.r_[True, cycle[1:] != cycle[:-1]])
+        ends = np.r_[starts[1:], len(steps)]
+        heating = steps['ramp_rate'] > 0
+        cooling = steps['ramp_rate'] < 0
+        for start, end in zip(starts, ends):
+            block = steps[start:end]
+            rows.append({
+                'cycle': int(block['cycle'][0]),
+                'start': block['start'][0],
+                'duration': block['start'][-1] + block['duration'][-1] - block['start'][0],
+                'heat_rate': _nanmean(block['ramp_rate'][heating[start:end]]),
+                'cool_rate': _nanmean(block['ramp_rate'][cooling[start:end]]),
+                'max_overshoot': _nanmax(block['overshoot']),
+                'max_hold_error': _nanmax(np.abs(block['hold_error'])),
+            })
+        return rows
+
+    #whole run figures
+    def summary(self):
+        steps = self.steps
+        heating = steps['ramp_rate'] > 0
+        cooling = steps['ramp_rate'] < 0
+        return {
+            'duration': self.duration,
+            'steps': len(steps),
+            'cycles': self.cycles,
+            'unreached': int(np.isnan(steps['ramp_time']).sum()),
+            'heat_rate': _nanmean(steps['ramp_rate'][heating]),
+            'cool_rate': _nanmean(steps['ramp_rate'][cooling]),
+            'max_overshoot': _nanmax(steps['overshoot']),
+            'mean_settling': _nanmean(steps['settling_time']),
+            'mean_hold_std': _nanmean(steps['hold_std']),
+            'max_hold_error': _nanmax(np.abs(steps['hold_error'])),
+            'max_sensor_diff': _nanmax(steps['sensor_diff_max']),
+        }
+
+
+def _nanmean(values):
+    return float(np.nanmean(values)) if np.any(~np.isnan(values)) else float('nan')
+
+
+def _nanmax(values):
+    return float(np.nanmax(values)) if np.any(~np.isnan(values)) else float('nan')
+
+
+#segment the trace into steps and compute their metrics
+def analyze(trace, arrival_band=ARRIVAL_BAND, settle_band=SETTLE_BAND):
+    t = trace['time']
+    target = trace['target']
+    block = trace['block']
+    n = len(t)
+    if not n:
+        return RunAnalysis(np.zeros(0, dtype=STEP_DTYPE), 0.0)
+
+    #segments: runs of a constant target
+    starts = np.flatnonzero(np.r_[True, target[1:] != target[:-1]])
+    ends = np.r_[starts[1:], n]  # exclusive
+    segment = np.repeat(np.arange(len(starts)), ends - starts)
+    index = np.arange(n)
+    seg_target = target[starts]
+    start_temp = block[starts]
+    direction = np.where(seg_target >= start_temp, 1.0, -1.0)
+    error = block - target
+
+    #arrival: first sample within the band
+    arrived = np.minimum.reduceat(np.where(np.abs(error) <= arrival_band, index, n), starts)
+    reached = arrived < ends
+    arrival = np.minimum(arrived, ends - 1)
+    ramp_time = np.where(reached, t[arrival] - t[starts], np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ramp_rate = np.where(reached & (ramp_time > 0), (block[arrival] - start_temp) / ramp_time, np.nan)
+
+    #samples after arrival (the hold)
+    holding = index >= np.where(reached, arrived, ends)[segment]
+    hold_count = np.add.reduceat(holding.astype(np.int64), starts)
+    excess = np.where(holding, error * direction[segment], -np.inf)
+    overshoot = np.where(reached, np.maximum(np.maximum.reduceat(excess, starts), 0.0), np.nan)
+    hold_sum = np.add.reduceat(np.where(holding, block, 0.0), starts)
+    hold_squares = np.add.reduceat(np.where(holding, block * block, 0.0), starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hold_mean = np.where(hold_count > 0, hold_sum / hold_count, np.nan)
+        hold_var = np.maximum(hold_squares / hold_count - hold_mean * hold_mean, 0.0)
+    hold_std = np.where(hold_count > 1, np.sqrt(hold_var), np.nan)
+    hold_time = np.where(reached, t[ends - 1] - t[arrival], 0.0)
+
+    #settling: the sample after the last one outside the band
+    last_out = np.maximum.reduceat(np.where(np.abs(error) > settle_band, index, -1), starts)
+    settled = np.where(last_out < 0, starts, last_out + 1)
+    settling_time = np.where(settled < ends, t[np.minimum(settled, n - 1)] - t[starts], np.nan)
+
+    sensor_diff = np.abs(trace['block_1'] - trace['block_2'])
+    lengths = ends - starts
+    diff_mean = np.add.reduceat(sensor_diff, starts) / lengths
+    diff_max = np.maximum.reduceat(sensor_diff, starts)
+
+    #cycles: numbered from each denaturation (highest target) step
+    active = seg_target > 0
+    denaturation = active & (seg_target >= seg_target[active].max(initial=0) - CYCLE_TOLERANCE)
+    cycle = np.cumsum(denaturation)
+
+    steps = np.zeros(int(active.sum()), dtype=STEP_DTYPE)
+    steps['cycle'] = cycle[active]
+    steps['start'] = t[starts][active]
+    steps['duration'] = (np.r_[t[starts[1:]], t[-1]] - t[starts])[active]
+    steps['target'] = seg_target[active]
+    steps['start_temp'] = start_temp[active]
+    steps['ramp_time'] = ramp_time[active]
+    steps['ramp_rate'] = ramp_rate[active]
+    steps['overshoot'] = overshoot[active]
+    steps['settling_time'] = settling_time[active]
+    steps['hold_time'] = hold_time[active]
+    steps['hold_mean'] = hold_mean[active]
+    steps['hold_std'] = hold_std[active]
+    steps['hold_error'] = hold_mean[active] - seg_target[active]
+    steps['sensor_diff_mean'] = diff_mean[active]
+    steps['sensor_diff_max'] = diff_max[active]
+    return RunAnalysis(steps, float(t[-1] - t[0]))
+
+
+def analyze_log(path):
+    from sd_log import read_log
+    return analyze(trace_from_log(read_log(path)))
+
+
+def write_steps(steps, out):
+    writer = csv.writer(out)
+    writer.writerow(STEP_DTYPE.names)
+    for row in steps.tolist():
+        writer.writerow([f"{value:.3f}" if isinstance(value, float) else value for value in row])
+
+
+def format_report(analysis, show_steps=False):
+    lines = []
+    if show_steps:
+        lines.append(f"{'cyc':>3} {'start':>7} {'target':>6} {'from':>6} {'ramp s':>7} {'C/s':>6} {'over':>5} "
+                     f"{'settle':>6} {'hold s':>6} {'mean':>6} {'std':>5} {'sens':>5}")
+        for step in analysis.steps:
+            lines.append(f"{step['cycle']:3d} {step['start']:7.0f} {step['target']:6.1f} {step['start_temp']:6.1f} "
+                         f"{step['ramp_time']:7.1f} {step['ramp_rate']:6.2f} {step['overshoot']:5.2f} "
+                         f"{step['settling_time']:6.1f} {step['hold_time']:6.0f} {step['hold_mean']:6.2f} "
+                         f"{step['hold_std']:5.2f} {step['sensor_diff_max']:5.2f}")
+        lines.append("")
+    lines.append(f"{'cycle':>5} {'start':>7} {'length':>7} {'heat C/s':>8} {'cool C/s':>8} {'overshoot':>9} {'hold err':>8}")
+    for row in analysis.cycle_table():
+        lines.append(f"{row['cycle']:5d} {row['start']:7.0f} {row['duration']:7.0f} {row['heat_rate']:8.2f} "
+                     f"{row['cool_rate']:8.2f} {row['max_overshoot']:9.2f} {row['max_hold_error']:8.2f}")
+    summary = analysis.summary()
+    lines.append("")
+    lines.append(f"{summary['duration']:.0f} s, {summary['cycles']} cycles, {summary['steps']} steps "
+                 f"({summary['unreached']} never reached their target)")
+    lines.append(f"ramp {summary['heat_rate']:.2f} C/s up, {summary['cool_rate']:.2f} C/s down, "
+                 f"overshoot up to {summary['max_overshoot']:.2f} C, settling {summary['mean_settling']:.1f} s on average")
+    lines.append(f"hold std {summary['mean_hold_std']:.2f} C on average, error up to {summary['max_hold_error']:.2f} C, "
+                 f"sensors up to {summary['max_sensor_diff']:.2f} C apart")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ramp, overshoot, settling and hold metrics of a PCR run.")
+    parser.add_argument('log', help="SD card log (CSV)")
+    parser.add_argument('--steps', action='store_true', help="list every step")
+    parser.add_argument('--csv', help="write the step table to this file ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    analysis = analyze_log(args.log)
+    if args.csv == '-':
+        write_steps(analysis.steps, sys.stdout)
+        return
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            write_steps(analysis.steps, f)
+    print(format_report(analysis, args.steps))
+
+
+if __name__ == "__main__":
+    main()
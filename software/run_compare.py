@@ -0,0 +1,500 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import zipfile
+
+import numpy as np
+
+from lod_history import LOD_FACTOR, POINTS_PER_PIXEL
+from metrics import Histogram
+from run_analysis import analyze, trace_from_log, trace_from_telemetry
+from sd_log import find_logs, read_log
+from session_recorder import SessionReader, SESSION_SUFFIX
+
+#overlay of many runs of the same protocol, e.g. today's run against the archive to spot a heater
+#that gets slower over the months
+#every log (SD card CSV or recorded .tcs session) is decoded once into the columns of a run_analysis
+#trace and kept in CACHE_DIR as a .npz named after the hash of the file content (a renamed or
+#downloaded-again copy is a hit, an edited one a miss), the least recently used entries are removed
+#once the cache grows past CACHE_MAX_BYTES
+#runs are aligned by protocol step, not by wall clock: a step starts where the block target changes
+#(steps with a target of 0 are left out, as in run_analysis.py), step k of every run starts at the same
+#x and its slot is as long as the longest step k, so the ramps and holds of a step are drawn on top
+#of each other whatever the previous steps took
+#each run keeps a min-max pyramid of its aligned samples (buckets of LOD_FACTOR**k samples that never
+#straddle two steps) and a redraw asks every run for at most POINTS_PER_PIXEL points per pixel of the
+#visible range, 50 runs redraw in a few tens of ms at any zoom
+#  python run_compare.py ../Example_logs --highlight today.CSV --out compare.png
+#  python run_compare.py archive/ --bench
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.thermocycler', 'run_cache')
+CACHE_MAX_BYTES = 256 * 1024 * 1024  # the least recently used runs are evicted past this
+CACHE_VERSION = 2  # part of the cache key, bump when the stored columns change
+HASH_CHUNK = 1 << 20  # bytes hashed per read
+HASH_INDEX = 'hashes.json'  # known hashes of the files seen, in CACHE_DIR
+TRACE_COLUMNS = ('time', 'target', 'block', 'block_1', 'block_2', 'cap')
+COMPARE_CHANNELS = ('block', 'cap', 'target')  # channels kept in the pyramid of a run
+BENCH_REDRAWS = 20  # redraws timed by --bench
+
+
+#content hash of a file (hex), the cache key of its run
+def file_hash(path):
+    digest = hashlib.sha256(b'run %d\n' % CACHE_VERSION)  # sha256 is hardware accelerated on most CPUs
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_CHUNK)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()[:32]
+
+
+#trace columns of an SD card log or a recorded session, decoded from scratch
+def decode_run(path):
+    if path.endswith(SESSION_SUFFIX):
+        with SessionReader(path) as reader:
+            trace = trace_from_telemetry(reader.frames())
+    else:
+        trace = trace_from_log(read_log(path))
+    #temperatures are read in 0.25 degree steps, float32 holds them exactly at half the size
+    return {name: trace[name] if name == 'time' else trace[name].astype(np.float32) for name in TRACE_COLUMNS}
+
+
+#decoded runs on disk, keyed by file content
+#the hash of a file is remembered with its size and mtime in HASH_INDEX so an unchanged file is not
+#read again (hashing a long session takes longer than loading its run)
+class RunCache:
+
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0, 'hash_ms': 0.0, 'load_ms': 0.0, 'decode_ms': 0.0}
+        self._hashes = None  # abspath -> [size, mtime_ns, hash]
+        self._hashes_changed = False
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    #cache key of a file, hashed again only if its size or mtime changed
+    def key(self, path):
+        if self._hashes is None:
+            try:
+                with open(os.path.join(self.directory, HASH_INDEX), encoding='utf-8') as f:
+                    self._hashes = json.load(f)
+            except (OSError, ValueError):
+                self._hashes = {}
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        known = self._hashes.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return known[2]
+        key = file_hash(path)
+        self._hashes[path] = [stat.st_size, stat.st_mtime_ns, key]
+        self._hashes_changed = True
+        return key
+
+    #write the remembered hashes (of the files that still exist)
+    def save(self):
+        if not self._hashes_changed:
+            return
+        hashes = {path: known for path, known in self._hashes.items() if os.path.exists(path)}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            index = os.path.join(self.directory, HASH_INDEX)
+            with open(index + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(hashes, f)
+            os.replace(index + '.tmp', index)
+            self._hashes_changed = False
+        except OSError as e:
+            print(f"Run cache: {HASH_INDEX} not written: {e}")
+
+    #trace columns of `path`, decoded and stored if it is not cached yet
+    def load(self, path):
+        stats = self.stats
+        start = time.perf_counter()
+        entry = self.entry_path(self.key(path))
+        loaded = time.perf_counter()
+        stats['hash_ms'] += (loaded - start) * 1000
+        try:
+            with np.load(entry) as data:
+                trace = {name: data[name] for name in TRACE_COLUMNS}
+            os.utime(entry)  # most recently used
+            stats['hits'] += 1
+            stats['load_ms'] += (time.perf_counter() - loaded) * 1000
+            return trace
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass
+
+        trace = decode_run(path)
+        stats['misses'] += 1
+        stats['decode_ms'] += (time.perf_counter() - loaded) * 1000
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp = entry + '.tmp.npz'
+            np.savez(temp, **trace)
+            os.replace(temp, entry)
+        except OSError as e:
+            print(f"Run cache: {entry} not written: {e}")
+        return trace
+
+    #(path, size, last use) of the entries, least recently used first
+    def entries(self):
+        try:
+            names = [name for name in os.listdir(self.directory) if name.endswith('.npz')]
+        except OSError:
+            return []
+        found = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((path, stat.st_size, stat.st_mtime))
+        return sorted(found, key=lambda entry: entry[2])
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    #remove the least recently used entries until the cache fits in max_bytes
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.stats['evicted'] += 1
+        return total
+
+    def clear(self):
+        for path, _, _ in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+#one run cut into its active steps, x is set by align()
+class Run:
+
+    def __init__(self, name, trace, path=None):
+        self.name = name
+        self.path = path
+        self.trace = trace
+        time_ = trace['time']
+        target = trace['target']
+        n = len(target)
+        change = np.ones(n, dtype=bool)
+        change[1:] = target[1:] != target[:-1]
+        starts = np.flatnonzero(change)
+        ends = np.append(starts[1:], n)
+        active = target[starts] > 0 if n else np.zeros(0, dtype=bool)
+
+        #a step lasts until the first sample of the next one (the last step until the end of the trace)
+        end_times = time_[np.minimum(ends, n - 1)] if n else np.zeros(0)
+        self.step_starts = starts[active]
+        self.step_targets = target[self.step_starts].astype(np.float64)
+        self.step_durations = (end_times - time_[starts])[active] if n else np.zeros(0)
+
+        #active step of every sample, -1 outside of them
+        step_of_segment = np.full(len(starts), -1)
+        step_of_segment[active] = np.arange(int(active.sum()))
+        step = step_of_segment[np.cumsum(change) - 1] if n else np.zeros(0, dtype=np.intp)
+        self._samples = np.flatnonzero(step >= 0)
+        self.step = step[self._samples]
+        self.x = None
+        self.levels = []
+        self.mismatched = 0  # steps whose target differs from the reference run's
+
+    def __len__(self):
+        return len(self.step_starts)
+
+    @property
+    def duration(self):
+        return float(self.trace['time'][-1]) if len(self.trace['time']) else 0.0
+
+    #place the samples of step k at slots[k] + time since the start of the step and build the pyramid
+    def align(self, slots):
+        time_ = self.trace['time']
+        samples = self._samples
+        step_start_times = time_[self.step_starts]
+        self.x = slots[self.step] + (time_[samples] - step_start_times[self.step])
+        values = np.stack([self.trace[name][samples] for name in COMPARE_CHANNELS], axis=1).astype(np.float64)
+        self.levels = _pyramid(self.x, self.step, values)
+
+    #(x, {channel: y}) of [start, end] with at most max_points points, NaN between two steps
+    def query(self, start, end, max_points):
+        for level, (first, last, step, mins, maxs, min_at, max_at) in enumerate(self.levels):
+            lo = max(int(np.searchsorted(last, start, 'left')) - 1, 0)
+            hi = min(int(np.searchsorted(first, end, 'right')) + 1, len(first))
+            points = hi - lo if level == 0 else POINTS_PER_PIXEL * (hi - lo)
+            if points <= max_points or level == len(self.levels) - 1:
+                break
+        sl = slice(lo, hi)
+        step = step[sl]
+        if level == 0:
+            x = first[sl]
+            y = mins[sl]
+            breaks = np.flatnonzero(step[1:] != step[:-1]) + 1
+        else:
+            #two points per bucket: (first x, min or max), (last x, the other one)
+            x = np.stack((first[sl], last[sl]), axis=1).ravel()
+            min_first = (min_at[sl] <= max_at[sl])
+            y = np.stack((np.where(min_first, mins[sl], maxs[sl]), np.where(min_first, maxs[sl], mins[sl])),
+                         axis=1).reshape(len(x), -1)
+            breaks = 2 * (np.flatnonzero(step[1:] != step[:-1]) + 1)
+        if len(breaks):
+            x = np.insert(x, breaks, np.nan)
+            y = np.insert(y, breaks, np.nan, axis=0)
+        return x, {name: y[:, i] for i, name in enumerate(COMPARE_CHANNELS)}
+
+
+#min-max levels of aligned samples: level 0 is the samples, level k+1 merges LOD_FACTOR buckets of
+#level k that belong to the same step, until a level has one bucket per step
+#a level is (first x, last x, step, mins, maxs, sample index of the min, of the max) per bucket
+def _pyramid(x, step, values):
+    index = np.repeat(np.arange(len(x))[:, None], values.shape[1], axis=1)
+    level = (x, x, step, values, values, index, index)
+    levels = [level]
+    while len(level[0]) > 1:
+        first, last, step, mins, maxs, min_at, max_at = level
+        n = len(first)
+        new_step = np.ones(n, dtype=bool)
+        new_step[1:] = step[1:] != step[:-1]
+        position = np.arange(n)
+        rank = position - np.maximum.accumulate(np.where(new_step, position, 0))
+        starts = np.flatnonzero(rank % LOD_FACTOR == 0)
+        if len(starts) == n:
+            break
+        bucket = np.cumsum(rank % LOD_FACTOR == 0) - 1
+        ends = np.append(starts[1:], n) - 1
+        new_mins = np.fmin.reduceat(mins, starts, axis=0)
+        new_maxs = np.fmax.reduceat(maxs, starts, axis=0)
+        level = (first[starts], last[ends], step[starts], new_mins, new_maxs,
+                 _first_at(mins, new_mins, min_at, bucket, starts), _first_at(maxs, new_maxs, max_at, bucket, starts))
+        levels.append(level)
+    return levels
+
+
+#sample index of the first child of every bucket that holds the bucket's extreme
+def _first_at(values, extremes, at, bucket, starts):
+    missing = np.iinfo(np.int64).max
+    found = np.minimum.reduceat(np.where(values == extremes[bucket], at, missing), starts, axis=0)
+    return np.where(found == missing, at[starts], found)  # all NaN
+
+
+#align runs by step: returns the start and width of the slot of every step
+#the first run is the reference, the steps of the others with another target are counted in `mismatched`
+def align(runs):
+    count = max((len(run) for run in runs), default=0)
+    widths = np.zeros(count)
+    for run in runs:
+        widths[:len(run)] = np.maximum(widths[:len(run)], run.step_durations)
+    slots = np.concatenate(([0.0], np.cumsum(widths)[:-1])) if count else widths
+    reference = runs[0].step_targets if runs else np.zeros(0)
+    for run in runs:
+        n = min(len(run), len(reference))
+        run.mismatched = int(np.count_nonzero(run.step_targets[:n] != reference[:n]))
+        run.align(slots)
+    return slots, widths
+
+
+#runs of the given files through `cache` (decoded every time without one, e.g. a session still recording),
+#the cache is trimmed to its size afterwards
+def load_runs(paths, cache=None):
+    runs = []
+    for path in paths:
+        trace = cache.load(path) if cache is not None else decode_run(path)
+        runs.append(Run(os.path.basename(path), trace, path))
+    if cache is not None:
+        cache.save()
+        cache.evict()
+    return runs
+
+
+#median ramp time per step target: [(target, highlight s, archive s, change %)]
+#a heater losing power shows as longer heating ramps than in the archive
+def compare_ramps(highlight, archive):
+    def medians(runs):
+        result = {}
+        for run in runs:
+            steps = analyze(run.trace).steps
+            for target in np.unique(steps['target']):
+                ramps = steps['ramp_time'][steps['target'] == target]
+                result.setdefault(float(target), []).extend(ramps[~np.isnan(ramps)])
+        return {target: float(np.median(ramps)) for target, ramps in result.items() if ramps}
+
+    mine = medians([highlight])
+    theirs = medians(archive)
+    rows = []
+    for target in sorted(set(mine) & set(theirs)):
+        change = (mine[target] - theirs[target]) / theirs[target] * 100 if theirs[target] else float('nan')
+        rows.append((target, mine[target], theirs[target], change))
+    return rows
+
+
+#overlay of aligned runs on a matplotlib axes: the archive in thin lines colored from oldest to newest,
+#the highlighted run on top, the reference targets dashed
+#the lines are decimated again for the visible range whenever the x limits change (zoom, pan)
+class CompareView:
+
+    def __init__(self, ax, runs, highlight=None, channel='block', colormap='viridis'):
+        self.ax = ax
+        self.runs = list(runs)
+        self.highlight = highlight
+        self.channel = channel
+        self.stats = {'redraws': 0, 'points': 0, 'last_query_ms': 0.0}
+        self.query_time = Histogram()  # ms to decimate every run for a redraw
+
+        #the highlighted run is the reference of the step targets
+        ordered = ([highlight] if highlight is not None else []) + self.runs
+        self.slots, self.widths = align(ordered)
+        self.extent = float(self.slots[-1] + self.widths[-1]) if len(self.slots) else 1.0
+
+        import matplotlib
+        colors = matplotlib.colormaps[colormap](np.linspace(0, 0.9, max(len(self.runs), 1)))
+        self.lines = [ax.plot([], [], color=color, linewidth=0.8, alpha=0.6)[0]
+                      for color in colors[:len(self.runs)]]
+        self.highlight_line = None
+        if highlight is not None:
+            self.highlight_line = ax.plot([], [], color='red', linewidth=1.6, zorder=3, label=highlight.name)[0]
+
+        reference = ordered[0] if ordered else None
+        if reference is not None and len(reference):
+            n = len(reference)
+            ax.plot(np.repeat(self.slots[:n], 2) + np.tile([0, 1], n) * np.repeat(self.widths[:n], 2),
+                    np.repeat(reference.step_targets, 2), color='black', linestyle='--', linewidth=0.8,
+                    label="target")
+
+        ax.set_title(f"{len(self.runs)} runs aligned by protocol step")
+        ax.set_xlabel("Protocol time, steps aligned (s)")
+        ax.set_ylabel("Temperature (°C)")
+        ax.set_xlim(0, self.extent)
+        low, high = self._ylim(ordered)
+        ax.set_ylim(low, high)
+        if highlight is not None:
+            ax.legend(loc='lower right')
+        self.render()
+        ax.callbacks.connect('xlim_changed', lambda ax: self.render())
+
+    #range of the channel over all runs (their coarsest level) with a margin
+    def _ylim(self, runs):
+        column = COMPARE_CHANNELS.index(self.channel)
+        values = np.concatenate([np.zeros(0)] + [level[i][:, column] for level in (run.levels[-1] for run in runs)
+                                                 for i in (3, 4)])
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return 0, 120
+        return values.min() - 5, values.max() + 5
+
+    #set the decimated data of every line for the current x range (drawn by the next canvas draw)
+    def render(self):
+        start = time.perf_counter()
+        low, high = self.ax.get_xlim()
+        max_points = max(int(self.ax.bbox.width * POINTS_PER_PIXEL), 2)
+        points = 0
+        pairs = list(zip(self.lines, self.runs))
+        if self.highlight_line is not None:
+            pairs.append((self.highlight_line, self.highlight))
+        for line, run in pairs:
+            x, channels = run.query(low, high, max_points)
+            line.set_data(x, channels[self.channel])
+            points += len(x)
+        elapsed = (time.perf_counter() - start) * 1000
+        stats = self.stats
+        stats['redraws'] += 1
+        stats['points'] = points
+        stats['last_query_ms'] = elapsed
+        self.query_time.record(elapsed)
+
+
+#time full redraws (decimation + Agg draw) of a view at zoom levels from the whole run to a few steps
+def bench(view, canvas, redraws=BENCH_REDRAWS):
+    draw_time = Histogram()
+    rng = np.random.default_rng(0)
+    extent = view.extent
+    for i in range(redraws):
+        width = extent / 4 ** (i % 4)
+        low = rng.uniform(0, extent - width) if width < extent else 0.0
+        start = time.perf_counter()
+        view.ax.set_xlim(low, low + width)
+        canvas.draw()
+        draw_time.record((time.perf_counter() - start) * 1000)
+    return draw_time.summary()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Overlay many runs of a protocol aligned by step.")
+    parser.add_argument('logs', nargs='*', help="SD logs, .tcs sessions, directories or glob patterns (the archive)")
+    parser.add_argument('--highlight', help="run drawn on top (default: the most recent file)")
+    parser.add_argument('--channel', choices=('block', 'cap'), default='block')
+    parser.add_argument('--out', help="save the plot to this image instead of showing it")
+    parser.add_argument('--bench', action='store_true', help="time redraws at several zoom levels")
+    parser.add_argument('--no-cache', action='store_true', help="decode every log again")
+    parser.add_argument('--cache-size', type=float, default=CACHE_MAX_BYTES / 1024 / 1024, help="MB (default %(default)d)")
+    parser.add_argument('--clear-cache', action='store_true')
+    args = parser.parse_args(argv)
+
+    cache = None if args.no_cache else RunCache(max_bytes=int(args.cache_size * 1024 * 1024))
+    if args.clear_cache and cache is not None:
+        cache.clear()
+        if not args.logs:
+            return
+
+    paths = find_logs(args.logs) + find_logs([path for path in args.logs if os.path.isdir(path)], '*' + SESSION_SUFFIX)
+    if args.highlight is None and paths:
+        args.highlight = max(paths, key=os.path.getmtime)
+    archive = [path for path in paths if args.highlight is None or os.path.abspath(path) != os.path.abspath(args.highlight)]
+    if not archive and args.highlight is None:
+        parser.error("no logs found")
+
+    start = time.perf_counter()
+    runs = load_runs(archive, cache)
+    highlight = load_runs([args.highlight], cache)[0] if args.highlight else None
+    elapsed = time.perf_counter() - start
+    if cache is not None:
+        stats = cache.stats
+        print(f"{len(runs) + (highlight is not None)} runs loaded in {elapsed * 1000:.0f} ms: {stats['hits']} cached "
+              f"({stats['load_ms']:.0f} ms), {stats['misses']} decoded ({stats['decode_ms']:.0f} ms), "
+              f"hashing {stats['hash_ms']:.0f} ms, cache {cache.size() / 1024 / 1024:.1f} MB"
+              + (f", {stats['evicted']} evicted" if stats['evicted'] else ""))
+    else:
+        print(f"{len(runs) + (highlight is not None)} runs decoded in {elapsed * 1000:.0f} ms")
+
+    import matplotlib
+    if args.out or args.bench:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(15, 6))
+    view = CompareView(ax, runs, highlight, args.channel)
+
+    for run in ([highlight] if highlight is not None else []) + runs:
+        note = f", {run.mismatched} steps with another target" if run.mismatched else ""
+        print(f"  {run.name}: {len(run)} steps, {run.duration / 60:.1f} min{note}")
+    if highlight is not None and runs:
+        print(f"median ramp time, {highlight.name} vs the {len(runs)} other runs:")
+        for target, mine, theirs, change in compare_ramps(highlight, runs):
+            print(f"  {target:6.1f} C {mine:7.1f} s {theirs:7.1f} s {change:+6.1f} %")
+
+    if args.bench:
+        summary = bench(view, fig.canvas)
+        print(f"redraw of {len(runs) + (highlight is not None)} runs: avg {summary['avg']:.1f} ms, "
+              f"p90 {summary['p90']:.1f} ms, max {summary['max']:.1f} ms, last {view.stats['points']} points "
+              f"(decimation {view.stats['last_query_ms']:.1f} ms)")
+    if args.out:
+        ax.set_xlim(0, view.extent)
+        fig.savefig(args.out, dpi=100)
+        print(f"saved to {args.out}")
+    elif not args.bench:
+        plt.show()
+
+
+if __name__ == "__main__":
+    main()
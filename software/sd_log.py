@@ -0,0 +1,284 @@
+import argparse
+import csv
+import glob
+import io
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+#SD card logs written by Thermocycler.ino (logToSD), one row per sensor read
+#logs are streamed in fixed-size byte chunks and parsed with NumPy only (no per-row Python objects):
+#the lines of a chunk are classified with vectorized byte masks, the valid ones are parsed together
+#by NumPy's C reader (np.loadtxt), so a multi-hour log never has to fit in memory as text
+#the header, "AZ_5 ACTIVATED, REASON: ..." lines (kept as events) and a last line cut by a power loss
+#are skipped
+#  python sd_log.py summary ../Example_logs --csv summary.csv
+
+#column name -> dtype
+LOG_COLUMNS = {
+    'millis': np.int64,
+    'block_temp_1': np.float32,
+    'block_temp_2': np.float32,
+    'block_temp_mean': np.float32,
+    'temp_cap': np.float32,
+    'block_gradient': np.float32,
+    'cap_gradient': np.float32,
+    'l_btn': np.uint8,
+    'r_btn': np.uint8,
+    'H70_pwm': np.uint8,
+    'H50_pwm': np.uint8,
+    'H_CAP_pwm': np.uint8,
+    'H70_act': np.uint8,
+    'H50_act': np.uint8,
+    'H_CAP_act': np.uint8,
+    'FAN_act': np.uint8,
+    'AZ_5': np.uint8,
+    'target_temp_block': np.float32,
+    'target_temp_cap': np.float32,
+    'heat_act': np.uint8,
+}
+COLUMN_COUNT = len(LOG_COLUMNS)
+HEADER_PREFIX = b'millis,'
+
+CHUNK_BYTES = 1 << 20  # bytes read per chunk (about 12000 rows)
+LOG_PATTERN = '*.CSV'  # the firmware names its logs in upper case
+
+_NEWLINE = ord('\n')
+_COMMA = ord(',')
+_CR = ord('\r')
+
+
+def _empty_columns():
+    return {name: np.empty(0, dtype=dtype) for name, dtype in LOG_COLUMNS.items()}
+
+
+def _typed(values):
+    return {name: values[:, i].astype(dtype) for i, (name, dtype) in enumerate(LOG_COLUMNS.items())}
+
+
+#rows of a log as typed column chunks, the counters are complete once the iteration is over
+#`path` is a file or an iterable of bytes blocks (e.g. SDTransfer.blocks() of sd_transfer.py)
+#  bytes      bytes read
+#  rows       parsed data rows
+#  skipped    malformed lines (wrong field count or unparsable values)
+#  headers    header lines (one per firmware boot)
+#  events     (millis of the previous row, text) of the non-data lines, e.g. AZ_5 reasons
+#  event_rows data rows before each event (millis repeat across boots, the row count does not)
+#  truncated  True if the file ends in the middle of a line
+class LogStream:
+
+    def __init__(self, path, chunk_bytes=CHUNK_BYTES):
+        self.path = path
+        self.chunk_bytes = chunk_bytes
+        self.bytes = 0
+        self.rows = 0
+        self.skipped = 0
+        self.headers = 0
+        self.events = []
+        self.event_rows = []
+        self.truncated = False
+        self._last_millis = None
+
+    def __iter__(self):
+        rest = b''
+        for block in self._blocks():
+            self.bytes += len(block)
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            if end:
+                chunk = self._parse(block[:end])
+                if chunk is not None:
+                    yield chunk
+        #a complete row without its line break is still a row, anything else was cut by a power loss
+        if rest.strip():
+            chunk = self._parse(rest + b'\n', last=True)
+            if chunk is not None:
+                yield chunk
+
+    def _blocks(self):
+        if not isinstance(self.path, (str, bytes, os.PathLike)):
+            yield from self.path
+            return
+        with open(self.path, 'rb') as f:
+            while True:
+                block = f.read(self.chunk_bytes)
+                if not block:
+                    break
+                yield block
+
+    #parse complete lines (the block ends with a line break)
+    def _parse(self, block, last=False):
+        buf = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(buf == _NEWLINE)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        commas = np.concatenate(([0], np.cumsum(buf == _COMMA)))
+        fields = commas[ends] - commas[starts] + 1
+        first = buf[np.minimum(starts, len(buf) - 1)]
+        numeric = (ends > starts) & (first >= ord('0')) & (first <= ord('9'))
+        valid = numeric & (fields == COLUMN_COUNT)
+
+        if last:
+            if not valid.all() or buf[ends[-1] - 1 - (buf[ends[-1] - 1] == _CR)] == _COMMA:
+                self.truncated = True
+                return None
+
+        values = None
+        count = int(valid.sum())
+        if count:
+            if count == len(ends):
+                text = buf
+            else:
+                line = np.concatenate(([0], np.cumsum(buf == _NEWLINE)[:-1]))
+                text = buf[valid[line]]
+            try:
+                values = np.loadtxt(io.BytesIO(text.tobytes()), delimiter=',', dtype=np.float64, ndmin=2)
+            except ValueError:
+                pass
+            if values is None or values.size != count * COLUMN_COUNT:
+                values = self._parse_lines(block, starts, ends, valid)
+            values = values.reshape(-1, COLUMN_COUNT)
+
+        #rows before each line, to date the events
+        before = np.cumsum(valid) - valid
+        for i in np.flatnonzero(~valid):
+            millis = int(values[before[i] - 1, 0]) if before[i] else self._last_millis
+            self._other_line(block[starts[i]:ends[i]], numeric[i], millis, self.rows + int(before[i]))
+
+        if values is None or not len(values):
+            return None
+        self.rows += len(values)
+        self._last_millis = int(values[-1, 0])
+        return _typed(values)
+
+    #slow path for a chunk with a damaged line (empty field, "ovf"...): parse its lines one by one,
+    #the damaged ones are dropped from `valid` (and counted as skipped with the other invalid lines)
+    def _parse_lines(self, block, starts, ends, valid):
+        rows = []
+        for i in np.flatnonzero(valid):
+            try:
+                rows.append(np.array(block[starts[i]:ends[i]].split(b','), dtype=np.float64))
+            except ValueError:
+                valid[i] = False
+        return np.array(rows).reshape(-1, COLUMN_COUNT)
+
+    def _other_line(self, line, numeric, millis, row):
+        line = line.rstrip(b'\r')
+        if not line:
+            return
+        if line.startswith(HEADER_PREFIX):
+            self.headers += 1
+        elif numeric:
+            self.skipped += 1
+        else:
+            self.events.append((millis, line.decode('ascii', 'replace')))
+            self.event_rows.append(row)
+
+
+#iterate over a log in typed column chunks
+def iter_log(path, chunk_bytes=CHUNK_BYTES):
+    return iter(LogStream(path, chunk_bytes))
+
+
+#read a whole log into typed columns
+def read_log(path, chunk_bytes=CHUNK_BYTES):
+    chunks = list(LogStream(path, chunk_bytes))
+    if not chunks:
+        return _empty_columns()
+    return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in LOG_COLUMNS}
+
+
+SUMMARY_FIELDS = ['file', 'bytes', 'rows', 'skipped', 'truncated', 'boots', 'duration_s', 'heating_s',
+                  'max_block', 'max_cap', 'max_sensor_diff', 'target_changes', 'az5', 'events', 'error']
+
+
+#one line of the summary table, computed while streaming (a log is never loaded whole),
+#`path` can also be an iterable of bytes blocks, `name` is then shown as its file
+def summarize_log(path, chunk_bytes=CHUNK_BYTES, name=None):
+    summary = dict.fromkeys(SUMMARY_FIELDS, '')
+    summary.update(file=name or path, duration_s=0.0, heating_s=0.0, target_changes=0, az5=False)
+    try:
+        stream = LogStream(path, chunk_bytes)
+        max_block = max_cap = max_diff = -np.inf
+        previous_millis = previous_target = None
+        for chunk in stream:
+            millis = chunk['millis']
+            dt = np.diff(millis, prepend=millis[0] if previous_millis is None else previous_millis) / 1000
+            dt[dt < 0] = 0  # millis restart at every boot
+            summary['duration_s'] += float(dt.sum())
+            summary['heating_s'] += float(dt[chunk['heat_act'] == 1].sum())
+            max_block = max(max_block, float(np.nanmax(chunk['block_temp_mean'], initial=-np.inf)))
+            max_cap = max(max_cap, float(np.nanmax(chunk['temp_cap'], initial=-np.inf)))
+            diff = np.abs(chunk['block_temp_1'] - chunk['block_temp_2'])
+            max_diff = max(max_diff, float(np.nanmax(diff, initial=-np.inf)))
+            target = chunk['target_temp_block']
+            previous = target[0] if previous_target is None else previous_target
+            summary['target_changes'] += int(np.count_nonzero(np.diff(target, prepend=previous)))
+            summary['az5'] = summary['az5'] or bool(chunk['AZ_5'].any())
+            previous_millis = millis[-1]
+            previous_target = target[-1]
+        summary.update(bytes=stream.bytes, rows=stream.rows, skipped=stream.skipped, truncated=stream.truncated,
+                       boots=stream.headers, events="; ".join(text for _, text in stream.events))
+        summary['az5'] = summary['az5'] or any(text.startswith('AZ_5') for _, text in stream.events)
+        for key, value in (('max_block', max_block), ('max_cap', max_cap), ('max_sensor_diff', max_diff)):
+            summary[key] = round(value, 2) if np.isfinite(value) else ''
+        summary['duration_s'] = round(summary['duration_s'], 1)
+        summary['heating_s'] = round(summary['heating_s'], 1)
+    except OSError as e:
+        summary['error'] = str(e)
+    return summary
+
+
+#log files of directories and/or files, sorted
+def find_logs(paths, pattern=LOG_PATTERN):
+    found = set()
+    for path in paths:
+        if os.path.isdir(path):
+            found.update(glob.glob(os.path.join(path, '**', pattern), recursive=True))
+        else:
+            found.update(glob.glob(path))
+    return sorted(found)
+
+
+#summarize many logs across a process pool (in this process if there is only one log or worker)
+def summarize_logs(paths, workers=None, chunk_bytes=CHUNK_BYTES):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(paths) <= 1:
+        return [summarize_log(path, chunk_bytes) for path in paths]
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        return list(pool.map(summarize_log, paths, [chunk_bytes] * len(paths),
+                             chunksize=max(1, len(paths) // (workers * 4))))
+
+
+def write_summary(summaries, out):
+    writer = csv.DictWriter(out, fieldnames=SUMMARY_FIELDS)
+    writer.writeheader()
+    writer.writerows(summaries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Read firmware SD card logs.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    summary = sub.add_parser('summary', help="one line per log: duration, temperatures, AZ_5 events...")
+    summary.add_argument('paths', nargs='+', help="log files, glob patterns or directories (searched recursively)")
+    summary.add_argument('--pattern', default=LOG_PATTERN, help="file pattern inside directories")
+    summary.add_argument('--workers', type=int, help="worker processes (default: one per CPU)")
+    summary.add_argument('--csv', help="write the table to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    paths = find_logs(args.paths, args.pattern)
+    if not paths:
+        parser.error("no log files found")
+    summaries = summarize_logs(paths, args.workers)
+    if args.csv:
+        with open(args.csv, 'w', newline='', encoding='utf-8') as f:
+            write_summary(summaries, f)
+        print(f"{len(summaries)} logs summarized to {args.csv}")
+    else:
+        write_summary(summaries, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
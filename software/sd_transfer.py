@@ -0,0 +1,198 @@
+import os
+import queue
+import threading
+import time
+
+from binary_frame import (FRAME_SD_ENTRY, FRAME_SD_DATA, FRAME_SD_END, SD_OFFSET_STRUCT, SD_END_STRUCT,
+                          SD_OK, SD_NO_CARD, SD_NOT_FOUND, SD_BUSY, SD_BAD_REQUEST)
+from instrument import BAUD_RATE
+
+#SD card files offloaded over the serial link ("sd_list" and "sd_read" commands of Thermocycler.ino)
+#a file is read in chunks: the firmware sends a chunk as CRC-checked binary data frames, each with its
+#file offset, and ends it with an end frame (next offset, file size), a frame dropped for a bad CRC
+#shows up as a gap in the offsets and the next chunk is asked from the last good offset
+#the firmware loop (telemetry, control, SD logging) waits while a chunk is sent, so transfers are
+#refused while heating and chunks stay short (8 KB take 0.75 s at 115200 baud)
+#the frames are queued by the I/O thread and handled by the caller, one chunk at most is held in memory:
+#  transfer = SDTransfer(instrument)
+#  transfer.list_files()                                 [(name, size), ...]
+#  transfer.download('10171130.CSV', 'logs/10171130.CSV')  resumes from logs/10171130.CSV.part
+#  LogStream(transfer.blocks('10171130.CSV'))              parse the log while it arrives (sd_log.py)
+
+CHUNK_SIZE = 8192  # bytes asked per sd_read
+CHUNK_RETRIES = 5  # chunks in a row without progress before a transfer is given up
+READY_TIMEOUT = 15  # s to wait for the firmware loop (its first telemetry frame) after the handshake
+REPLY_TIMEOUT = 3  # s allowed for a reply besides its time on the wire
+LINK_RATE = BAUD_RATE / 10  # bytes/s on the wire (8N1)
+PART_SUFFIX = '.part'
+
+SD_ERRORS = {
+    SD_NO_CARD: "no SD card",
+    SD_NOT_FOUND: "not found on the SD card",
+    SD_BUSY: "the thermocycler is heating, transfers wait for the end of the run",
+    SD_BAD_REQUEST: "bad request",
+}
+
+_UNSUPPORTED = -1  # reply kind of an "Unrecognized variable: sd_..." line (firmware without SD transfer)
+
+
+class SDTransferError(OSError):
+    pass
+
+
+class SDTransfer:
+
+    def __init__(self, instrument, chunk_size=CHUNK_SIZE):
+        self.instrument = instrument
+        self.chunk_size = chunk_size
+        self.size = None  # size of the file being read, once known
+        self.stats = {'requests': 0, 'frames': 0, 'bytes': 0, 'gaps': 0, 'retries': 0}
+
+        self._replies = queue.Queue()
+        self._lock = threading.Lock()  # one request at a time
+        self._ready = threading.Event()
+        if instrument.last_frame:
+            self._ready.set()
+        instrument.add_frame_hook(self._frame)
+        instrument.add_console_hook(self._console)
+        for frame_type in (FRAME_SD_ENTRY, FRAME_SD_DATA, FRAME_SD_END):
+            instrument.add_binary_hook(frame_type, self._binary)
+
+    def close(self):
+        instrument = self.instrument
+        instrument.remove_frame_hook(self._frame)
+        instrument.remove_console_hook(self._console)
+        for frame_type in (FRAME_SD_ENTRY, FRAME_SD_DATA, FRAME_SD_END):
+            instrument.remove_binary_hook(frame_type)
+
+    #True once the firmware loop runs (it only reads commands after its boot splash)
+    def wait_ready(self, timeout=READY_TIMEOUT):
+        return self._ready.wait(timeout)
+
+    #[(name, size)] of the files in `directory` of the card
+    def list_files(self, directory='/'):
+        with self._lock:
+            for _ in range(CHUNK_RETRIES):
+                self._request(f"sd_list={directory}")
+                files = []
+                while True:
+                    reply = self._next(time.monotonic() + REPLY_TIMEOUT)
+                    if reply is None:
+                        break
+                    kind, payload = reply
+                    if kind == FRAME_SD_ENTRY:
+                        size, = SD_OFFSET_STRUCT.unpack_from(payload)
+                        files.append((payload[SD_OFFSET_STRUCT.size:].decode('ascii', 'replace'), size))
+                    elif kind == FRAME_SD_END:
+                        status, count, _ = SD_END_STRUCT.unpack(payload)
+                        self._check(status, directory)
+                        if count == len(files):
+                            return files
+                        break
+                self.stats['retries'] += 1
+            raise SDTransferError(f"no complete listing of {directory} from the thermocycler")
+
+    #verified bytes of a file from `offset` on, one chunk at a time (size is set once the first chunk is in)
+    def blocks(self, name, offset=0):
+        self.size = None
+        failures = 0
+        while self.size is None or offset < self.size:
+            with self._lock:
+                data, next_offset, size = self._read_chunk(name, offset)
+            if size is not None:
+                self.size = size
+            if data:
+                failures = 0
+                offset = next_offset
+                yield data
+            elif self.size is None or offset < self.size:
+                failures += 1
+                self.stats['retries'] += 1
+                if failures > CHUNK_RETRIES:
+                    raise SDTransferError(f"{name}: no progress at offset {offset}")
+
+    #copy a file of the card to `path` through `path`.part (kept to resume if the transfer is interrupted),
+    #`progress(offset, size)` is called after each chunk, returns the size of the file
+    def download(self, name, path, progress=None):
+        part = path + PART_SUFFIX
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        with open(part, 'ab') as f:
+            for block in self.blocks(name, offset):
+                f.write(block)
+                offset += len(block)
+                if progress:
+                    progress(offset, self.size)
+        os.replace(part, path)
+        return offset
+
+    #one sd_read: (bytes received in order from `offset`, offset after them, file size or None if the
+    #end frame was not received)
+    def _read_chunk(self, name, offset):
+        self._request(f"sd_read={name},{offset},{self.chunk_size}")
+        stats = self.stats
+        parts = []
+        expected = offset
+        gap = False
+        deadline = time.monotonic() + self.chunk_size / LINK_RATE + REPLY_TIMEOUT
+        while True:
+            reply = self._next(deadline)
+            if reply is None:
+                return b''.join(parts), expected, None
+            kind, payload = reply
+            if kind == FRAME_SD_DATA:
+                stats['frames'] += 1
+                frame_offset, = SD_OFFSET_STRUCT.unpack_from(payload)
+                if frame_offset == expected and not gap:
+                    data = payload[SD_OFFSET_STRUCT.size:]
+                    parts.append(data)
+                    expected += len(data)
+                    stats['bytes'] += len(data)
+                elif frame_offset > expected and not gap:
+                    #a frame was lost, the rest of the chunk is asked again
+                    gap = True
+                    stats['gaps'] += 1
+            elif kind == FRAME_SD_END:
+                status, _, size = SD_END_STRUCT.unpack(payload)
+                self._check(status, name)
+                return b''.join(parts), expected, size
+
+    def _request(self, command):
+        if not self.wait_ready():
+            raise SDTransferError("no telemetry from the thermocycler")
+        #late frames of an abandoned request
+        while not self._replies.empty():
+            self._replies.get_nowait()
+        self.stats['requests'] += 1
+        self.instrument.send(command)
+
+    def _next(self, deadline):
+        try:
+            kind, payload = self._replies.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            return None
+        if kind == _UNSUPPORTED:
+            raise SDTransferError("the firmware has no SD transfer (update Thermocycler.ino)")
+        return kind, payload
+
+    def _check(self, status, name):
+        if status != SD_OK:
+            raise SDTransferError(f"{name}: {SD_ERRORS.get(status, f'error {status}')}")
+
+    def _frame(self, frame, rx_time):
+        if not self._ready.is_set():
+            self._ready.set()
+
+    def _console(self, text, tag):
+        if "Unrecognized variable: sd_" in text:
+            self._replies.put((_UNSUPPORTED, text))
+
+    def _binary(self, frame_type, payload, rx_time):
+        self._replies.put((frame_type, payload))
+
+
+def format_size(size):
+    if size is None:
+        return "?"
+    if size < 1024:
+        return f"{size} B"
+    return f"{size / 1024:.1f} KB" if size < 1024 * 1024 else f"{size / 1024 / 1024:.1f} MB"
@@ -1,230 +1,144 @@
-import serial
-import serial.tools.list_ports
-import threading
+import argparse
 import time
-import tkinter as tk
-from tkinter import scrolledtext
-import json
-import math
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
-from PIL import Image, ImageTk
+
+from lod_history import LodHistory
+from plot_renderer import PlotRenderer
+from ui_dispatch import UIDispatcher, BoundedConsole
+from variables_panel import PanelModel, PANEL_PRECISION
+from metrics import Metrics, SnapshotWriter, format_snapshot, SNAPSHOT_INTERVAL
+from instrument import Instrument, BAUD_RATE, DEVICE_HWID
+from discovery import Reconnector, wait_for_device
+from cycle_runner import CycleRunner
+from protocol import load_timeline, format_duration
+
+#GUI modules, imported by load_gui() when the Tk front end starts so the core can run headless
+tk = None
+scrolledtext = None
+FigureCanvasTkAgg = None
+Figure = None
+Image = None
+ImageTk = None
 
 # Serial config
 SERIAL_PORT = ''
-BAUD_RATE = 115200
-ACK_TIMEOUT = 2  # seconds to wait for ACK before retrying
-MAX_RETRIES = 3  # max number of retries per message
+DISCOVERY_TIMEOUT = 6  # s to find the device on its own before asking for the port
+CONNECT_TIMEOUT = 20  # s to wait for the device on a given port
+PIPELINED_COMMANDS = True  # set to False to force the stop-and-wait protocol of older firmware
+BINARY_TELEMETRY = True  # accept the compact binary telemetry frames if the firmware offers them
 sd_mode = True  # set to True for SD mode, False for normal mode
 
-message_queue = []
-message_lock = threading.Lock()
-awaiting_ack = False
-current_message = None
-ack_received_time = None
-retry_count = 0
-
 timestamps = True
 
+RECORD_SESSION = True  # save everything received and sent to ~/.thermocycler/sessions (session_recorder.py)
+PROTOCOL_FILE = None  # path of a protocol file (see protocols/), None for protocols/default.json
+THERMAL_MODEL = None  # device name of a thermal model fitted with thermal_fit.py, None for the protocol ramp rates
+
+TIMER_REFRESH = 100  # ms between elapsed/hold timer label updates
+PANEL_REFRESH = 200  # ms between live variables panel updates, only the labels whose text changed are touched
+STATS_REFRESH = 1000  # ms between updates of the performance stats window
+METRICS_FILE = None  # path for periodic performance snapshots (.csv, or JSON lines otherwise), None to disable
+METRICS_INTERVAL = SNAPSHOT_INTERVAL  # s between snapshots written to METRICS_FILE
+SERVER_PORT = None  # port of the local telemetry server (telemetry_server.py), None to disable
+SERVER_COMMANDS = False  # let the server's clients send commands (with the token shown in the console)
+PLOT_FPS = 10  # max graph redraws per second, samples arriving in between are coalesced
+UI_DISPATCH_INTERVAL = 50  # ms between UI queue drains
+CONSOLE_MAX_LINES = 5000  # oldest console lines are trimmed past this limit
+
 ui_labels = {}
+panel = PanelModel(PANEL_PRECISION)  # last value of every telemetry key, see variables_panel.py
+metrics = Metrics()  # hot-path counters and latency histograms, see metrics.py
+ui_dispatcher = None
+console = None
+instrument = None
+
+#telemetry history kept for the graph: the last HISTORY_CAPACITY samples as received, the whole run
+#as a min-max pyramid (lod_history.py)
+HISTORY_CAPACITY = 12000  # samples kept at full resolution
+PLOT_WINDOWS = [('Run', None), ('10 min', 600), ('1 min', 60)]  # graph view buttons (seconds shown)
+HISTORY_CHANNELS = [
+    'time',
+    'block_temperature',
+    'target_block_temp',
+    'cap_temperature',
+    'target_cap_temp',
+    'block_gradient',
+    'cap_gradient',
+    'redundant_temp',
+]
 
 graph_data = {
-    'time': [],
-    'block_temperature': [],
-    'target_block_temp': [],
-    'cap_temperature': [],
-    'target_cap_temp': [],
+    'history': LodHistory(HISTORY_CHANNELS, HISTORY_CAPACITY),
     'ax': None,
     'fig': None,
     'canvas': None,
-    'start_time': time.time()
+    'renderer': None,
+    'start_time': time.time(),
+    'clock': None,  # seconds shown on the time axis, time since start_time if None (a replay sets its own)
 }
 
-def handle_sync(message, sd_mode):
-    message = message.strip()
-    if message.lower() == "syn":
-        return "syn ack\n" if sd_mode else "syn ack no_sd\n"
-    if message.lower() == "ack tim":
-        return time.strftime("%m%d%H%M") + "\n"
-    return None
+def load_gui():
+    global tk, scrolledtext, FigureCanvasTkAgg, Figure, Image, ImageTk
 
-def update_graph(data_dict):
+    import tkinter
+    from tkinter import scrolledtext as tk_scrolledtext
+    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg as canvas_class
+    from matplotlib.figure import Figure as figure_class
+    from PIL import Image as pil_image, ImageTk as pil_imagetk
 
-    t = time.time() - graph_data['start_time']
-    graph_data['time'].append(t)
+    tk = tkinter
+    scrolledtext = tk_scrolledtext
+    FigureCanvasTkAgg = canvas_class
+    Figure = figure_class
+    Image = pil_image
+    ImageTk = pil_imagetk
 
-    # Append values, defaulting to the previous value or 0 if not present
-    for key in ['block_temperature', 'target_block_temp', 'cap_temperature', 'target_cap_temp']:
-        if key in data_dict:
-            graph_data[key].append(float(data_dict[key]))
-        else:
-            last_val = graph_data[key][-1] if graph_data[key] else 0
-            graph_data[key].append(last_val)
-
-    #limit max length of data
-    if len(graph_data['time']) > 12000:
-        for key in ['time', 'block_temperature', 'target_block_temp', 'cap_temperature', 'target_cap_temp']:
-            graph_data[key] = graph_data[key][-12000:]
-
-
-    # Update the graph
-    ax = graph_data['ax']
-    ax.clear()
-    ax.set_title("Temperature Over Time")
-    ax.set_xlabel("Time (s)")
-    ax.set_ylabel("Temperature (°C)")
+def update_graph(data_dict):
 
-    ax.plot(graph_data['time'], graph_data['block_temperature'], label='Block Temp', color='red')
-    ax.plot(graph_data['time'], graph_data['target_block_temp'], label='Block Target Temp', color='orange', linestyle='--')
-    ax.plot(graph_data['time'], graph_data['cap_temperature'], label='Cap Temp', color='blue')
-    ax.plot(graph_data['time'], graph_data['target_cap_temp'], label='Cap Target Temp', color='green', linestyle='--')
+    clock = graph_data['clock']
+    t = clock() if clock is not None else time.time() - graph_data['start_time']
 
-    ax.legend(loc='upper left')
-    ax.set_ylim(0, 120)
-    
-    graph_data['canvas'].draw()
+    # Append values, channels not present keep their previous value (0 at start)
+    history = graph_data['history']
+    history.append_dict(data_dict, time=t)
 
+    # Redraw is done by the renderer timer, so many samples result in a single draw
+    graph_data['renderer'].mark_dirty()
 
 
-def update_variables_panel(data_dict):
 
-    global arrived_at_temp_needed
+#runs on the Tk main loop for every telemetry frame
+def handle_frame(data_dict, rx_time):
+    panel.update(data_dict)
+    update_graph(data_dict)
+    instrument.engine.record_frame(rx_time)
 
-    #parse incoming data and update the UI
-    for key, value in data_dict.items():
-        if key in ui_labels:
-            ui_labels[key]['text'] = f"{key}: {value}"
-            if key == "temp_reached":
-                arrived_at_temp_needed = value
+#push the panel changes since the last refresh to the labels
+def update_variables_panel():
+    for key, text in panel.changes().items():
+        label = ui_labels.get(key)
+        if label is not None:
+            label['text'] = text
         else:
-            label = tk.Label(variables_frame, text=f"{key}: {value}", anchor='w', font=('Arial', 15))
+            label = tk.Label(variables_frame, text=text, anchor='w', font=('Arial', 15))
             label.pack(fill='x', padx=5)
             ui_labels[key] = label
+    root.after(PANEL_REFRESH, update_variables_panel)
 
-def read_from_serial(ser, output_text):
-    global awaiting_ack, current_message, ack_received_time, retry_count
-
-    while True:
-        if ser.in_waiting > 0:
-            incoming_data = ser.readline().decode('utf-8', errors='ignore').strip()
-
-            # Handle incoming messages
-            response = handle_sync(incoming_data, sd_mode) #check for sync message
-            
-            if response:
-                ser.write(response.encode('utf-8'))
-                output_text.config(state=tk.NORMAL)
-
-                #add a timestamp if enabled
-                if timestamps:
-                    output_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} > Sent: {response}")
-                else:
-                    output_text.insert(tk.END, f"Sent: {response}")
-                output_text.see(tk.END)
-                output_text.config(state=tk.DISABLED)
-
-            # Check for ACK message
-            if incoming_data.lower() == "ack" and awaiting_ack:
-                awaiting_ack = False
-                ack_received_time = time.time()
-                retry_count = 0
-                current_message = None
-                output_text.config(state=tk.NORMAL)
-                if timestamps:
-                    output_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} > ACK received\n", 'green')
-                else:
-                    output_text.insert(tk.END, "ACK received\n", 'green')
-                output_text.see(tk.END)
-                output_text.config(state=tk.DISABLED)
-
-            try:
-                # Attempt to parse incoming data as JSON
-                # If successful, update the variables panel and graph
-                data_dict = json.loads(incoming_data)
-                if isinstance(data_dict, dict):
-                    root.after(0, update_variables_panel, data_dict)
-                    root.after(0, update_graph, data_dict)
-            except json.JSONDecodeError:
-
-                # If JSON parsing fails, treat it as a regular string and display it
-                output_text.config(state=tk.NORMAL)
-                if timestamps:
-                    output_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} > {incoming_data}\n")
-                else:
-                    output_text.insert(tk.END, f"Received: {incoming_data}\n")
-                output_text.see(tk.END)
-                output_text.config(state=tk.DISABLED)
-
-                pass
-
-        # Handle outgoing messages with ACK verification
-        if not awaiting_ack:
-            #lock the message queue to prevent race conditions
-            with message_lock:
-                if message_queue:
-                    current_message = message_queue.pop(0)
-                    ser.write(current_message.encode('utf-8'))
-                    # Display the sent message in the output text area
-                    output_text.config(state=tk.NORMAL)
-                    if timestamps:
-                        output_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} > Sent: {current_message}")
-                    else:
-                        output_text.insert(tk.END, f"Sent: {current_message}")
-                    output_text.see(tk.END)
-                    output_text.config(state=tk.DISABLED)
-
-                    awaiting_ack = True
-                    ack_received_time = time.time()
-                    retry_count = 1
-        else: # handle waiting for ACK
-            # Waiting for ACK: check timeout
-            if time.time() - ack_received_time > ACK_TIMEOUT:
-                if retry_count < MAX_RETRIES:
-                    ser.write(current_message.encode('utf-8'))
-                    output_text.config(state=tk.NORMAL)
-                    if timestamps:
-                        output_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} > Retrying ({retry_count}): {current_message}", 'orange')
-                    else:
-                        output_text.insert(tk.END, f"Retrying ({retry_count}): {current_message}", 'orange')
-                    output_text.see(tk.END)
-                    output_text.config(state=tk.DISABLED)
-                    ack_received_time = time.time()
-                    retry_count += 1
-                else:
-                    # Max retries reached
-                    output_text.config(state=tk.NORMAL)
-                    if timestamps:
-                        output_text.insert(tk.END, f"{time.strftime('%H:%M:%S')} > Failed to send after {MAX_RETRIES} retries: {current_message}", 'red')
-                    else:
-                        output_text.insert(tk.END, f"Failed to send after {MAX_RETRIES} retries: {current_message}", 'red')
-                    output_text.see(tk.END)
-                    output_text.config(state=tk.DISABLED)
-                    awaiting_ack = False
-                    current_message = None
-                    retry_count = 0
-
-        time.sleep(0.1)
-
-
+#builds the cycle controls and connects them to a CycleRunner (the cycle runs on its own thread)
 def cycle_controller(output_frame):
-    
-    #messages to be sent at the start of the cycle
-    startup_messages = ["heat_act=true", "target_cap_temp=110"]
-    
-    #messages to be sent in the cycle
-    messages = ["target_block_temp=95", "target_block_temp=60", "target_block_temp=72"]
-    intervals = [30, 30, 45]  # Seconds for each message
-    arrived_at_temp = [True, True, True]  # Whether to wait for the target temperature
-    max_cycles = 5  # Number of cycles to run
-
-    cycle_thread = None
-    eta_thread = None
-    pause_flag = threading.Event()
-    stop_flag = threading.Event()
-    end_flag = threading.Event()
+
+    ramp_model = None
+    if THERMAL_MODEL:
+        from thermal_fit import load_model
+        ramp_model = load_model(THERMAL_MODEL)
+    runner = CycleRunner(instrument, load_timeline(PROTOCOL_FILE, ramp_model=ramp_model))
 
     # GUI Elements
-    eta_label = tk.Label(output_frame, text="Elapsed: 0.0s", font=('Arial', 12))
+    protocol_label = tk.Label(output_frame, text=f"Protocol: {runner.timeline.name}", font=('Arial', 12, 'bold'))
+    protocol_label.pack(pady=5)
+
+    eta_label = tk.Label(output_frame, text=f"Elapsed: 0.0s \nRemaining: ~{format_duration(runner.remaining())}",
+                         font=('Arial', 12))
     eta_label.pack(pady=5)
 
     time_label = tk.Label(output_frame, text="Timer: 0.0s \nNext in: 0.0s", font=('Arial', 12))
@@ -238,233 +152,65 @@ def cycle_controller(output_frame):
     next_message_label = tk.Label(output_frame, textvariable=next_message_var, font=('Arial', 12))
     next_message_label.pack(pady=5)
 
-    cycle_number_var = tk.StringVar(value=f"Cycle Number: 0 Out of {max_cycles}")
+    cycle_number_var = tk.StringVar(value=f"Cycle Number: 0 Out of {runner.timeline.cycles}")
     cycle_number_label = tk.Label(output_frame, textvariable=cycle_number_var, font=('Arial', 12))
     cycle_number_label.pack(pady=5)
 
     info_label = tk.Label(output_frame, text="Press 'Start' to begin the cycle.", font=('Arial', 12))
     info_label.pack(pady=5)
 
-    # Functions to update the UI
+    # Functions to update the UI (called from the cycle thread, so they go through the dispatcher)
+    #the clocks are read from the runner on the Tk side, the cycle thread only wakes up for the protocol
     def update_eta_display():
-        start_time = time.time()
-        while not stop_flag.is_set():
-            if cycle_thread and cycle_thread.is_alive():
-                elapsed = time.time() - start_time
-                eta_label.config(text=f"Elapsed: {elapsed:.1f}s")
-            else:
-                eta_label.config(text="Elapsed: 0.0s")
-            time.sleep(0.1)
-    
-    def update_timer_display(elapsed, remaining):
-        time_label.config(text=f"Timer: {elapsed:.1f}s \nNext in: {remaining:.1f}s")
+        remaining = runner.remaining()
+        finish = time.strftime('%H:%M', time.localtime(time.time() + remaining / runner.time_scale))
+        eta_label.config(text=f"Elapsed: {runner.elapsed():.1f}s \nRemaining: ~{format_duration(remaining)} (done at {finish})")
+        timer = runner.timer()
+        if timer is not None:
+            time_label.config(text=f"Timer: {timer[0]:.1f}s \nNext in: {timer[1]:.1f}s")
+        root.after(TIMER_REFRESH, update_eta_display)
 
     def update_last_message(msg):
-        last_message_var.set(f"Last Message Sent: {msg}")
+        ui_dispatcher.post(last_message_var.set, f"Last Message Sent: {msg}")
 
-    def update_cycle_number(num):
-        cycle_number_var.set(f"Cycle Number: {num} Out of {max_cycles}")
+    def update_cycle_number(num, cycles):
+        ui_dispatcher.post(cycle_number_var.set, f"Cycle Number: {num} Out of {cycles}")
 
     def update_next_message(msg):
-        next_message_var.set(f"Next Message: {msg}")
+        ui_dispatcher.post(next_message_var.set, f"Next Message: {msg}")
 
     def update_info_label(msg):
-        if end_flag.is_set():
-            msg += "\n\nEnding cycle set..."
-        info_label.config(text=msg)
-
-
-    # main cycle function
-    def cycle_messages():
-        i = 0
-
-        #send startup messages
-        for message in startup_messages:
-            send_message_cycle(message)
-            time.sleep(0.5) 
-            update_last_message(message)
-            update_next_message(messages[0])
-
-        while not stop_flag.is_set():
-            
-            current_interval = intervals[i % len(intervals)]
-
-            #check if the cycle should go to end conditions
-            if math.floor((i/len(messages)) + 1) >= max_cycles or end_flag.is_set():
-                
-                update_info_label("Ending... Final extension started.")
-                
-                #end hold message
-                send_message_cycle("target_block_temp=72")
-                
-                #pause interval (not optimal as it could be done in a function, but it works)
-                start_time = time.time()
-                paused_duration = 0
-                pause_start = None
-                current_interval = 10*60  # 10 minutes
-                
-                while True:
-                    if stop_flag.is_set():
-                        return
-
-                    if pause_flag.is_set():
-                        if pause_start is None:
-                            pause_start = time.time()
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        if pause_start is not None:
-                            paused_duration += time.time() - pause_start
-                            pause_start = None
-
-                    elapsed = time.time() - start_time - paused_duration
-                    remaining = max(0, current_interval - elapsed)
-                    update_timer_display(elapsed, remaining)
-
-                    if elapsed >= current_interval:
-                        break
-                    time.sleep(0.1)
-
-                #cool down
-                send_message_cycle("target_block_temp=0")
-                send_message_cycle("target_cap_temp=0")
-
-                update_info_label("Final extension completed. Cooling down.")
-
-                #pause for cooling
-                start_time = time.time()
-                paused_duration = 0
-                pause_start = None
-                current_interval = 2*60  # 10 minutes
-                
-                while True:
-                    if stop_flag.is_set():
-                        return
-
-                    if pause_flag.is_set():
-                        if pause_start is None:
-                            pause_start = time.time()
-                        time.sleep(0.1)
-                        continue
-                    else:
-                        if pause_start is not None:
-                            paused_duration += time.time() - pause_start
-                            pause_start = None
-
-                    elapsed = time.time() - start_time - paused_duration
-                    remaining = max(0, current_interval - elapsed)
-                    update_timer_display(elapsed, remaining)
-
-                    if elapsed >= current_interval:
-                        break
-                    time.sleep(0.1)
-                
-                #final message
-                send_message_cycle("heat_act=false")
-
-                stop_flag.set()
-
-                update_info_label("Cycle completed. Press 'Start' to begin again.")
-                return
-
-            #check next message
-            message = messages[i % len(messages)]
-
-            #send message
-            send_message_cycle(message)
-            time.sleep(1) #needed to allow the arduino program to recalculate the arrived_at_temp variable, if needed add to it
-            update_last_message(message)
-            update_next_message(messages[(i + 1) % len(messages)])
-
-            update_cycle_number(math.floor((i/len(messages)) + 1))
-
-            # if needed, wait for the target temperature to be reached
-            if arrived_at_temp[i % len(arrived_at_temp)]:
-                while not arrived_at_temp_needed:
-                    time.sleep(0.1)
-                    if pause_flag.is_set():
-                        update_info_label("Cycle paused. Press 'Resume' to continue.")
-                    else:
-                        update_info_label("Waiting for target temperature to be reached...")
-                    
-                    if stop_flag.is_set():
-                        return
-                    
-
-                
-                update_info_label("Holding at target temperature...")
-
-            #pause interval
-            start_time = time.time()
-            paused_duration = 0
-            pause_start = None
-
-            while True:
-                if stop_flag.is_set():
-                    return
-
-                if pause_flag.is_set():
-                    if pause_start is None:
-                        pause_start = time.time()
-                    time.sleep(0.1)
-                    continue
-                else:
-                    if pause_start is not None:
-                        paused_duration += time.time() - pause_start
-                        pause_start = None
-
-                elapsed = time.time() - start_time - paused_duration
-                remaining = max(0, current_interval - elapsed)
-                update_timer_display(elapsed, remaining)
-
-                if elapsed >= current_interval:
-                    break
-                time.sleep(0.1)
-
-            
-            
-            i += 1
+        ui_dispatcher.post(info_label.config, {'text': msg})
+
+    runner.on_last_message = update_last_message
+    runner.on_next_message = update_next_message
+    runner.on_cycle = update_cycle_number
+    runner.on_info = update_info_label
 
     #srart the cycle
     def start_cycle():
-        
-        nonlocal cycle_thread, eta_thread
-        if cycle_thread is None or not cycle_thread.is_alive():
-            stop_flag.clear()
-            pause_flag.clear()
-            end_flag.clear()
+        if runner.start():
             end_button.config(state=tk.NORMAL)
             stop_button.config(state=tk.NORMAL)
             start_button.config(state=tk.DISABLED)
             pause_button.config(state=tk.NORMAL)
-            eta_thread = threading.Thread(target=update_eta_display, daemon=True)
-            eta_thread.start()
-            cycle_thread = threading.Thread(target=cycle_messages, daemon=True)
-            cycle_thread.start()
 
     #stop the cycle
     def stop_cycle():
-        stop_flag.set()
-        pause_flag.clear()
-        end_flag.clear()
+        runner.stop()
         start_button.config(state=tk.NORMAL)
         pause_button.config(state=tk.DISABLED)
         stop_button.config(state=tk.DISABLED)
         end_button.config(state=tk.NORMAL)
-        update_info_label("Cycle stopped. Press 'Start' to begin again.")
+        runner.info("Cycle stopped. Press 'Start' to begin again.")
 
     #pause/resume the cycle
     def pause_cycle():
-        if pause_flag.is_set():
-            pause_flag.clear()
-            update_info_label("Holding at target temperature...")
-        else:
-            pause_flag.set()
-            update_info_label("Cycle paused. Press 'Resume' to continue.")
+        runner.toggle_pause()
 
     #end the cycle
     def end_cycle():
-        end_flag.set()
+        runner.end()
         end_button.config(state=tk.DISABLED)
 
 
@@ -479,24 +225,90 @@ def cycle_controller(output_frame):
     stop_button.pack(side=tk.LEFT, padx=5)
     end_button.pack(side=tk.LEFT, padx=5)
 
-#add messages to the queue
-def send_message_cycle(entry):
-
-    msg = entry.strip()
-
-    with message_lock:
-        message_queue.append(msg + "\n")  # Add newline to simulate proper format
+    update_eta_display()
+    return runner
 
 #add written message to the queue
 def send_message(entry):
     msg = entry.get().strip()
     if msg:
-        with message_lock:
-            message_queue.append(msg + "\n")  # Add newline to simulate proper format
+        instrument.send(msg)
         entry.delete(0, tk.END)
 
-def main(ser):
-    global root, variables_frame
+#register the metrics of the GUI side (the instrument registers its own)
+def add_gui_metrics(dispatcher, renderer):
+    metrics.add_stats('ui', dispatcher.stats, rates=('calls',))
+    metrics.add_gauge('ui.queued', dispatcher.pending)
+    metrics.add_histogram('ui_lag_ms', dispatcher.lag)
+    metrics.add_histogram('ui_batch_ms', dispatcher.batch_time)
+    metrics.add_stats('panel', panel.stats, rates=('changes',))
+    metrics.add_stats('plot', renderer.stats)
+    metrics.add_histogram('draw_ms', renderer.draw_time)
+
+#window with every metric, refreshed while it is open
+def show_stats_window():
+    window = tk.Toplevel(root)
+    window.title("Performance stats")
+    text = tk.Text(window, width=110, height=24, font=('Courier', 9), wrap=tk.WORD)
+    text.pack(fill='both', expand=True)
+    reader = metrics.reader()
+
+    def refresh():
+        if not window.winfo_exists():
+            return
+        text.config(state=tk.NORMAL)
+        text.delete('1.0', tk.END)
+        text.insert(tk.END, format_snapshot(reader.snapshot()))
+        text.config(state=tk.DISABLED)
+        window.after(STATS_REFRESH, refresh)
+
+    refresh()
+
+#overlay archived runs (SD logs or sessions chosen in a dialog) aligned by step with the session being
+#recorded on top (run_compare.py), the archive is decoded through the run cache
+def show_compare_window():
+    from tkinter import filedialog
+    from matplotlib.backends.backend_tkagg import NavigationToolbar2Tk
+    from run_compare import RunCache, CompareView, load_runs
+
+    paths = filedialog.askopenfilenames(parent=root, title="Runs to compare",
+                                        filetypes=[("SD logs and sessions", "*.CSV *.csv *.tcs"), ("All files", "*")])
+    if not paths:
+        return
+    runs = load_runs(paths, RunCache())
+    highlight = None
+    recorder = instrument.recorder
+    if recorder is not None:
+        #the session changes as it is recorded, it is decoded without the cache
+        recorder.flush()
+        highlight = load_runs([recorder.path])[0]
+        if not len(highlight):
+            highlight = None
+
+    window = tk.Toplevel(root)
+    window.title("Run comparison")
+    fig = Figure(figsize=(12, 5), dpi=100)
+    ax = fig.add_subplot(111)
+    canvas = FigureCanvasTkAgg(fig, master=window)
+    NavigationToolbar2Tk(canvas, window)
+    canvas.get_tk_widget().pack(fill='both', expand=True)
+    CompareView(ax, runs, highlight)
+    canvas.draw()
+
+#show link throughput and latency once a second
+def update_link_stats(link_label):
+    rates = instrument.engine.rates()
+    link_label.config(text=f"Link: {rates['frames_per_s']:.1f} frames/s, {rates['lines_per_s']:.1f} lines/s, "
+                           f"{rates['bytes_per_s']:.0f} B/s | latency avg {rates['latency_avg_ms']:.1f} ms, "
+                           f"max {rates['latency_max_ms']:.1f} ms")
+    root.after(1000, update_link_stats, link_label)
+
+#`received`: bytes already read from the port by discovery, with `reconnect` the port is reopened
+#as soon as it comes back after being lost
+def main(ser, received=b'', reconnect=False):
+    global root, variables_frame, ui_dispatcher, console, instrument
+
+    load_gui()
 
     #create tkinter elements
     root = tk.Tk()
@@ -521,6 +333,23 @@ def main(ser):
     output_text.pack(padx=10, pady=10, fill='both', expand=True)
     output_text.pack_propagate(False)
     output_text.config(state=tk.DISABLED)
+    for color in ('green', 'orange', 'red'):
+        output_text.tag_config(color, foreground=color)
+
+    #all UI updates coming from other threads are handed over through the dispatcher
+    ui_dispatcher = UIDispatcher(root, interval_ms=UI_DISPATCH_INTERVAL)
+    console = BoundedConsole(output_text, ui_dispatcher, max_lines=CONSOLE_MAX_LINES)
+    ui_dispatcher.start()
+
+    instrument = Instrument(ser, sd_mode=sd_mode, pipelined=PIPELINED_COMMANDS, binary=BINARY_TELEMETRY,
+                            timestamps=timestamps, on_console=console.write,
+                            on_frame=lambda frame, rx_time: ui_dispatcher.post(handle_frame, frame, rx_time))
+    if RECORD_SESSION:
+        console.write(f"Recording session to {instrument.record().path}\n", None)
+    reconnector = None
+    if reconnect:
+        reconnector = Reconnector(instrument, DEVICE_HWID, BAUD_RATE, paths=[ser.port]).start()
+        instrument.on_error = lambda error: reconnector.connection_lost()
 
     variables_frame = tk.Frame(main_frame, bd=2, relief='sunken', padx=10)
     variables_frame.pack(side='right', fill='y', padx=5, pady=5)
@@ -528,6 +357,7 @@ def main(ser):
     variables_frame.config(width=300, height=650)
 
     tk.Label(variables_frame, text="Live Variables", font=('Arial', 12, 'bold')).pack()
+    update_variables_panel()
 
     entry_frame = tk.Frame(root)
     entry_frame.pack(padx=10, pady=5)
@@ -539,6 +369,15 @@ def main(ser):
     send_button = tk.Button(entry_frame, text="Send", command=lambda: send_message(entry))
     send_button.pack(side=tk.LEFT)
 
+    link_label = tk.Label(entry_frame, text="Link: -", font=('Arial', 10), fg='gray')
+    link_label.pack(side=tk.LEFT, padx=(15, 0))
+    tk.Button(entry_frame, text="Stats", command=show_stats_window).pack(side=tk.LEFT, padx=(5, 0))
+    tk.Button(entry_frame, text="Compare", command=show_compare_window).pack(side=tk.LEFT, padx=(5, 0))
+
+    tk.Label(entry_frame, text="Graph:", font=('Arial', 10)).pack(side=tk.LEFT, padx=(15, 0))
+    for text, window in PLOT_WINDOWS:
+        tk.Button(entry_frame, text=text, command=lambda w=window: graph_data['renderer'].set_window(w)).pack(side=tk.LEFT)
+
     # Create graph frame
     graph_frame = tk.Frame(root, bd=2, relief='sunken')
     graph_frame.pack(side='bottom', fill='y', padx=5, pady=5, expand=True)
@@ -546,72 +385,111 @@ def main(ser):
 
     fig = Figure(figsize=(15, 2), dpi=100)
     ax = fig.add_subplot(111)
-    ax.set_title("Temperature Over Time")
-    ax.set_xlabel("Time (s)")
-    ax.set_ylabel("Temperature (°C)")
 
     canvas = FigureCanvasTkAgg(fig, master=graph_frame)
-    canvas.draw()
     canvas.get_tk_widget().pack(fill='both', expand=True)
 
+    renderer = PlotRenderer(fig, ax, canvas, graph_data['history'], fps=PLOT_FPS)
+    renderer.start()
+
     # Store plot elements in global state
     graph_data['ax'] = ax
     graph_data['fig'] = fig
     graph_data['canvas'] = canvas
+    graph_data['renderer'] = renderer
 
-    thread = threading.Thread(target=read_from_serial, args=(ser, output_text), daemon=True)
-    thread.start()
-    thread2 = threading.Thread(target=cycle_controller, args=(side_control_frame,), daemon=True)
-    thread2.start()
+    instrument.add_metrics(metrics)
+    add_gui_metrics(ui_dispatcher, renderer)
+    snapshots = SnapshotWriter(metrics, METRICS_FILE, METRICS_INTERVAL).start() if METRICS_FILE else None
+    server = None
+    if SERVER_PORT is not None:
+        from telemetry_server import TelemetryServer
+        server = TelemetryServer(instrument, port=SERVER_PORT, commands=SERVER_COMMANDS).start()
+        metrics.add_stats('server', server.hub.stats)
+        console.write(f"Telemetry server on {server.url}"
+                      + (f", commands token {server.token}" if server.commands else "") + "\n", None)
+
+    cycle_controller(side_control_frame)
+
+    instrument.start(received=received)
+    update_link_stats(link_label)
 
     root.mainloop()
 
+    if snapshots is not None:
+        snapshots.stop()
+    if server is not None:
+        server.stop()
+    if reconnector is not None:
+        reconnector.stop()
+
+    if instrument.recorder is not None:
+        instrument.recorder.close()
+
+#ask the user for a port when the device is not found
+def select_port_dialog():
+    load_gui()
+    import tkinter.simpledialog
+    import tkinter.messagebox
+    import serial.tools.list_ports
+
+    root = tk.Tk()
+    root.title("Select Serial Port")
+    root.withdraw()  # Hide the main window
+
+    port_list = [port.device for port in serial.tools.list_ports.comports()]
+    if not port_list:
+        tkinter.messagebox.showerror("No Ports Found", "No serial ports detected. Please connect your device and restart the program.")
+        exit(1)
+
+    selected_port = tkinter.simpledialog.askstring(
+        "Select Serial Port",
+        "Available ports:\n" + "\n".join(port_list) + "\n\nEnter port name (e.g., COM3):",
+        initialvalue=port_list[0]
+    )
+    if not selected_port or selected_port not in port_list:
+        tkinter.messagebox.showerror("Invalid Selection", "No valid port selected. Exiting.")
+        exit(1)
+    root.destroy()
+    return selected_port
+
 if __name__ == "__main__":
-    
-    timeout = time.time() + 20
-    while True:
-        
-        ports = serial.tools.list_ports.comports()
-
-        for port in ports:
-            if port.hwid == "USB VID:PID=2341:1002 SER=F412FA9C9F1C":
-                SERIAL_PORT = port.device
-                print(f"Found device on {SERIAL_PORT}")
-                break
-        try:
-            ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-            print(f"Connected to {SERIAL_PORT}")
-            break
-        except serial.SerialException:
-            if time.time() > timeout:
-                print(f"Failed to connect to {SERIAL_PORT} after 5 seconds.")
-                exit(1)
-            time.sleep(0.5)
-            
-        # If no port was found, prompt the user to select one
-        if SERIAL_PORT is None or not any(port.device == SERIAL_PORT for port in ports):
-            import tkinter.simpledialog
-            import tkinter.messagebox
-
-            root = tk.Tk()
-            root.title("Select Serial Port")
-            root.withdraw()  # Hide the main window
-
-            port_list = [port.device for port in ports]
-            if not port_list:
-                tkinter.messagebox.showerror("No Ports Found", "No serial ports detected. Please connect your device and restart the program.")
-                exit(1) 
-
-            selected_port = tkinter.simpledialog.askstring(
-                "Select Serial Port",
-                "Available ports:\n" + "\n".join(port_list) + "\n\nEnter port name (e.g., COM3):",
-                initialvalue=port_list[0]
-            )
-            if selected_port and selected_port in port_list:
-                SERIAL_PORT = selected_port
-            else:
-                tkinter.messagebox.showerror("Invalid Selection", "No valid port selected. Exiting.")
-                exit(1)
-            root.destroy()
-    
-    main(ser)
+
+    parser = argparse.ArgumentParser(description="Thermocycler serial communicator")
+    #a port can be given on the command line (e.g. a virtual thermocycler from thermocycler_sim.py)
+    parser.add_argument('port', nargs='?', help="serial port, the device is looked for on every port if not given")
+    parser.add_argument('--replay', metavar='FILE', help="play a recorded session (.tcs) or SD card log instead")
+    parser.add_argument('--speed', default='1', help="replay speed-up factor or 'max' (default 1)")
+    parser.add_argument('--binary', action='store_true', help="replay the frames in the binary format")
+    parser.add_argument('--metrics', metavar='FILE', help="append performance snapshots to FILE (.csv or JSON lines)")
+    parser.add_argument('--serve', metavar='PORT', type=int, help="serve the telemetry to local clients on PORT (telemetry_server.py)")
+    parser.add_argument('--allow-commands', action='store_true', help="let the server's clients send commands")
+    args = parser.parse_args()
+    METRICS_FILE = args.metrics or METRICS_FILE
+    SERVER_PORT = args.serve if args.serve is not None else SERVER_PORT
+    SERVER_COMMANDS = args.allow_commands or SERVER_COMMANDS
+
+    if args.replay:
+        from replay import ReplaySerial, open_source, parse_speed, format_summary
+
+        ser = ReplaySerial(open_source(args.replay, binary=args.binary), parse_speed(args.speed),
+                           consumed=lambda: instrument.engine.stats['frames'], port=f"replay:{args.replay}")
+        graph_data['clock'] = ser.clock
+        RECORD_SESSION = False
+        print(f"Replaying {args.replay}")
+        main(ser)
+        print(format_summary(ser.summary()))
+        exit(0)
+
+    #the given port, else the last port of the device, else every candidate port at once (discovery.py)
+    probe = wait_for_device(DEVICE_HWID, args.port, BAUD_RATE, timeout=CONNECT_TIMEOUT if args.port else DISCOVERY_TIMEOUT)
+    if probe is None and not args.port:
+        # If no port answered, prompt the user to select one
+        SERIAL_PORT = select_port_dialog()
+        probe = wait_for_device(DEVICE_HWID, SERIAL_PORT, BAUD_RATE, timeout=CONNECT_TIMEOUT)
+    if probe is None:
+        print(f"Failed to connect to {args.port or SERIAL_PORT or DEVICE_HWID} after {CONNECT_TIMEOUT} seconds.")
+        exit(1)
+    print(f"Connected to {probe.port} in {probe.elapsed * 1000:.0f} ms")
+
+    main(probe.ser, probe.received, reconnect=True)
@@ -0,0 +1,318 @@
+import os
+import selectors
+import threading
+import time
+
+import serial
+
+from binary_frame import SYNC, HEADER_SIZE, CRC_SIZE, frame_crc
+from metrics import Histogram
+
+
+#dedicated serial I/O thread
+#reads block until data arrives (or `read_timeout` passes), every complete line
+#received in a wakeup is handed to `on_line(line, rx_time)` right away and
+#`on_wakeup(now)` is called after each wakeup so timeouts can be serviced without polling,
+#writes go straight to the port from the calling thread
+#binary frames (see binary_frame.py) mixed in the stream are checked and handed to
+#`on_binary(frame_type, payload, rx_time)`, text never contains the 0xA5 sync byte
+class SerialEngine:
+
+    def __init__(self, ser, on_line, on_wakeup=None, on_error=None, on_binary=None, read_timeout=0.02, max_line=4096):
+        self.ser = ser
+        self.on_line = on_line
+        self.on_binary = on_binary
+        self.on_wakeup = on_wakeup
+        self.on_error = on_error
+        self.read_timeout = read_timeout
+        self.max_line = max_line
+
+        self._write_lock = threading.Lock()
+        self._running = threading.Event()
+        self._thread = None
+        self._mux = None
+        self._buffer = bytearray()
+
+        self.stats = {
+            'wakeups': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'lines': 0,
+            'binary_frames': 0,
+            'crc_errors': 0,
+            'split_lines': 0,  # text lines a binary frame was sent in the middle of
+            'frames': 0,
+            'latency_sum_ms': 0.0,
+            'latency_max_ms': 0.0,
+        }
+        self.latency = Histogram()  # ms from reception to record_frame
+        self.wakeup_bytes = Histogram()  # bytes per read wakeup
+        self._rate_last = (time.monotonic(), dict(self.stats))
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self.ser.timeout = self.read_timeout
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name="serial-engine", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=1):
+        self._running.clear()
+        if self._mux is not None:
+            self._mux.remove(self)
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def is_running(self):
+        return self._running.is_set()
+
+    #use another (reopened) port, the engine must be stopped
+    def set_port(self, ser):
+        self.ser = ser
+        self._buffer.clear()
+
+    #safe to call from any thread, the data is written immediately
+    def write(self, text):
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        with self._write_lock:
+            self.ser.write(data)
+        self.stats['bytes_out'] += len(data)
+
+    #called by the consumer once a frame has been handled, rx_time is the one passed to on_line
+    def record_frame(self, rx_time):
+        latency = (time.monotonic() - rx_time) * 1000
+        stats = self.stats
+        stats['frames'] += 1
+        stats['latency_sum_ms'] += latency
+        if latency > stats['latency_max_ms']:
+            stats['latency_max_ms'] = latency
+        self.latency.record(latency)
+
+    #rates since the previous call
+    def rates(self):
+        now = time.monotonic()
+        last_time, last = self._rate_last
+        stats = dict(self.stats)
+        dt = max(now - last_time, 1e-6)
+        frames = stats['frames'] - last['frames']
+        result = {
+            'wakeups_per_s': (stats['wakeups'] - last['wakeups']) / dt,
+            'bytes_per_s': (stats['bytes_in'] - last['bytes_in']) / dt,
+            'lines_per_s': (stats['lines'] - last['lines']) / dt,
+            'frames_per_s': frames / dt,
+            'latency_avg_ms': (stats['latency_sum_ms'] - last['latency_sum_ms']) / frames if frames else 0.0,
+            'latency_max_ms': stats['latency_max_ms'],
+        }
+        self.stats['latency_max_ms'] = 0.0
+        stats['latency_max_ms'] = 0.0
+        self._rate_last = (now, stats)
+        return result
+
+    #process bytes read from the port (by the engine thread or a SerialMultiplexer)
+    def feed(self, data, now):
+        self.stats['wakeups'] += 1
+        if data:
+            self.stats['bytes_in'] += len(data)
+            self.wakeup_bytes.record(len(data))
+            buffer = self._buffer
+            buffer += data
+            self._split(buffer, now)
+
+            #drop runaway partial lines (noise on the link)
+            if len(buffer) > self.max_line:
+                buffer.clear()
+
+    def _fail(self, error):
+        self._running.clear()
+        if self.on_error:
+            self.on_error(error)
+
+    def _run(self):
+        ser = self.ser
+
+        while self._running.is_set():
+            try:
+                data = ser.read(1)
+                if data:
+                    waiting = ser.in_waiting
+                    if waiting:
+                        data += ser.read(waiting)
+            except (serial.SerialException, OSError, TypeError) as e:
+                #TypeError is raised by pyserial when the port is closed under a blocking read
+                self._fail(e)
+                break
+
+            now = time.monotonic()
+            self.feed(data, now)
+
+            if self.on_wakeup:
+                self.on_wakeup(now)
+
+    #hand every complete line and binary frame in the buffer to the callbacks, keep the incomplete tail
+    #a frame sent in the middle of a text line is cut out of it, the text before the frame is kept
+    #and completed by the bytes that follow it
+    def _split(self, buffer, now):
+        stats = self.stats
+        start = 0
+        sync = buffer.find(SYNC)
+        while True:
+            newline = buffer.find(b'\n', start)
+
+            if sync >= 0 and (newline < 0 or sync < newline):
+                body_start = sync + len(SYNC)
+                if len(buffer) < sync + HEADER_SIZE:
+                    break
+                end = sync + HEADER_SIZE + buffer[body_start + 1] + CRC_SIZE
+                if len(buffer) < end:
+                    break
+                body = bytes(buffer[body_start:end - CRC_SIZE])
+                if frame_crc(body) == buffer[end - 2] | (buffer[end - 1] << 8):
+                    stats['binary_frames'] += 1
+                    if self.on_binary:
+                        self.on_binary(body[0], body[2:], now)
+                    if start == sync:
+                        start = end
+                    else:
+                        del buffer[sync:end]
+                        stats['split_lines'] += 1
+                        end = sync
+                else:
+                    #corrupted frame or false sync: resync right after this sync byte
+                    stats['crc_errors'] += 1
+                    end = sync + 1
+                    if start == sync:
+                        start = end
+                sync = buffer.find(SYNC, end)
+                continue
+
+            if newline < 0:
+                break
+            line = buffer[start:newline].decode('utf-8', errors='ignore').strip()
+            start = newline + 1
+            stats['lines'] += 1
+            self.on_line(line, now)
+
+        del buffer[:start]
+
+
+#one I/O thread for many serial engines (POSIX only, serial ports are selectable file descriptors there)
+#ports are read without blocking when the selector reports data, `on_wakeup` of every engine is
+#called after each wakeup and at least every `tick` seconds so ACK timeouts are still serviced
+class SerialMultiplexer:
+
+    def __init__(self, tick=0.05):
+        self.tick = tick
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._engines = {}  # engine -> file descriptor
+        self._changes = []
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._running = threading.Event()
+        self._thread = None
+
+    #multiplexing needs real file descriptors (not available on Windows)
+    @staticmethod
+    def supported():
+        return os.name == 'posix'
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name="serial-mux", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=1):
+        self._running.clear()
+        self._wake()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    #start serving an engine instead of its own thread
+    def add(self, engine):
+        engine.ser.timeout = 0
+        engine._mux = self
+        engine._running.set()
+        with self._lock:
+            self._changes.append((True, engine))
+        self._wake()
+
+    def remove(self, engine):
+        engine._mux = None
+        with self._lock:
+            self._changes.append((False, engine))
+        self._wake()
+
+    def __len__(self):
+        return len(self._engines)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    #registrations are only changed on the I/O thread, between two select calls
+    def _apply_changes(self):
+        with self._lock:
+            changes, self._changes = self._changes, []
+        for add, engine in changes:
+            if add and engine not in self._engines:
+                try:
+                    fd = engine.ser.fileno()
+                except (serial.SerialException, OSError) as e:
+                    engine._mux = None
+                    engine._fail(e)
+                    continue
+                self._engines[engine] = fd
+                self._selector.register(fd, selectors.EVENT_READ, engine)
+            elif not add and engine in self._engines:
+                self._unregister(engine)
+
+    def _unregister(self, engine):
+        fd = self._engines.pop(engine)
+        try:
+            self._selector.unregister(fd)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _drop(self, engine, error):
+        self._unregister(engine)
+        engine._mux = None
+        engine._fail(error)
+
+    def _run(self):
+        while self._running.is_set():
+            self._apply_changes()
+            events = self._selector.select(self.tick)
+            now = time.monotonic()
+
+            for key, _ in events:
+                engine = key.data
+                if engine is None:
+                    try:
+                        while os.read(self._wake_r, 64):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    ser = engine.ser
+                    data = ser.read(ser.in_waiting or 1)
+                except (serial.SerialException, OSError, TypeError) as e:
+                    self._drop(engine, e)
+                    continue
+                engine.feed(data, now)
+
+            for engine in list(self._engines):
+                if engine.on_wakeup:
+                    engine.on_wakeup(now)
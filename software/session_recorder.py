@@ -0,0 +1,378 @@
+import argparse
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import numpy as np
+
+from frame_decoder import FRAME_SCHEMA, BOOL, INT, PAIR, RECORD_FIELDS, RECORD_SIZE
+
+#everything the host exchanges with an instrument, recorded to an append-only file of fixed-size records
+#  header (HEADER_SIZE bytes) | record | record | ...
+#every record is RECORD_BYTES long and starts with the monotonic time (seconds since the session
+#started) and its kind:
+#  KIND_FRAME  decoded telemetry frame, RECORD_FIELDS as float32 (frame_decoder.RECORD_FIELDS layout),
+#              keys the frame did not have are NaN and left out of the mask of FRAME_SCHEMA keys it had
+#              (the seq field, version 2, older files have every key)
+#  KIND_RX     text line received (console output, sync, acks...), up to TEXT_BYTES per record
+#  KIND_TX     text sent to the instrument
+#  KIND_RAW    line of the frame record just before it, kept for frames outside FRAME_SCHEMA (the reduced
+#              AZ_5 diagnostics frame, unknown keys) so they are replayed exactly as received
+#  KIND_MORE   continuation of the previous text record
+#telemetry is stored decoded (format_frame / encode_frame rebuild the wire format for a replay)
+#every INDEX_STRIDE records the time of the record is appended to the sidecar index (<session>.idx),
+#a sparse (time, record) table that tells which pages to look at for any time, the data itself is
+#memory mapped by SessionReader and handed out as NumPy views without parsing the file
+#a file cut by a crash (partial last record, index behind the data) is still readable
+#  python session_recorder.py info SESSION
+#  python session_recorder.py dump SESSION --start 60 --end 120
+
+MAGIC = b'TCSESS1\0'
+VERSION = 2  # 2: frame key mask and KIND_RAW
+HEADER_SIZE = 128
+RECORD_BYTES = 128
+TEXT_BYTES = RECORD_BYTES - 16
+INDEX_STRIDE = 1024  # records per index entry
+FLUSH_INTERVAL = 1.0  # seconds between flushes of the data file
+SESSION_DIR = os.path.join(os.path.expanduser('~'), '.thermocycler', 'sessions')
+SESSION_SUFFIX = '.tcs'
+
+KIND_FRAME = 1
+KIND_RX = 2
+KIND_TX = 3
+KIND_MORE = 4
+KIND_RAW = 5
+
+FRAME_ALL = (1 << len(FRAME_SCHEMA)) - 1  # frame key mask with every FRAME_SCHEMA key
+
+#  magic | version | record bytes | record fields | index stride | wall start | monotonic start | name
+_HEADER = struct.Struct('<8sHHHI dd 32s')
+_FRAME = struct.Struct(f'<dBxHI{RECORD_SIZE}f{TEXT_BYTES - 4 * RECORD_SIZE}x')
+_TEXT = struct.Struct(f'<dBxHI{TEXT_BYTES}s')
+_INDEX = struct.Struct('<dQ')
+NAN = float('nan')
+INDEX_DTYPE = np.dtype([('time', '<f8'), ('record', '<u8')])
+
+#frame values and text share the payload (overlapping fields)
+RECORD_DTYPE = np.dtype({
+    'names': ['time', 'kind', 'length', 'seq', 'values', 'text'],
+    'formats': ['<f8', 'u1', '<u2', '<u4', ('<f4', (RECORD_SIZE,)), f'S{TEXT_BYTES}'],
+    'offsets': [0, 8, 10, 12, 16, 16],
+    'itemsize': RECORD_BYTES,
+})
+
+
+#flat float record of a frame dict (binary and JSON frames give the same dict), NaN for missing keys
+def frame_values(frame):
+    values = []
+    for key, kind in FRAME_SCHEMA:
+        value = frame.get(key)
+        if kind == PAIR:
+            values += [float(value[0]), float(value[1])] if value else [NAN, NAN]
+        else:
+            values.append(float(value) if value is not None else NAN)
+    return values
+
+
+#mask of the FRAME_SCHEMA keys present in a frame dict, bit i for the i-th key
+def frame_mask(frame):
+    mask = 0
+    for bit, (key, _) in enumerate(FRAME_SCHEMA):
+        if key in frame:
+            mask |= 1 << bit
+    return mask
+
+
+#frame dict of a flat record, the inverse of frame_values (keys missing from `mask` are left out)
+def values_frame(values, mask=FRAME_ALL):
+    frame = {}
+    i = 0
+    for bit, (key, kind) in enumerate(FRAME_SCHEMA):
+        if not mask & (1 << bit):
+            i += 2 if kind == PAIR else 1
+        elif kind == PAIR:
+            frame[key] = [int(values[i]), int(values[i + 1])]
+            i += 2
+        elif kind == BOOL:
+            frame[key] = bool(values[i])
+            i += 1
+        elif kind == INT:
+            frame[key] = int(values[i])
+            i += 1
+        else:
+            frame[key] = float(values[i])
+            i += 1
+    return frame
+
+
+#records of one text line, `kind` then KIND_MORE for every TEXT_BYTES after the first
+def _text_records(kind, text, t):
+    data = text.encode('utf-8', 'replace')
+    parts = [data[i:i + TEXT_BYTES] for i in range(0, len(data), TEXT_BYTES)] or [b'']
+    return b''.join(_TEXT.pack(t, kind if seq == 0 else KIND_MORE, len(part), seq, part)
+                    for seq, part in enumerate(parts))
+
+
+def new_session_path(name="session", directory=SESSION_DIR):
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in name.strip("/").replace("/dev/", ""))
+    return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{safe}{SESSION_SUFFIX}")
+
+
+#writer side, called from the I/O thread (frames, received lines) and from any thread sending commands
+class SessionRecorder:
+
+    def __init__(self, path, name=""):
+        self.path = path
+        self.name = name
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.start_wall = time.time()
+        self.start_mono = time.monotonic()
+        self.records = 0
+        self._last_time = 0.0
+        self._lock = threading.Lock()
+        self._last_flush = self.start_mono
+        self._file = open(path, 'wb')
+        header = _HEADER.pack(MAGIC, VERSION, RECORD_BYTES, RECORD_SIZE, INDEX_STRIDE, self.start_wall, self.start_mono,
+                              name.encode('utf-8', 'replace')[:32])
+        self._file.write(header.ljust(HEADER_SIZE, b'\0'))
+        self._index = open(path + '.idx', 'wb')
+        self.closed = False
+
+    #`raw` is the received line of a JSON frame, kept when the frame is not exactly FRAME_SCHEMA
+    def frame(self, frame, rx_time=None, raw=None):
+        values = frame_values(frame)
+        mask = frame_mask(frame)
+        if mask == FRAME_ALL and len(frame) == len(FRAME_SCHEMA):
+            raw = None
+        with self._lock:
+            t = self._time(rx_time)
+            records = _FRAME.pack(t, KIND_FRAME, RECORD_SIZE, mask, *values)
+            if raw is not None:
+                #same write as the frame, so the raw line always follows it
+                records += _text_records(KIND_RAW, raw, t)
+            self._write(records, t)
+
+    def received(self, line, rx_time=None):
+        self._text(KIND_RX, line, rx_time)
+
+    def sent(self, text):
+        self._text(KIND_TX, text.rstrip('\n'), None)
+
+    #seconds since the start, never going back (lines are stamped on the I/O thread, sends on the caller's)
+    def _time(self, mono):
+        t = (time.monotonic() if mono is None else mono) - self.start_mono
+        self._last_time = max(self._last_time, t)
+        return self._last_time
+
+    def _text(self, kind, text, mono):
+        with self._lock:
+            t = self._time(mono)
+            self._write(_text_records(kind, text, t), t)
+
+    #append records (all stamped `t`), called with the lock held
+    def _write(self, records, t):
+        if self.closed:
+            return
+        first = self.records
+        self.records += len(records) // RECORD_BYTES
+        for entry in range(-(-first // INDEX_STRIDE) * INDEX_STRIDE, self.records, INDEX_STRIDE):
+            self._index.write(_INDEX.pack(t, entry))
+        self._file.write(records)
+        now = time.monotonic()
+        if now - self._last_flush >= FLUSH_INTERVAL:
+            self._flush(now)
+
+    def _flush(self, now):
+        self._file.flush()
+        self._index.flush()
+        self._last_flush = now
+
+    def flush(self):
+        with self._lock:
+            if not self.closed:
+                self._flush(time.monotonic())
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            self._file.close()
+            self._index.close()
+
+
+#read side: the records are a memory mapped NumPy array, nothing is parsed up front
+class SessionReader:
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        header = self._file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE or header[:8] != MAGIC:
+            self._file.close()
+            raise ValueError(f"{path} is not a session file")
+        (_, self.version, record_bytes, record_fields, self.index_stride, self.start_wall, self.start_mono,
+         name) = _HEADER.unpack_from(header)
+        if record_bytes != RECORD_BYTES or record_fields != RECORD_SIZE:
+            self._file.close()
+            raise ValueError(f"{path} was recorded with another frame layout")
+        self.name = name.rstrip(b'\0').decode('utf-8', 'replace')
+        self._mmap = None
+        self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        self.refresh()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    #map the records written since the file was opened (the session may still be recording)
+    def refresh(self):
+        size = os.fstat(self._file.fileno()).st_size
+        count = max(0, (size - HEADER_SIZE) // RECORD_BYTES)
+        if count == len(self.records):
+            return
+        #the previous map stays alive as long as views of it are in use
+        self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        self._mmap = None
+        if count:
+            self._mmap = mmap.mmap(self._file.fileno(), HEADER_SIZE + count * RECORD_BYTES, access=mmap.ACCESS_READ)
+            self.records = np.frombuffer(self._mmap, dtype=RECORD_DTYPE, count=count, offset=HEADER_SIZE)
+        self.index = self._load_index(count)
+
+    #the sidecar index, rebuilt from the records if it is missing or behind
+    def _load_index(self, count):
+        index = np.zeros(0, dtype=INDEX_DTYPE)
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                data = f.read()
+            index = np.frombuffer(data, dtype=INDEX_DTYPE, count=len(data) // INDEX_DTYPE.itemsize)
+        except OSError:
+            pass
+        index = index[index['record'] < count]
+        expected = -(-count // self.index_stride)
+        if len(index) < expected:
+            rebuilt = np.zeros(expected, dtype=INDEX_DTYPE)
+            rebuilt['record'] = np.arange(expected) * self.index_stride
+            rebuilt['time'] = self.records['time'][::self.index_stride]
+            index = rebuilt
+        return index
+
+    def close(self):
+        self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # views still in use, unmapped when they are released
+            self._mmap = None
+        self._file.close()
+
+    @property
+    def duration(self):
+        return float(self.records['time'][-1]) if len(self.records) else 0.0
+
+    #first record at or after `t` seconds: the index narrows the search to one stride of records
+    def seek(self, t):
+        if not len(self.records):
+            return 0
+        block = max(int(np.searchsorted(self.index['time'], t, 'right')) - 1, 0)
+        lo = int(self.index['record'][block]) if len(self.index) else 0
+        hi = min(lo + self.index_stride, len(self.records))
+        if block + 1 < len(self.index):
+            hi = int(self.index['record'][block + 1])
+        return lo + int(np.searchsorted(self.records['time'][lo:hi], t, 'left')) if hi > lo else lo
+
+    #zero-copy view of the records between two times (seconds from the session start)
+    def range(self, start=None, end=None):
+        first = 0 if start is None else self.seek(start)
+        last = len(self.records) if end is None else self.seek(np.nextafter(end, np.inf))
+        return self.records[first:max(first, last)]
+
+    #telemetry between two times as columns keyed like the frame (RECORD_FIELDS) plus 'time'
+    def frames(self, start=None, end=None):
+        records = self.range(start, end)
+        frames = records[records['kind'] == KIND_FRAME]
+        columns = {'time': frames['time']}
+        values = frames['values']
+        for i, name in enumerate(RECORD_FIELDS):
+            columns[name] = values[:, i]
+        return columns
+
+    #(time, kind, text) of the text records between two times, long lines joined again
+    def lines(self, start=None, end=None):
+        records = self.range(start, end)
+        for i in np.flatnonzero((records['kind'] == KIND_RX) | (records['kind'] == KIND_TX)):
+            yield float(records['time'][i]), int(records['kind'][i]), self._text_at(records, i)
+
+    #every record in order as (time, kind, payload), payload being a frame dict or a text line
+    def events(self, start=None, end=None):
+        records = self.range(start, end)
+        kinds = records['kind']
+        masks = records['seq'] if self.version >= 2 else np.full(len(records), FRAME_ALL)
+        for i in np.flatnonzero(kinds != KIND_MORE):
+            kind = int(kinds[i])
+            if kind == KIND_FRAME:
+                yield float(records['time'][i]), kind, values_frame(records['values'][i], int(masks[i]))
+            else:
+                yield float(records['time'][i]), kind, self._text_at(records, i)
+
+    def _text_at(self, records, i):
+        record = records[i]
+        data = record['text'][:record['length']]
+        j = i + 1
+        while j < len(records) and records['kind'][j] == KIND_MORE:
+            data += records['text'][j][:records['length'][j]]
+            j += 1
+        return data.decode('utf-8', 'replace')
+
+
+KIND_NAMES = {KIND_FRAME: 'frame', KIND_RX: 'rx', KIND_TX: 'tx', KIND_MORE: 'more', KIND_RAW: 'raw'}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect recorded sessions.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    info = sub.add_parser('info', help="session summary")
+    info.add_argument('session')
+    dump = sub.add_parser('dump', help="print the records of a time range")
+    dump.add_argument('session')
+    dump.add_argument('--start', type=float, help="seconds from the start of the session")
+    dump.add_argument('--end', type=float)
+    dump.add_argument('--no-frames', action='store_true', help="only the text lines")
+    args = parser.parse_args(argv)
+
+    with SessionReader(args.session) as reader:
+        if args.command == 'info':
+            kinds = reader.records['kind']
+            print(f"{reader.path}: {reader.name or '-'}, started {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reader.start_wall))}")
+            print(f"{len(reader)} records over {reader.duration:.1f} s: {int((kinds == KIND_FRAME).sum())} frames, "
+                  f"{int((kinds == KIND_RX).sum())} lines received, {int((kinds == KIND_TX).sum())} sent")
+            return
+        for t, kind, payload in reader.events(args.start, args.end):
+            if kind == KIND_FRAME:
+                if not args.no_frames:
+                    print(f"{t:10.3f} frame block={payload.get('block_temperature', NAN):.2f} "
+                          f"target={payload.get('target_block_temp', NAN):.2f} cap={payload.get('cap_temperature', NAN):.2f}")
+            elif kind != KIND_RAW or not args.no_frames:
+                print(f"{t:10.3f} {KIND_NAMES[kind]:5} {payload}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:
+        pass
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
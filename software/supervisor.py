@@ -0,0 +1,207 @@
+import threading
+import time
+
+import serial
+
+from instrument import Instrument, BAUD_RATE, DEVICE_VID_PID, DRAIN_TIMEOUT, find_ports
+from cycle_runner import CycleRunner
+from protocol import format_duration
+from serial_engine import SerialMultiplexer
+
+
+#one thermocycler of the bank: its instrument, cycle runner and the last progress reported
+class Unit:
+
+    def __init__(self, name, instrument, runner):
+        self.name = name
+        self.instrument = instrument
+        self.runner = runner
+        self.cycle = 0
+        self.cycles = runner.timeline.cycles
+        self.info = "Idle"
+        self.last_message = None
+        self.error = None
+
+    def status(self):
+        frame = self.instrument.last_frame
+        return {
+            'name': self.name,
+            'connected': self.instrument.connected.is_set(),
+            'online': self.error is None and self.instrument.engine.is_running(),
+            'running': self.runner.is_running(),
+            'cycle': self.cycle,
+            'cycles': self.cycles,
+            'elapsed': self.runner.elapsed(),
+            'remaining': self.runner.remaining(),
+            'info': self.error or self.info,
+            'last_message': self.last_message,
+            'block_temperature': frame.get('block_temperature'),
+            'target_block_temp': frame.get('target_block_temp'),
+            'cap_temperature': frame.get('cap_temperature'),
+            'temp_reached': frame.get('temp_reached'),
+        }
+
+
+#drives a bank of thermocyclers from one process
+#every unit has its own instrument and cycle runner, the serial I/O of all of them is served
+#by one SerialMultiplexer thread where supported (otherwise one blocking reader thread per port)
+#`on_console(name, text, tag)` receives the console lines of every unit, `runner_options` are passed
+#to every CycleRunner (e.g. the protocol timeline), with `record` every unit records its session
+class Supervisor:
+
+    def __init__(self, baud=BAUD_RATE, sd_mode=True, pipelined=True, binary=True, timestamps=True,
+                 multiplex=None, on_console=None, runner_options=None, record=False):
+        self.baud = baud
+        self.sd_mode = sd_mode
+        self.pipelined = pipelined
+        self.binary = binary
+        self.timestamps = timestamps
+        self.on_console = on_console
+        self.runner_options = runner_options or {}
+        self.record = record
+
+        if multiplex is None:
+            multiplex = SerialMultiplexer.supported()
+        self.mux = SerialMultiplexer() if multiplex else None
+
+        self.units = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self.mux is not None:
+            self.mux.start()
+        return self
+
+    #open and start every matching port (and `extra_ports`) not already in the bank, returns the new unit names
+    #ports are locked (exclusive=True), a port another program holds fails to open and is skipped
+    def discover(self, vid_pid=DEVICE_VID_PID, extra_ports=()):
+        added = []
+        ports = find_ports(vid_pid)
+        ports += [port for port in extra_ports if port not in ports]
+        for port in ports:
+            if port in self.units:
+                continue
+            try:
+                ser = serial.Serial(port, self.baud, timeout=1, exclusive=True)
+            except serial.SerialException:
+                continue
+            self.add(ser, port)
+            added.append(port)
+        return added
+
+    #add an already open serial port (or any object behaving like one) to the bank
+    def add(self, ser, name=None):
+        name = name or getattr(ser, 'port', None) or f"unit{len(self.units) + 1}"
+        on_console = None
+        if self.on_console is not None:
+            on_console = lambda text, tag, name=name: self.on_console(name, text, tag)
+
+        instrument = Instrument(ser, name=name, sd_mode=self.sd_mode, pipelined=self.pipelined,
+                                binary=self.binary, timestamps=self.timestamps, on_console=on_console)
+        if self.record:
+            instrument.record()
+        unit = Unit(name, instrument, CycleRunner(instrument, **self.runner_options))
+        self._wire(unit)
+
+        with self._lock:
+            self.units[name] = unit
+        instrument.start(self.mux)
+        return unit
+
+    def remove(self, name):
+        with self._lock:
+            unit = self.units.pop(name, None)
+        if unit is not None:
+            unit.runner.stop()
+            unit.instrument.close()
+
+    def _wire(self, unit):
+        def on_cycle(num, cycles):
+            unit.cycle = num
+            unit.cycles = cycles
+
+        def on_info(msg):
+            unit.info = msg
+
+        def on_last_message(msg):
+            unit.last_message = msg
+
+        def on_finished():
+            if not unit.info.startswith("Cycle completed"):
+                unit.info = "Stopped"
+
+        def on_error(error):
+            unit.error = f"Serial connection lost: {error}"
+            unit.runner.stop()
+
+        unit.runner.on_cycle = on_cycle
+        unit.runner.on_info = on_info
+        unit.runner.on_last_message = on_last_message
+        unit.runner.on_finished = on_finished
+        unit.instrument.on_error = on_error
+
+    def _select(self, names):
+        with self._lock:
+            if names is None:
+                return list(self.units.values())
+            return [self.units[name] for name in names if name in self.units]
+
+    #start the cycle on the given units (all by default) once their handshake is done,
+    #returns the names of the units that started
+    def start_cycles(self, names=None):
+        started = []
+        for unit in self._select(names):
+            if unit.instrument.connected.is_set() and unit.error is None and unit.runner.start():
+                unit.cycle = 0
+                started.append(unit.name)
+        return started
+
+    def end_cycles(self, names=None):
+        for unit in self._select(names):
+            unit.runner.end()
+
+    def stop_cycles(self, names=None):
+        for unit in self._select(names):
+            unit.runner.stop()
+
+    def any_running(self):
+        return any(unit.runner.is_running() for unit in self._select(None))
+
+    #status of every unit, in name order
+    def status(self):
+        return [unit.status() for unit in sorted(self._select(None), key=lambda unit: unit.name)]
+
+    #stop the cycles and close the units once their last commands (heater off) are acked,
+    #waiting at most `timeout` seconds for all of them
+    def close(self, timeout=DRAIN_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        units = self._select(None)
+        for unit in units:
+            unit.runner.stop()
+        for unit in units:
+            unit.runner.wait(1)
+        for unit in units:
+            if not unit.instrument.drain(max(deadline - time.monotonic(), 0)):
+                unit.instrument.log("The last commands were not acked, check that the heater is off.\n", 'red')
+            unit.instrument.close()
+        if self.mux is not None:
+            self.mux.close()
+
+
+def _temp(value):
+    return "   -  " if value is None else f"{value:6.2f}"
+
+
+#one line per unit, for consoles and logs
+def format_status(statuses):
+    lines = [f"{'unit':<16} {'block':>6} {'target':>6} {'cap':>6} {'cycle':>7} {'elapsed':>8} {'left':>8}  status"]
+    for status in statuses:
+        if not status['connected']:
+            state = status['info'] if not status['online'] else "waiting for handshake"
+        else:
+            state = status['info'].replace("\n", " ")
+        lines.append(f"{status['name']:<16} {_temp(status['block_temperature'])} {_temp(status['target_block_temp'])} "
+                     f"{_temp(status['cap_temperature'])} {status['cycle']:>3}/{status['cycles']:<3} "
+                     f"{time.strftime('%H:%M:%S', time.gmtime(status['elapsed']))} "
+                     f"{format_duration(status['remaining']):>8}  {state}")
+    return "\n".join(lines)
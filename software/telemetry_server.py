@@ -0,0 +1,463 @@
+import argparse
+import collections
+import json
+import hmac
+import math
+import secrets
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#local server publishing what an Instrument receives to any number of subscribers (dashboards,
+#loggers, notebooks), standard library only: Server-Sent Events over plain HTTP
+#  GET  /events?kinds=frame,console,command&policy=drop&queue=256&max_rate=10
+#                        text/event-stream, one "event: <kind>" + "data: <json>" per event
+#  GET  /frame           last telemetry frame (JSON)
+#  GET  /status          server, client and link state (JSON)
+#  POST /command         queue a command like the Send button, {"command": "target_block_temp=95"} as
+#                        application/json with "Authorization: Bearer <token>", answers {"id": <command id>}
+#commands are off unless the server is started with commands=True (--allow-commands), the token is made
+#up at start and printed: a web page open in the browser can post to 127.0.0.1 too, so requests with a
+#foreign Origin are refused and JSON is required (a cross-site JSON post needs a CORS preflight, which
+#is never granted)
+#the instrument's I/O thread only encodes each event once and appends it to every subscriber's bounded
+#queue (never blocking), every client is written by its own server thread, so a slow client only
+#loses its own events:
+#  policy=drop       a full queue drops its oldest event
+#  policy=decimate   frames are thinned out instead (one of every 2, 4, 8... while the client lags,
+#                    back to all of them when it catches up), console and command events are never thinned
+#max_rate caps the frames per second of a client whatever the policy
+#  python telemetry_server.py serve --replay ../Example_logs/LOG.CSV --speed 20
+#  python telemetry_server.py tail http://127.0.0.1:8765 --kinds frame --max-rate 1
+
+SERVER_HOST = '127.0.0.1'  # local clients only
+SERVER_PORT = 8765
+CLIENT_QUEUE = 256  # events queued per client
+MAX_CLIENT_QUEUE = 65536
+MAX_STRIDE = 64  # at most one frame of every MAX_STRIDE is kept for a lagging client with policy=decimate
+KEEPALIVE = 15  # s between SSE comments on a quiet stream (lets dead connections be noticed)
+MAX_COMMAND_BYTES = 256
+
+EVENT_KINDS = ('frame', 'console', 'command')
+POLICY_DROP = 'drop'
+POLICY_DECIMATE = 'decimate'
+
+
+#one client: a bounded queue filled by the publisher and emptied by the client's server thread
+class Subscriber:
+
+    def __init__(self, kinds=EVENT_KINDS, policy=POLICY_DROP, capacity=CLIENT_QUEUE, max_rate=None, name=""):
+        if policy not in (POLICY_DROP, POLICY_DECIMATE):
+            raise ValueError(f"unknown policy {policy!r}")
+        self.kinds = frozenset(kinds)
+        self.policy = policy
+        self.capacity = capacity
+        self.name = name
+        self.closed = False
+        self.stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'decimated': 0, 'stride': 1}
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._min_interval = 1 / max_rate if max_rate else 0.0
+        self._last_frame = -math.inf
+        self._stride = 1  # decimate: one frame of every _stride is queued
+        self._skip = 0
+
+    #called by the publisher, never blocks on the client
+    def offer(self, kind, data, now):
+        if kind not in self.kinds or self.closed:
+            return
+        stats = self.stats
+        if kind == 'frame':
+            if now - self._last_frame < self._min_interval:
+                stats['decimated'] += 1
+                return
+            if self._skip:
+                self._skip -= 1
+                stats['decimated'] += 1
+                return
+            self._skip = self._stride - 1
+            self._last_frame = now
+
+        with self._cond:
+            queue = self._queue
+            if len(queue) >= self.capacity:
+                queue.popleft()
+                stats['dropped'] += 1
+                if self.policy == POLICY_DECIMATE:
+                    self._stride = min(self._stride * 2, MAX_STRIDE)
+            elif self._stride > 1 and len(queue) < self.capacity // 4:
+                self._stride //= 2
+            stats['stride'] = self._stride
+            queue.append(data)
+            stats['queued'] += 1
+            self._cond.notify()
+
+    #next event (bytes), None after `timeout` seconds without one or once closed
+    def get(self, timeout=None):
+        with self._cond:
+            if not self._queue and not self.closed:
+                self._cond.wait(timeout)
+            if self._queue:
+                self.stats['sent'] += 1
+                return self._queue.popleft()
+            return None
+
+    def pending(self):
+        return len(self._queue)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+#fan-out of the events of one instrument, the subscriber list is replaced (not modified) so the
+#publisher iterates it without a lock
+class TelemetryHub:
+
+    def __init__(self):
+        self.subscribers = []
+        self.latest = None  # last frame (dict, JSON safe)
+        self.stats = {'published': 0, 'clients': 0, 'connections': 0, 'commands': 0}
+        self._lock = threading.Lock()
+        self._instrument = None
+
+    def subscribe(self, **options):
+        subscriber = Subscriber(**options)
+        with self._lock:
+            self.subscribers = self.subscribers + [subscriber]
+            self.stats['clients'] = len(self.subscribers)
+            self.stats['connections'] += 1
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self._lock:
+            self.subscribers = [s for s in self.subscribers if s is not subscriber]
+            self.stats['clients'] = len(self.subscribers)
+
+    def close(self):
+        for subscriber in self.subscribers:
+            self.unsubscribe(subscriber)
+
+    #encode once, queue for every subscriber
+    def publish(self, kind, payload):
+        if kind == 'frame':
+            self.latest = payload
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        self.stats['published'] += 1
+        data = f"event: {kind}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n".encode('utf-8')
+        now = time.monotonic()
+        for subscriber in subscribers:
+            subscriber.offer(kind, data, now)
+
+    #publish the frames, console lines and command events of an instrument
+    def attach(self, instrument):
+        self._instrument = instrument
+        instrument.add_frame_hook(self._frame)
+        instrument.add_console_hook(self._console)
+        instrument.add_command_hook(self._command)
+
+    def detach(self):
+        instrument = self._instrument
+        if instrument is not None:
+            instrument.remove_frame_hook(self._frame)
+            instrument.remove_console_hook(self._console)
+            instrument.remove_command_hook(self._command)
+            self._instrument = None
+
+    def _frame(self, frame, rx_time):
+        payload = {key: _json_value(value) for key, value in frame.items()}
+        payload['time'] = round(time.time(), 3)
+        self.publish('frame', payload)
+
+    def _console(self, text, tag):
+        self.publish('console', {'text': text.rstrip("\n"), 'tag': tag, 'time': round(time.time(), 3)})
+
+    def _command(self, kind, command_id, message, tries):
+        self.publish('command', {'kind': kind, 'id': command_id, 'message': message, 'tries': tries,
+                                 'time': round(time.time(), 3)})
+
+
+#NaN readings (disconnected sensor) become null, JSON has no NaN
+def _json_value(value):
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+#HTTP server of a hub, runs on its own threads (one per connection), `commands` enables POST /command
+#for the clients that present `token`
+class TelemetryServer:
+
+    def __init__(self, instrument, host=SERVER_HOST, port=SERVER_PORT, commands=False, token=None):
+        self.instrument = instrument
+        self.commands = commands
+        self.token = token or secrets.token_urlsafe(16)
+        self.hub = TelemetryHub()
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.telemetry = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    #origins of the pages served by this server itself (what a browser sends for same-origin requests)
+    def local_origin(self, origin):
+        port = self.httpd.server_address[1]
+        return origin in (f"http://{self.httpd.server_address[0]}:{port}", f"http://localhost:{port}",
+                          f"http://127.0.0.1:{port}")
+
+    def start(self):
+        if self._thread is None:
+            self.hub.attach(self.instrument)
+            self._thread = threading.Thread(target=self.httpd.serve_forever, name="telemetry-server", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self.hub.detach()
+            self.hub.close()
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+
+    def status(self):
+        instrument = self.instrument
+        return {
+            'server': dict(self.hub.stats),
+            'clients': [dict(subscriber.stats, name=subscriber.name, pending=subscriber.pending(),
+                             policy=subscriber.policy) for subscriber in self.hub.subscribers],
+            'device': {
+                'name': instrument.name,
+                'connected': instrument.connected.is_set(),
+                'online': instrument.engine.is_running(),
+                'commands_queued': instrument.commands.pending(),
+                'commands_in_flight': instrument.commands.in_flight(),
+                'lines': instrument.engine.stats['lines'],
+                'binary_frames': instrument.engine.stats['binary_frames'],
+            },
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        server = self.server.telemetry
+        if not self._same_origin(server):
+            return
+        if url.path == '/events':
+            self._events(server, urllib.parse.parse_qs(url.query))
+        elif url.path == '/frame':
+            latest = server.hub.latest
+            if latest is None:
+                self._json(404, {'error': "no frame received yet"})
+            else:
+                self._json(200, latest)
+        elif url.path == '/status':
+            self._json(200, server.status())
+        else:
+            self._json(404, {'error': "unknown path"})
+
+    def do_POST(self):
+        server = self.server.telemetry
+        if urllib.parse.urlsplit(self.path).path != '/command':
+            self.close_connection = True
+            self._json(404, {'error': "unknown path"})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_COMMAND_BYTES:
+            self.close_connection = True
+            self._json(413, {'error': "command too long"})
+            return
+        body = self.rfile.read(length)
+        if not self._same_origin(server):
+            return
+        if not server.commands:
+            self._json(403, {'error': "commands are disabled (start the server with --allow-commands)"})
+            return
+        scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+        if scheme != 'Bearer' or not hmac.compare_digest(token.strip().encode(), server.token.encode()):
+            self._json(401, {'error': "missing or wrong token"})
+            return
+        if not self.headers.get('Content-Type', '').startswith('application/json'):
+            self._json(415, {'error': "expected application/json"})
+            return
+        try:
+            body = str(json.loads(body).get('command', '')).strip()
+        except (ValueError, AttributeError):
+            self._json(400, {'error': "expected {\"command\": ...}"})
+            return
+        if not body or not body.isprintable():
+            self._json(400, {'error': "expected one printable line"})
+            return
+        command_id = server.instrument.send(body)
+        server.hub.stats['commands'] += 1
+        self._json(202, {'id': command_id, 'command': body})
+
+    #False (and a 403 sent) for a request made by a page of another site
+    def _same_origin(self, server):
+        origin = self.headers.get('Origin')
+        if origin is None or server.local_origin(origin):
+            return True
+        self.close_connection = True
+        self._json(403, {'error': "cross-origin requests are refused"})
+        return False
+
+    def _events(self, server, query):
+        try:
+            kinds = [kind for part in query.get('kinds', [','.join(EVENT_KINDS)]) for kind in part.split(',') if kind]
+            if not set(kinds) <= set(EVENT_KINDS):
+                raise ValueError(f"kinds must be among {', '.join(EVENT_KINDS)}")
+            capacity = min(max(int(query.get('queue', [CLIENT_QUEUE])[0]), 1), MAX_CLIENT_QUEUE)
+            max_rate = float(query['max_rate'][0]) if 'max_rate' in query else None
+            subscriber = server.hub.subscribe(kinds=kinds, policy=query.get('policy', [POLICY_DROP])[0],
+                                              capacity=capacity, max_rate=max_rate,
+                                              name=f"{self.client_address[0]}:{self.client_address[1]}")
+        except ValueError as e:
+            self._json(400, {'error': str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            self.wfile.write(b": connected\n\n")
+            self.wfile.flush()
+            while not subscriber.closed:
+                data = subscriber.get(KEEPALIVE)
+                if data is None:
+                    if subscriber.closed:
+                        break
+                    data = b": keepalive\n\n"
+                self.wfile.write(data)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, OSError):
+            pass
+        finally:
+            server.hub.unsubscribe(subscriber)
+
+    def _json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+#(kind, payload) of the events of a server, for scripts and notebooks
+def subscribe(url, kinds=EVENT_KINDS, policy=POLICY_DROP, queue=CLIENT_QUEUE, max_rate=None, timeout=None):
+    query = {'kinds': ','.join(kinds), 'policy': policy, 'queue': queue}
+    if max_rate:
+        query['max_rate'] = max_rate
+    with urllib.request.urlopen(f"{url.rstrip('/')}/events?{urllib.parse.urlencode(query)}", timeout=timeout) as stream:
+        kind = None
+        for raw in stream:
+            line = raw.decode('utf-8').rstrip("\r\n")
+            if line.startswith('event: '):
+                kind = line[7:]
+            elif line.startswith('data: ') and kind:
+                yield kind, json.loads(line[6:])
+                kind = None
+
+
+#queue a command on a server (`token` printed by the server at start), returns its id
+def send_command(url, command, token, timeout=5):
+    request = urllib.request.Request(f"{url.rstrip('/')}/command", data=json.dumps({'command': command}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json', 'Authorization': f"Bearer {token}"},
+                                     method='POST')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.load(response)['id']
+
+
+def _serve(args):
+    from instrument import Instrument
+
+    received = b''
+    if args.replay:
+        from replay import ReplaySerial, open_source, parse_speed
+        ser = ReplaySerial(open_source(args.replay), parse_speed(args.speed), port=f"replay:{args.replay}")
+    else:
+        from discovery import wait_for_device
+        probe = wait_for_device(port=args.serial)
+        if probe is None:
+            print("Thermocycler not found.")
+            sys.exit(1)
+        ser, received = probe.ser, probe.received
+    instrument = Instrument(ser)
+    server = TelemetryServer(instrument, args.host, args.port, commands=args.allow_commands).start()
+    instrument.start(received=received)
+    print(f"Serving {instrument.name} on {server.url} (Ctrl+C to stop)")
+    if server.commands:
+        print(f"Commands enabled, token {server.token}")
+    try:
+        while instrument.engine.is_running():
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    server.stop()
+    instrument.close()
+
+
+def _tail(args):
+    try:
+        for kind, payload in subscribe(args.url, args.kinds.split(','), args.policy, max_rate=args.max_rate):
+            if kind == 'console':
+                print(payload['text'])
+            else:
+                print(kind, json.dumps(payload))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        sys.stderr.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local telemetry server (Server-Sent Events) of a thermocycler")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    serve = sub.add_parser('serve', help="connect to the thermocycler (or a recording) and serve it")
+    serve.add_argument('--serial', help="serial port (default: discover the device)")
+    serve.add_argument('--replay', metavar='FILE', help="serve a recorded session (.tcs) or SD card log instead")
+    serve.add_argument('--speed', default='1', help="replay speed-up factor or 'max'")
+    serve.add_argument('--host', default=SERVER_HOST)
+    serve.add_argument('--port', type=int, default=SERVER_PORT)
+    serve.add_argument('--allow-commands', action='store_true', help="accept POST /command (with the printed token)")
+
+    tail = sub.add_parser('tail', help="print the events of a server")
+    tail.add_argument('url', nargs='?', default=f"http://{SERVER_HOST}:{SERVER_PORT}")
+    tail.add_argument('--kinds', default=','.join(EVENT_KINDS))
+    tail.add_argument('--policy', default=POLICY_DROP, choices=[POLICY_DROP, POLICY_DECIMATE])
+    tail.add_argument('--max-rate', type=float, help="max frames per second")
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        _serve(args)
+    else:
+        _tail(args)
+
+
+if __name__ == "__main__":
+    main()
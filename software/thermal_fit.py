@@ -0,0 +1,252 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+from run_analysis import log_time
+from sd_log import read_log
+
+#block ramp rates of one instrument learned from its SD logs, used to predict how long the
+#wait-for-temperature part of each protocol step takes
+#the firmware drives the block in two modes while ramping (update_values): full heater power when
+#the block is more than 1.5 degrees below target, fan when it is more than 2 degrees above,
+#so the rate is only a function of the block temperature in each mode and is fitted as a
+#median per temperature bin
+#  python thermal_fit.py fit --device unit1 ../Example_logs/*.CSV
+#  python thermal_fit.py predict --device unit1 --protocol protocols/touchdown.json
+
+BIN_WIDTH = 5.0  # degrees per rate bin
+BIN_RANGE = (0.0, 130.0)
+MIN_BIN_SAMPLES = 5  # bins with fewer samples are interpolated from their neighbours
+RATE_WINDOW = 3  # samples on each side of the centered difference (the sensors step by 0.25 degrees)
+MIN_RATE = 0.01  # degrees per second, keeps the integration finite near ambient
+ARRIVAL_BAND = 1.0  # the firmware reports temp_reached within 1 degree of the target
+INTEGRATION_STEP = 0.1  # degrees
+
+FIT_VERSION = 2  # part of the log signature, bump when the fit of the same logs changes
+MODEL_DIR = os.path.join(os.path.expanduser('~'), '.thermocycler', 'thermal_models')
+
+DRIVE_HEAT = 1
+DRIVE_COOL = 2
+
+
+class RampModel:
+
+    def __init__(self, centers, heat, cool, samples=None, device=None, sources=None):
+        self.centers = np.asarray(centers, dtype=np.float64)
+        self.heat = np.asarray(heat, dtype=np.float64)  # degrees per second while heating
+        self.cool = np.asarray(cool, dtype=np.float64)  # degrees per second while cooling (positive)
+        self.samples = samples or {}
+        self.device = device
+        self.sources = sources or []
+
+    #seconds for the block to go from `start` to the arrival band around `end`
+    def ramp_time(self, start, end):
+        if end >= start:
+            stop = end - ARRIVAL_BAND
+            curve = self.heat
+        else:
+            stop = end + ARRIVAL_BAND
+            curve = self.cool
+        span = abs(stop - start)
+        if (end >= start) != (stop > start) or span == 0:
+            return 0.0
+        grid = np.linspace(start, stop, int(np.ceil(span / INTEGRATION_STEP)) + 1)
+        middle = (grid[1:] + grid[:-1]) / 2
+        rates = np.maximum(np.interp(middle, self.centers, curve), MIN_RATE)
+        return float(np.sum(np.abs(np.diff(grid)) / rates))
+
+    def to_dict(self):
+        return {
+            'device': self.device,
+            'centers': self.centers.tolist(),
+            'heat': self.heat.tolist(),
+            'cool': self.cool.tolist(),
+            'samples': self.samples,
+            'sources': self.sources,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['centers'], data['heat'], data['cool'], data.get('samples'), data.get('device'),
+                   data.get('sources'))
+
+
+#centered temperature rate and drive mode of every row of a log, rows whose window mixes modes
+#(or spans a reboot) are dropped
+def log_rates(log):
+    t = log_time(log['millis'])
+    temp = log['block_temp_mean']
+    n = len(t)
+    k = RATE_WINDOW
+    if n <= 2 * k:
+        return np.empty(0), np.empty(0), np.empty(0, dtype=np.int8)
+
+    active = (log['heat_act'] == 1) & (log['AZ_5'] == 0)
+    drive = np.zeros(n, dtype=np.int8)
+    drive[active & (log['H70_pwm'] == 255) & (log['H70_act'] == 1)] = DRIVE_HEAT
+    drive[active & (log['FAN_act'] == 1)] = DRIVE_COOL
+
+    #a window is usable if the drive mode does not change inside it (a reboot counts as a change)
+    reboot = log['millis'][1:] < log['millis'][:-1]
+    changes = np.concatenate(([0], np.cumsum((drive[1:] != drive[:-1]) | reboot)))
+    centre = slice(k, n - k)
+    steady = changes[2 * k:] == changes[:n - 2 * k]
+    dt = t[2 * k:] - t[:n - 2 * k]
+    valid = steady & (dt > 0) & (drive[centre] != 0) & ~np.isnan(temp[centre])
+
+    rates = (temp[2 * k:] - temp[:n - 2 * k]) / np.where(dt > 0, dt, 1)
+    return temp[centre][valid], rates[valid], drive[centre][valid]
+
+
+#median rate per bin (vectorized: one sort, medians picked by index), NaN for bins with too few samples
+def _binned_median(temps, rates, edges):
+    bins = np.digitize(temps, edges) - 1
+    inside = (bins >= 0) & (bins < len(edges) - 1)
+    bins = bins[inside]
+    rates = rates[inside]
+    medians = np.full(len(edges) - 1, np.nan)
+    counts = np.bincount(bins, minlength=len(edges) - 1)
+    if not len(bins):
+        return medians, counts
+    order = np.lexsort((rates, bins))
+    bins = bins[order]
+    rates = rates[order]
+    present = np.flatnonzero(counts >= MIN_BIN_SAMPLES)
+    starts = np.searchsorted(bins, present, 'left')
+    ends = np.searchsorted(bins, present, 'right') - 1
+    medians[present] = (rates[(starts + ends) // 2] + rates[(starts + ends + 1) // 2]) / 2
+    return medians, counts
+
+
+def _fill(curve, centers):
+    known = ~np.isnan(curve)
+    if not known.any():
+        return None
+    return np.interp(centers, centers[known], curve[known])
+
+
+#fit a model from SD logs, raises ValueError if the logs have no heating or no cooling ramps
+def fit_logs(paths, device=None):
+    temps, rates, drives = [], [], []
+    for path in paths:
+        temp, rate, drive = log_rates(read_log(path))
+        temps.append(temp)
+        rates.append(rate)
+        drives.append(drive)
+    temps = np.concatenate(temps) if temps else np.empty(0)
+    rates = np.concatenate(rates) if rates else np.empty(0)
+    drives = np.concatenate(drives) if drives else np.empty(0, dtype=np.int8)
+
+    edges = np.arange(BIN_RANGE[0], BIN_RANGE[1] + BIN_WIDTH, BIN_WIDTH)
+    centers = (edges[1:] + edges[:-1]) / 2
+
+    heating = drives == DRIVE_HEAT
+    cooling = drives == DRIVE_COOL
+    heat, heat_counts = _binned_median(temps[heating], rates[heating], edges)
+    cool, cool_counts = _binned_median(temps[cooling], -rates[cooling], edges)
+    heat = _fill(heat, centers)
+    cool = _fill(cool, centers)
+    if heat is None or cool is None:
+        raise ValueError("the logs do not contain enough heating and cooling ramps")
+
+    samples = {'heat': int(heating.sum()), 'cool': int(cooling.sum()),
+               'heat_bins': heat_counts.tolist(), 'cool_bins': cool_counts.tolist()}
+    return RampModel(centers, np.maximum(heat, MIN_RATE), np.maximum(cool, MIN_RATE), samples, device,
+                     log_signature(paths))
+
+
+#identifies the exact log files a model was fitted from
+def log_signature(paths):
+    signature = [['version', FIT_VERSION]]
+    for path in sorted(paths):
+        stat = os.stat(path)
+        signature.append([os.path.abspath(path), stat.st_size, int(stat.st_mtime)])
+    return signature
+
+
+def model_path(device):
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in device)
+    return os.path.join(MODEL_DIR, safe + ".json")
+
+
+#cached model of a device, None if it was never fitted
+def load_model(device):
+    try:
+        with open(model_path(device), encoding='utf-8') as f:
+            return RampModel.from_dict(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_model(model):
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    path = model_path(model.device)
+    data = model.to_dict()
+    data['fitted_at'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1)
+    return path
+
+
+#cached model of a device, refitted only if the set of logs (or one of them) changed
+def fit_device(device, paths):
+    model = load_model(device)
+    if model is not None and model.sources == log_signature(paths):
+        return model
+    model = fit_logs(paths, device)
+    save_model(model)
+    return model
+
+
+def main(argv=None):
+    from protocol import load_timeline, format_duration
+
+    parser = argparse.ArgumentParser(description="Fit block ramp rates from SD logs and predict protocol durations.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    fit = sub.add_parser('fit', help="fit (or refresh) the model of a device")
+    fit.add_argument('logs', nargs='+', help="SD log files or glob patterns")
+    fit.add_argument('--device', default='default')
+
+    predict = sub.add_parser('predict', help="predict the duration of a protocol")
+    predict.add_argument('--device', default='default')
+    predict.add_argument('--protocol', help="protocol file (default protocols/default.json)")
+    predict.add_argument('--cycles', type=int)
+    predict.add_argument('--steps', action='store_true', help="list every step")
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'fit':
+        paths = sorted({path for pattern in args.logs for path in glob.glob(pattern)})
+        if not paths:
+            parser.error("no log files found")
+        model = fit_device(args.device, paths)
+        print(f"{args.device}: {len(paths)} logs, {model.samples['heat']} heating and {model.samples['cool']} cooling samples")
+        print(f"{'temp':>6} {'heat C/s':>9} {'n':>5} {'cool C/s':>9} {'n':>5}")
+        for i, center in enumerate(model.centers):
+            heat_n = model.samples['heat_bins'][i]
+            cool_n = model.samples['cool_bins'][i]
+            if heat_n or cool_n:
+                print(f"{center:6.1f} {model.heat[i]:9.3f} {heat_n:5d} {model.cool[i]:9.3f} {cool_n:5d}")
+        print(f"saved to {model_path(args.device)}")
+        return
+
+    model = load_model(args.device)
+    if model is None:
+        parser.error(f"no model for {args.device}, run 'fit' first")
+    timeline = load_timeline(args.protocol, args.cycles, ramp_model=model)
+    linear = load_timeline(args.protocol, args.cycles)
+    if args.steps:
+        for i, step in enumerate(timeline.steps):
+            print(f"{i:4d} {step.name:<24} {step.temp:6.1f} ramp {step.ramp:6.1f}s hold {step.hold:6.0f}s"
+                  f"{'' if step.wait else ' (no wait)'}")
+    print(f"{timeline.name}: {format_duration(timeline.total())} with the {args.device} model, "
+          f"{format_duration(linear.total())} with the protocol ramp rates")
+
+
+if __name__ == "__main__":
+    main()
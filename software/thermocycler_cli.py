@@ -0,0 +1,287 @@
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+
+from instrument import Instrument, BAUD_RATE, DEVICE_HWID, DEVICE_VID_PID
+from discovery import wait_for_device
+from cycle_runner import CycleRunner
+from protocol import ProtocolError, load_timeline, format_duration
+from supervisor import Supervisor, format_status
+from sd_transfer import SDTransfer, SDTransferError, CHUNK_SIZE, format_size
+
+#headless front end: same core as the Tk app (instrument.py, cycle_runner.py) without any GUI import
+#  python thermocycler_cli.py monitor            print the console and a frame summary every second
+#  python thermocycler_cli.py run                run the default protocol (--protocol protocols/touchdown.json)
+#  python thermocycler_cli.py send heat_act=true target_block_temp=95
+#  python thermocycler_cli.py bank --run         run the protocol on every connected unit
+#  python thermocycler_cli.py sd get --all       copy the SD card logs over the serial link
+
+SUMMARY_KEYS = ['block_temperature', 'target_block_temp', 'cap_temperature', 'target_cap_temp', 'temp_reached']
+HANDSHAKE_TIMEOUT = 30  # seconds to wait for the firmware handshake
+
+
+def print_console(text, tag=None):
+    sys.stdout.write(text if text.endswith("\n") else text + "\n")
+    sys.stdout.flush()
+
+
+def frame_summary(frame):
+    return " ".join(f"{key}={frame[key]}" for key in SUMMARY_KEYS if key in frame)
+
+
+def open_instrument(args, on_console=print_console):
+    probe = wait_for_device(args.hwid, args.port, args.baud, args.connect_timeout)
+    if probe is None:
+        print(f"Failed to connect to {args.port or args.hwid} after {args.connect_timeout} seconds.")
+        sys.exit(1)
+    print(f"Connected to {probe.port} ({probe.elapsed * 1000:.0f} ms)")
+    instrument = Instrument(probe.ser, sd_mode=not args.no_sd, pipelined=not args.no_seq, binary=not args.no_binary,
+                            timestamps=not args.no_timestamps, on_console=on_console)
+    if args.record:
+        print(f"Recording to {instrument.record().path}")
+    if args.serve is not None:
+        from telemetry_server import TelemetryServer
+        server = TelemetryServer(instrument, port=args.serve, commands=args.allow_commands).start()
+        print(f"Telemetry server on {server.url}" + (f", commands token {server.token}" if server.commands else ""))
+    return instrument.start(received=probe.received)
+
+
+#handshake answered (or the board was already running) and firmware loop running: commands sent
+#during the boot splash after the handshake would not be read before their retries run out
+def wait_handshake(instrument):
+    deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+    if not instrument.connected.wait(HANDSHAKE_TIMEOUT):
+        print("No handshake from the thermocycler.")
+        instrument.close()
+        sys.exit(1)
+    if not instrument.ready.wait(max(deadline - time.monotonic(), 0)):
+        print("No telemetry from the thermocycler.")
+        instrument.close()
+        sys.exit(1)
+
+
+def cmd_monitor(args):
+    instrument = open_instrument(args)
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+
+    while not stop.wait(args.interval):
+        if instrument.last_frame:
+            print_console(frame_summary(instrument.last_frame))
+        if not instrument.engine.is_running():
+            break
+    instrument.close()
+
+
+#compiled protocol of the run/bank subcommands, with the ramp times of a fitted thermal model if --model is given
+def timeline_from_args(args):
+    ramp_model = None
+    if args.model:
+        from thermal_fit import load_model
+        ramp_model = load_model(args.model)
+        if ramp_model is None:
+            print(f"No thermal model for {args.model}, fit one with: python thermal_fit.py fit --device {args.model} LOGS")
+            sys.exit(1)
+    try:
+        return load_timeline(args.protocol, args.cycles, ramp_model)
+    except (OSError, ProtocolError) as e:
+        print(f"Invalid protocol: {e}")
+        sys.exit(1)
+
+
+def cmd_run(args):
+    timeline = timeline_from_args(args)
+    print(f"Protocol: {timeline.name}, {len(timeline)} steps, about {format_duration(timeline.total())}")
+    instrument = open_instrument(args, on_console=print_console if args.verbose else None)
+    wait_handshake(instrument)
+
+    runner = CycleRunner(instrument, timeline, time_scale=args.speed)
+    last_info = [None]
+
+    def on_info(msg):
+        if msg != last_info[0]:
+            last_info[0] = msg
+            print_console(msg)
+
+    runner.on_info = on_info
+    runner.on_last_message = lambda msg: print_console(f"Sent: {msg}")
+    runner.on_cycle = lambda num, cycles: print_console(f"Cycle {num} of {cycles}, ~{format_duration(runner.remaining())} left")
+
+    #first Ctrl+C ends the cycle (final extension and cooling), the second one stops it
+    def interrupt(*_):
+        if runner.end_flag.is_set():
+            runner.stop()
+        else:
+            print_console("Ending cycle, press Ctrl+C again to stop immediately.")
+            runner.end()
+
+    signal.signal(signal.SIGINT, interrupt)
+    runner.start()
+    while runner.is_running():
+        runner.wait(0.5)
+    #the final commands (heater off) are only queued when the runner returns
+    if not instrument.drain():
+        print_console("Timed out waiting for the last ACKs, check that the heater is off.")
+    instrument.close()
+
+
+def cmd_send(args):
+    instrument = open_instrument(args)
+    wait_handshake(instrument)
+
+    for command in args.commands:
+        instrument.send(command)
+
+    if not instrument.drain(args.timeout):
+        print("Timed out waiting for ACKs.")
+        instrument.close()
+        sys.exit(1)
+    failed = instrument.commands.stats['failed']
+    instrument.close()
+    sys.exit(1 if failed else 0)
+
+
+def cmd_sd(args):
+    instrument = open_instrument(args, on_console=print_console if args.verbose else None)
+    wait_handshake(instrument)
+    transfer = SDTransfer(instrument, chunk_size=args.chunk)
+    failed = False
+    try:
+        if not transfer.wait_ready():
+            raise SDTransferError("no telemetry from the thermocycler")
+        if args.action == 'list':
+            for name, size in transfer.list_files():
+                print(f"{name:<12} {size:>10}")
+        else:
+            names = args.names
+            if args.all or not names:
+                names = [name for name, _ in transfer.list_files() if name.upper().endswith('.CSV')]
+            for name in names:
+                start = time.monotonic()
+                if args.action == 'summary':
+                    from sd_log import summarize_log, write_summary
+                    write_summary([summarize_log(transfer.blocks(name), name=name)], sys.stdout)
+                    continue
+                os.makedirs(args.out, exist_ok=True)
+                size = transfer.download(name, os.path.join(args.out, name),
+                                         progress=lambda offset, total: print(
+                                             f"\r{name}: {format_size(offset)} of {format_size(total)}", end=""))
+                elapsed = time.monotonic() - start
+                print(f"\r{name}: {format_size(size)} in {elapsed:.1f} s ({format_size(size / max(elapsed, 1e-6))}/s)")
+    except SDTransferError as e:
+        print(f"\nSD transfer failed: {e}")
+        failed = True
+    transfer.close()
+    instrument.close()
+    sys.exit(1 if failed else 0)
+
+
+def cmd_bank(args):
+    timeline = timeline_from_args(args)
+
+    def on_console(name, text, tag):
+        print_console(f"[{name}] {text}")
+
+    supervisor = Supervisor(baud=args.baud, sd_mode=not args.no_sd, pipelined=not args.no_seq,
+                            binary=not args.no_binary, timestamps=not args.no_timestamps,
+                            on_console=on_console if args.verbose else None,
+                            runner_options={'timeline': timeline, 'time_scale': args.speed},
+                            record=args.record).start()
+    stop = threading.Event()
+
+    #first Ctrl+C ends the cycles (final extension and cooling), the second one stops them
+    def interrupt(*_):
+        if not args.run or stop.is_set() or not supervisor.any_running():
+            supervisor.stop_cycles()
+            stop.set()
+        else:
+            print_console("Ending cycles, press Ctrl+C again to stop immediately.")
+            supervisor.end_cycles()
+            stop.set()
+
+    signal.signal(signal.SIGINT, interrupt)
+
+    started = set()
+    next_scan = 0
+    while True:
+        now = time.time()
+        if now >= next_scan and not stop.is_set():
+            for name in supervisor.discover(args.vid_pid, extra_ports=args.ports):
+                print_console(f"Found unit on {name}")
+            next_scan = now + args.scan_interval
+        if args.run and not stop.is_set():
+            started.update(supervisor.start_cycles([name for name in supervisor.units if name not in started]))
+
+        print_console(format_status(supervisor.status()) + "\n")
+
+        if stop.is_set() and not supervisor.any_running():
+            break
+        if args.run and started and not supervisor.any_running() and len(started) == len(supervisor.units):
+            break
+        time.sleep(args.interval)
+    supervisor.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless thermocycler control.")
+    parser.add_argument('--port', help="serial port (default: the last port of the device, then every candidate port at once)")
+    parser.add_argument('--hwid', default=DEVICE_HWID)
+    parser.add_argument('--baud', type=int, default=BAUD_RATE)
+    parser.add_argument('--connect-timeout', type=float, default=20)
+    parser.add_argument('--no-sd', action='store_true', help="answer the handshake with no_sd")
+    parser.add_argument('--no-seq', action='store_true', help="force stop-and-wait commands")
+    parser.add_argument('--no-binary', action='store_true', help="keep JSON telemetry")
+    parser.add_argument('--no-timestamps', action='store_true')
+    parser.add_argument('--record', action='store_true', help="record the session (see session_recorder.py)")
+    parser.add_argument('--serve', metavar='PORT', type=int, help="serve the telemetry to local clients on PORT (telemetry_server.py)")
+    parser.add_argument('--allow-commands', action='store_true', help="let the server's clients send commands")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    monitor = sub.add_parser('monitor', help="print console lines and telemetry")
+    monitor.add_argument('--interval', type=float, default=1.0, help="seconds between frame summaries")
+    monitor.set_defaults(func=cmd_monitor)
+
+    run = sub.add_parser('run', help="run the default cycle protocol")
+    run.add_argument('--protocol', help="protocol file (default protocols/default.json)")
+    run.add_argument('--cycles', type=int, help="override the cycle count of the protocol")
+    run.add_argument('--model', metavar='DEVICE', help="estimate the ramp times with the thermal model fitted for DEVICE (thermal_fit.py)")
+    run.add_argument('--verbose', action='store_true', help="also print the serial console")
+    run.add_argument('--speed', type=float, default=1.0, help="time scale of a virtual thermocycler (thermocycler_sim.py)")
+    run.set_defaults(func=cmd_run)
+
+    send = sub.add_parser('send', help="send commands and wait for their ACKs")
+    send.add_argument('commands', nargs='+')
+    send.add_argument('--timeout', type=float, default=15)
+    send.set_defaults(func=cmd_send)
+
+    sd = sub.add_parser('sd', help="list, copy or summarize the SD card logs over the serial link")
+    sd.add_argument('action', choices=['list', 'get', 'summary'])
+    sd.add_argument('names', nargs='*', help="files of the card (default: every .CSV)")
+    sd.add_argument('--all', action='store_true', help="every .CSV file of the card")
+    sd.add_argument('--out', default='.', help="directory of the copies (an interrupted copy resumes from NAME.part)")
+    sd.add_argument('--chunk', type=int, default=CHUNK_SIZE, help="bytes per request, the firmware loop waits while one is sent")
+    sd.add_argument('--verbose', action='store_true', help="also print the serial console")
+    sd.set_defaults(func=cmd_sd)
+
+    bank = sub.add_parser('bank', help="supervise every connected unit with one status table")
+    bank.add_argument('--vid-pid', default=DEVICE_VID_PID, help="USB VID:PID of the units")
+    bank.add_argument('--run', action='store_true', help="run the cycle protocol on every unit")
+    bank.add_argument('--protocol', help="protocol file (default protocols/default.json)")
+    bank.add_argument('--cycles', type=int, help="override the cycle count of the protocol")
+    bank.add_argument('--model', metavar='DEVICE', help="estimate the ramp times with the thermal model fitted for DEVICE (thermal_fit.py)")
+    bank.add_argument('--interval', type=float, default=2.0, help="seconds between status tables")
+    bank.add_argument('--scan-interval', type=float, default=10.0, help="seconds between port scans")
+    bank.add_argument('--verbose', action='store_true', help="also print the serial console of every unit")
+    bank.add_argument('--speed', type=float, default=1.0, help="time scale of virtual thermocyclers (thermocycler_sim.py)")
+    bank.add_argument('ports', nargs='*', help="ports to add besides the discovered ones (e.g. virtual units)")
+    bank.set_defaults(func=cmd_bank)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
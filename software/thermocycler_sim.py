@@ -0,0 +1,720 @@
+import argparse
+import math
+import os
+import random
+import re
+import selectors
+import signal
+import threading
+import time
+import tty
+
+from frame_decoder import format_frame
+from binary_frame import (encode_telemetry, encode_sd_entry, encode_sd_data, encode_sd_end, SD_DATA_SIZE,
+                          SD_OK, SD_NO_CARD, SD_NOT_FOUND, SD_BUSY, SD_BAD_REQUEST)
+
+#virtual thermocycler on a pseudo-terminal (POSIX only), for load, latency and long protocol tests
+#without the hardware: it speaks the serial protocol of firmware/Thermocycler.ino (handshake,
+#"ack"/"ack <id>" replies, var=value commands, JSON or binary telemetry, AZ_5 shutdown) and runs
+#the firmware loop against a simple thermal model of the block and cap heaters
+#the simulated clock runs `speed` times faster than the wall clock, frames are sent `frame_rate`
+#times per wall second with the latest state, whatever the speed
+#with `sd_dir` the files of that directory are the SD card of the sd_list/sd_read commands, sent at
+#the wire rate of the real link while the loop waits, like the firmware
+#  python thermocycler_sim.py --speed 60         then e.g. python thermocycler_cli.py --port <pty> run --speed 60
+
+AMBIENT_TEMP = 22.0
+
+JSON_FRAME_RATE = 20  # frames/s of the firmware loop with JSON telemetry (readCommands waits up to 50 ms)
+BINARY_FRAME_RATE = 100  # frames/s with binary telemetry (10 ms command timeout)
+CONTROL_STEP = 0.05  # simulated seconds per firmware loop iteration (thermal model and control logic)
+MAX_OUTPUT_BUFFER = 65536  # bytes kept for a host that is not reading, older output is dropped past this
+LINK_RATE = 11520  # bytes/s of the 115200 baud link, the pace of SD card transfers
+
+#firmware timings (simulated seconds, except the handshake which waits for a real host)
+HANDSHAKE_ATTEMPTS = 20
+HANDSHAKE_TIMEOUT = 1.0  # wall seconds, Serial.setTimeout(1000) while waiting for "syn ack" and the timestamp
+BOOT_DELAY = 7.0  # LCD splash after the handshake
+SENSOR_INTERVAL = 0.5
+SENSOR_INTERVAL_BINARY = 0.25  # thermocouple reads only, the log rows and rate updates stay on LOG_INTERVAL
+LOG_INTERVAL = 0.5
+AZ_5_FRAME_INTERVAL = 0.2  # reduced diagnostics frame period after a shutdown
+OFFLINE_INTERVAL = 0.05  # debug print period when no host answered the handshake
+
+#firmware limits
+RUNAWAY_TEMP = 130
+REDUNDANCY_MISMATCH = 15  # max difference between the two block sensors
+HEATING_TIMEOUT = 300  # seconds to reach a program step temperature
+COOLING_TIMEOUT = 180
+COOLED_TEMP = 26
+
+#standalone program of the firmware
+PROGRAM_BLOCK_TARGETS = [95.0, 60.0, 72.0]
+PROGRAM_CAP_TARGETS = [110.0, 110.0, 110.0]
+HOLD_TIMES = [30, 30, 45]  # seconds
+END_HOLD = 600
+END_HOLD_TEMP = 72
+PROGRAM_CYCLES = 2
+
+#sensors (MAX6675)
+SENSOR_RESOLUTION = 0.25
+SENSOR_NOISE = 0.1  # standard deviation in degrees
+REDUNDANT_OFFSET = 0.3  # second block sensor reads slightly higher
+
+FAULTS = ['sensor', 'runaway', 'mismatch']
+
+_NUMBER = re.compile(r'\s*[+-]?(\d+\.?\d*|\.\d+)')
+
+
+#Arduino String.toFloat()/toInt(): leading number, 0 if there is none
+def _to_float(text):
+    match = _NUMBER.match(text)
+    return float(match.group(0)) if match else 0.0
+
+
+def _to_int(text):
+    return int(_to_float(text))
+
+
+def _parse_bool(text):
+    return text.lower() in ("1", "true")
+
+
+#lumped thermal model, temperatures in degrees, powers in degrees per second at full PWM
+#the block heaters warm a heater node coupled to the block (gives the lag and overshoot of the real
+#aluminium block), the block and the cap lose heat to ambient, the fan multiplies the block losses
+class ThermalModel:
+
+    def __init__(self, ambient=AMBIENT_TEMP, block_power=6.0, coupling=0.6, block_loss=0.006, fan_loss=0.02,
+                 cap_power=2.0, cap_loss=0.008):
+        self.ambient = ambient
+        self.block_power = block_power
+        self.coupling = coupling
+        self.block_loss = block_loss
+        self.fan_loss = fan_loss
+        self.cap_power = cap_power
+        self.cap_loss = cap_loss
+        self.reset()
+
+    def reset(self):
+        self.heater = self.ambient
+        self.block = self.ambient
+        self.cap = self.ambient
+
+    #advance by dt seconds, pwm values are 0-255 (0 when the heater is off)
+    def step(self, dt, block_pwm, cap_pwm, fan):
+        flow = self.coupling * (self.heater - self.block)
+        self.heater += dt * (self.block_power * block_pwm / 255 - flow)
+        loss = (self.block_loss + (self.fan_loss if fan else 0)) * (self.block - self.ambient)
+        self.block += dt * (flow - loss)
+        self.cap += dt * (self.cap_power * cap_pwm / 255 - self.cap_loss * (self.cap - self.ambient))
+
+
+class VirtualThermocycler:
+
+    def __init__(self, frame_rate=None, speed=1.0, offer_seq=True, offer_binary=True, model=None,
+                 cycles=PROGRAM_CYCLES, seed=None, sd_dir=None):
+        self.frame_rate = frame_rate
+        self.speed = speed
+        self.offer_seq = offer_seq
+        self.offer_binary = offer_binary
+        self.model = model or ThermalModel()
+        self.cycles = cycles
+        self.random = random.Random(seed)
+        self.sd_dir = sd_dir
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._out = bytearray()
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+        self._thread = None
+
+        self.stats = {
+            'frames': 0,
+            'bytes_out': 0,
+            'bytes_dropped': 0,
+            'commands': 0,
+            'syn_attempts': 0,
+            'sd_bytes': 0,
+        }
+        self._reset_firmware()
+
+    #power-on state of the firmware globals
+    def _reset_firmware(self):
+        self.clock = 0.0  # simulated seconds since power on
+        self.phase = 'handshake'  # handshake, timestamp, boot, run, az5, offline
+        self._phase_deadline = 0.0
+        self._syn_count = 0
+        self._lines = []
+        self._next_sensor = 0.0
+        self._next_log = 0.0
+        self._transfer = None  # frames of the SD card transfer in progress
+        self._link_time = None  # wall time up to which the link was used by the transfer
+
+        self.sd = True
+        self.seq = False
+        self.binary = False
+        self.filename = "log.csv"
+
+        self.target_block = 0.0
+        self.target_cap = 0.0
+        self.heat_act = False
+        self.h_act = False
+        self.h_cap_act = False
+        self.fan_act = False
+        self.h_pwm = 0
+        self.h_cap_pwm = 0
+        self.arrived_at_temp = False
+        self.az5 = False
+        self.az5_info = ""
+        self.fault = None
+
+        self.temp_block = self.model.block
+        self.temp_block_2 = self.model.block
+        self.temp_cap = self.model.cap
+        self.rate_block = 0.0
+        self.rate_cap = 0.0
+        self._rate_history = []
+        self._rate_last = (0.0, self.temp_block, self.temp_cap)
+        self._redundancy_score = 0
+        self._redundancy_timer = 0.0
+
+        self.program_start = False
+        self.program_step = 0
+        self.abs_program_step = 0
+        self.holding = False
+        self.step_start = 0.0
+        self.heating_since = None
+        self.end_phase = False
+        self.end_hold_start = 0.0
+        self.cooling_started = False
+        self.cooling_start = 0.0
+
+    def open(self):
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        return self.port
+
+    def start(self):
+        if self._master is None:
+            self.open()
+        if self._thread is None or not self._thread.is_alive():
+            self._running.set()
+            self._thread = threading.Thread(target=self._run, name="virtual-thermocycler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=1):
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    #power cycle: back to the handshake, block and cap at ambient
+    def reset(self):
+        with self._lock:
+            self.model.reset()
+            self._reset_firmware()
+
+    #same as starting the standalone program from the LCD menu
+    def start_program(self):
+        with self._lock:
+            self.program_start = True
+            self.heat_act = True
+            self.abs_program_step = 0
+
+    #'sensor': block sensor reads NaN, 'runaway': block heaters stuck on, 'mismatch': second sensor drifts
+    def inject_fault(self, fault):
+        if fault not in FAULTS:
+            raise ValueError(f"unknown fault {fault!r}, expected one of {FAULTS}")
+        with self._lock:
+            self.fault = fault
+
+    def millis(self):
+        return int(self.clock * 1000)
+
+    def _write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._out += data
+        if len(self._out) > MAX_OUTPUT_BUFFER:
+            self.stats['bytes_dropped'] += len(self._out) - MAX_OUTPUT_BUFFER
+            del self._out[:len(self._out) - MAX_OUTPUT_BUFFER]
+
+    def _println(self, text=""):
+        self._write(text + "\r\n")
+
+    def _flush(self):
+        if not self._out:
+            return
+        try:
+            written = os.write(self._master, self._out)
+        except (BlockingIOError, OSError):
+            return
+        self.stats['bytes_out'] += written
+        del self._out[:written]
+
+    def _frame_interval(self):
+        if self.phase == 'az5':
+            return max(1 / (self.frame_rate or JSON_FRAME_RATE), AZ_5_FRAME_INTERVAL / self.speed)
+        if self.phase == 'offline':
+            return max(1 / (self.frame_rate or JSON_FRAME_RATE), OFFLINE_INTERVAL / self.speed)
+        rate = self.frame_rate or (BINARY_FRAME_RATE if self.binary else JSON_FRAME_RATE)
+        return 1 / rate
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self._master, selectors.EVENT_READ)
+        buffer = bytearray()
+        last = time.monotonic()
+        next_frame = last
+
+        while self._running.is_set():
+            timeout = max(0.0, min(next_frame - time.monotonic(), 0.05))
+            if selector.select(timeout):
+                try:
+                    buffer += os.read(self._master, 4096)
+                except (BlockingIOError, OSError):
+                    pass
+
+            with self._lock:
+                while b'\n' in buffer:
+                    line, _, rest = buffer.partition(b'\n')
+                    buffer[:] = rest
+                    self._lines.append(line.decode('utf-8', errors='ignore').strip())
+
+                now = time.monotonic()
+                self._advance((now - last) * self.speed)
+                last = now
+
+                if now >= next_frame:
+                    self._tick()
+                    next_frame += self._frame_interval()
+                    if next_frame < now:
+                        next_frame = now + self._frame_interval()
+                self._flush()
+
+        selector.close()
+
+    #run the firmware for `dt` simulated seconds
+    def _advance(self, dt):
+        self._handshake_lines()
+        end = self.clock + dt
+        while self.clock < end:
+            step = min(CONTROL_STEP, end - self.clock)
+            self.clock += step
+
+            heaters = self.heat_act and not self.az5
+            block_pwm = self.h_pwm if heaters and self.h_act else 0
+            if self.fault == 'runaway':
+                block_pwm = 255
+            cap_pwm = self.h_cap_pwm if heaters and self.h_cap_act else 0
+            fan = (heaters and self.fan_act) or self.az5
+            self.model.step(step, block_pwm, cap_pwm, fan)
+
+            if self.clock >= self._next_sensor:
+                self._read_sensors()
+                self._next_sensor = self.clock + (SENSOR_INTERVAL_BINARY if self.binary else SENSOR_INTERVAL)
+            if self.clock >= self._next_log:
+                self._update_rates()
+                self._next_log = self.clock + LOG_INTERVAL
+
+            if self.phase == 'handshake' and self.clock >= self._phase_deadline:
+                self._send_syn()
+            elif self.phase == 'timestamp' and self.clock >= self._phase_deadline:
+                self._boot()
+            elif self.phase == 'boot' and self.clock >= self._phase_deadline:
+                self.phase = 'run'
+            elif self.phase == 'run':
+                self._loop()
+
+    #handshake and timestamp lines are answered as soon as they arrive, like readStringUntil does
+    def _handshake_lines(self):
+        while self._lines and self.phase in ('handshake', 'timestamp'):
+            line = self._lines.pop(0)
+            if self.phase == 'handshake' and line.startswith("syn ack"):
+                self.sd = "no_sd" not in line
+                words = line.split()
+                self.seq = "seq" in words
+                self.binary = "bin" in words and self.offer_binary
+                self._println("ack tim")
+                self.phase = 'timestamp'
+                self._phase_deadline = self.clock + HANDSHAKE_TIMEOUT * self.speed
+            elif self.phase == 'timestamp' and line:
+                self.filename = line + ".csv"
+                self._println("ack")
+                self._println("Writing log to:" + self.filename)
+                self._boot()
+
+    def _send_syn(self):
+        if self._syn_count >= HANDSHAKE_ATTEMPTS:
+            self.phase = 'offline'
+            return
+        offer = ["syn"]
+        if self._syn_count % 2 == 0:
+            offer += (["seq"] if self.offer_seq else []) + (["bin"] if self.offer_binary else [])
+        self._println(" ".join(offer))
+        self._syn_count += 1
+        self.stats['syn_attempts'] += 1
+        self._phase_deadline = self.clock + HANDSHAKE_TIMEOUT * self.speed
+
+    def _boot(self):
+        if self.sd:
+            self._println("SD card connected!")
+            #the firmware prints this one without a newline, it ends up in front of the first frame
+            self._write("File initialization successful")
+        self.phase = 'boot'
+        self._phase_deadline = self.clock + BOOT_DELAY
+
+    def _sensor(self, value):
+        value += self.random.gauss(0, SENSOR_NOISE)
+        return round(value / SENSOR_RESOLUTION) * SENSOR_RESOLUTION
+
+    def _read_sensors(self):
+        self.temp_block = math.nan if self.fault == 'sensor' else self._sensor(self.model.block)
+        offset = REDUNDANT_OFFSET + (20 if self.fault == 'mismatch' else 0)
+        self.temp_block_2 = self._sensor(self.model.block + offset)
+        self.temp_cap = self._sensor(self.model.cap)
+
+    #updateTemperatureRate: average of the last 10 rates, computed at most every 0.5 s
+    def _update_rates(self):
+        last_time, last_block, last_cap = self._rate_last
+        dt = self.clock - last_time
+        if dt <= 0.5:
+            return
+        self._rate_history.append(((self.temp_block - last_block) / dt, (self.temp_cap - last_cap) / dt))
+        del self._rate_history[:-10]
+        self._rate_last = (self.clock, self.temp_block, self.temp_cap)
+        self.rate_block = sum(rate for rate, _ in self._rate_history) / 10
+        self.rate_cap = sum(rate for _, rate in self._rate_history) / 10
+
+    #update_values: bang-bang control of the heaters and the fan
+    def _update_values(self):
+        d_block = self.target_block - self.temp_block
+        d_cap = self.target_cap - self.temp_cap
+
+        self.fan_act = d_block < -2 and self.heat_act
+        self.h_act = d_block > -2 and self.heat_act
+        self.h_cap_act = d_cap > -2 and self.heat_act
+        self.arrived_at_temp = abs(d_block) < 1
+
+        self.h_pwm = 255 if d_block > 1.5 else 100 if d_block > 0 else 0
+        self.h_cap_pwm = 255 if d_cap > 1.5 else 100 if d_cap > 0 else 0
+
+    #one iteration of the firmware loop() after the handshake
+    def _loop(self):
+        if self.program_start and not self.az5:
+            self._program()
+
+        if self.temp_block > RUNAWAY_TEMP or self.temp_block_2 > RUNAWAY_TEMP or self.temp_cap > RUNAWAY_TEMP:
+            self.az5 = True
+            self.az5_info = "TEMP RUNAWAY"
+        elif any(math.isnan(t) or t == 0 for t in (self.temp_block, self.temp_block_2, self.temp_cap)):
+            self.az5 = True
+            self.az5_info = "SENSOR FAULT"
+        if abs(self.temp_block - self.temp_block_2) > REDUNDANCY_MISMATCH:
+            if self.clock - self._redundancy_timer > 1:
+                self._redundancy_score += 1
+                self._redundancy_timer = self.clock
+        else:
+            self._redundancy_score = 0
+        if self._redundancy_score > 5:
+            self.az5 = True
+            self.az5_info = "REDUNDANCY MISMATCH"
+
+        if not self.az5:
+            self._update_values()
+        else:
+            self.heat_act = False
+            self.phase = 'az5'
+            self._println("AZ 5 ACTIVATED")
+            self._println(self.az5_info)
+            self._println("MANUAL RESET NEEDED")
+
+    #standalone cycling program
+    def _program(self):
+        if not self.end_phase:
+            self.target_block = PROGRAM_BLOCK_TARGETS[self.program_step]
+            self.target_cap = PROGRAM_CAP_TARGETS[self.program_step]
+
+            if self.heating_since is None:
+                self.heating_since = self.clock
+            if self.clock - self.heating_since > HEATING_TIMEOUT:
+                self.az5 = True
+                self.az5_info = "HEATING TIMEOUT"
+
+            self._update_values()
+
+            if self.arrived_at_temp and not self.holding:
+                self.holding = True
+                self.step_start = self.clock
+
+            if self.holding and self.clock - self.step_start >= HOLD_TIMES[self.program_step]:
+                self.program_step += 1
+                self.abs_program_step += 1
+                self.holding = False
+                self.heating_since = None
+
+            length = len(PROGRAM_BLOCK_TARGETS)
+            if self.program_step >= length and self.abs_program_step >= length * self.cycles:
+                self.end_phase = True
+                self.end_hold_start = self.clock
+                self.target_block = END_HOLD_TEMP
+            if self.program_step >= length:
+                self.program_step = 0
+
+        elif not self.cooling_started and self.clock - self.end_hold_start >= END_HOLD:
+            self.cooling_started = True
+            self.target_block = 0
+            self.target_cap = 0
+            self.cooling_start = self.clock
+        elif self.cooling_started and (self.clock - self.cooling_start >= COOLING_TIMEOUT or self.temp_block < COOLED_TEMP):
+            self.heat_act = False
+            self.program_start = False
+            self.holding = False
+            self.program_step = 0
+            self.abs_program_step = 0
+            self.end_phase = False
+            self.cooling_started = False
+
+    #handleCommand
+    def _handle_command(self, command):
+        var, equals, val = command.partition('=')
+        if not equals:
+            return
+        var = var.strip()
+        val = val.strip()
+
+        if var == "H_pwm":
+            self.h_pwm = _to_int(val)
+        elif var == "H_CAP_pwm":
+            self.h_cap_pwm = _to_int(val)
+        elif var == "target_block_temp":
+            self.target_block = _to_float(val)
+        elif var == "target_cap_temp":
+            self.target_cap = _to_float(val)
+        elif var == "H_act":
+            self.h_act = _parse_bool(val)
+        elif var == "H_CAP_act":
+            self.h_cap_act = _parse_bool(val)
+        elif var == "FAN_act":
+            self.fan_act = _parse_bool(val)
+        elif var == "AZ_5":
+            self.az5 = _parse_bool(val)
+            self.az5_info = "REMOTE SHUTDOWN"
+        elif var == "heat_act":
+            self.heat_act = _parse_bool(val)
+        elif var == "sd_list":
+            self._transfer = self._sd_list()
+            return
+        elif var == "sd_read":
+            self._transfer = self._sd_read(val)
+            return
+        else:
+            self._println("Unrecognized variable: " + var)
+            return
+        self._println(f"Set {var} to {val}")
+
+    #listSD: entry frames, then the end frame with the number of entries
+    def _sd_list(self):
+        if not self.sd or self.sd_dir is None:
+            yield encode_sd_end(SD_NO_CARD)
+            return
+        files = sorted((entry for entry in os.scandir(self.sd_dir) if entry.is_file()), key=lambda entry: entry.name)
+        for entry in files:
+            yield encode_sd_entry(entry.name, entry.stat().st_size)
+        yield encode_sd_end(SD_OK, len(files))
+
+    #readSD: data frames from the offset, then the end frame with the next offset and the file size
+    def _sd_read(self, args):
+        parts = args.split(',')
+        if len(parts) != 3 or not parts[0]:
+            yield encode_sd_end(SD_BAD_REQUEST)
+            return
+        name = parts[0]
+        offset = _to_int(parts[1])
+        length = _to_int(parts[2])
+        if self.heat_act or self.program_start:
+            yield encode_sd_end(SD_BUSY, offset)
+            return
+        if not self.sd or self.sd_dir is None:
+            yield encode_sd_end(SD_NO_CARD, offset)
+            return
+        #FAT names are case insensitive
+        path = next((entry.path for entry in os.scandir(self.sd_dir)
+                     if entry.is_file() and entry.name.lower() == name.lower()), None)
+        if path is None:
+            yield encode_sd_end(SD_NOT_FOUND, offset)
+            return
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = min(offset + length, size)
+            f.seek(offset)
+            while offset < end:
+                data = f.read(min(end - offset, SD_DATA_SIZE))
+                if not data:
+                    break
+                yield encode_sd_data(offset, data)
+                offset += len(data)
+                self.stats['sd_bytes'] += len(data)
+        yield encode_sd_end(SD_OK, offset, size)
+
+    #the loop is blocked in listSD/readSD: the frames go out at the wire rate, nothing else happens
+    def _send_transfer(self):
+        now = time.monotonic()
+        if self._link_time is None:
+            self._link_time = now
+        while self._link_time <= now:
+            frame = next(self._transfer, None)
+            if frame is None:
+                self._transfer = None
+                self._link_time = None
+                return
+            self._write(frame)
+            self._link_time += len(frame) / LINK_RATE
+
+    #processCommand
+    def _process_command(self, command):
+        self.stats['commands'] += 1
+        if command.startswith("#"):
+            command_id, space, rest = command[1:].partition(' ')
+            if not space:
+                return
+            self._println("ack " + command_id)
+            self._handle_command(rest)
+        else:
+            self._println("ack")
+            self._handle_command(command)
+
+    def telemetry(self):
+        holding_timer = int(self.clock - self.step_start) if self.holding and not self.end_phase else 0
+        end_timer = int(self.clock - self.end_hold_start) if self.end_phase and not self.cooling_started else 0
+        return {
+            'block_temperature': self.temp_block,
+            'target_block_temp': self.target_block,
+            'block_gradient': self.rate_block,
+            'cap_temperature': self.temp_cap,
+            'target_cap_temp': self.target_cap,
+            'cap_gradient': self.rate_cap,
+            'redundant_temp': self.temp_block_2,
+            'buttons': [0, 0],
+            'H_pwm': self.h_pwm,
+            'H_CAP_pwm': self.h_cap_pwm,
+            'H_act': self.h_act,
+            'H_CAP_act': self.h_cap_act,
+            'FAN_act': self.fan_act,
+            'AZ_5': self.az5,
+            'heat_act': self.heat_act,
+            'temp_reached': self.arrived_at_temp,
+            'holding_temp': self.holding,
+            'program_active': self.program_start,
+            'timers': [holding_timer, HOLD_TIMES[self.program_step]],
+            'end_timers': [end_timer, END_HOLD],
+        }
+
+    #one pass of the serial part of loop(): send the telemetry, then handle the received commands
+    def _tick(self):
+        if self.phase == 'run':
+            if self._transfer is not None:
+                self._send_transfer()
+                return
+            if self.binary:
+                self._write(encode_telemetry(self.telemetry(), self.millis()))
+            else:
+                self._println(format_frame(self.telemetry()))
+            self.stats['frames'] += 1
+            #commands received during a transfer wait for its end, like in the serial buffer
+            while self._lines and self._transfer is None:
+                line = self._lines.pop(0)
+                if line:
+                    self._process_command(line)
+
+        elif self.phase == 'az5':
+            #reduced diagnostics frame, commands are no longer read
+            self._println(f'{{"block_temperature": {self.temp_block:.2f}, "cap_temperature": {self.temp_cap:.2f} }}')
+            self.stats['frames'] += 1
+            self._lines.clear()
+
+        elif self.phase == 'offline':
+            self._println("-------------")
+            self._println(f"Cap: {self.temp_cap:.2f}C")
+            self._println(f"PWM_cap: {self.h_pwm}/255 ")
+            self._println(f"Block 1: {self.temp_block:.2f}C")
+            self._println(f"Block 2: {self.temp_block_2:.2f}C")
+            self._println(f"PWM_block: {self.h_cap_pwm}/255 ")
+            self._println("Heat_act: True" if self.heat_act else "Heat_act: False")
+            self._println("-------------")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Virtual thermocycler on a pseudo-terminal.")
+    parser.add_argument('--count', type=int, default=1, help="number of virtual units")
+    parser.add_argument('--rate', type=float, default=None,
+                        help=f"frames per second (default {JSON_FRAME_RATE} JSON, {BINARY_FRAME_RATE} binary)")
+    parser.add_argument('--speed', type=float, default=1.0, help="simulated seconds per wall second")
+    parser.add_argument('--no-seq', action='store_true', help="do not offer sequence numbers (old firmware)")
+    parser.add_argument('--no-binary', action='store_true', help="do not offer binary telemetry")
+    parser.add_argument('--program', action='store_true', help="start the standalone program after boot")
+    parser.add_argument('--cycles', type=int, default=PROGRAM_CYCLES, help="cycles of the standalone program")
+    parser.add_argument('--fault', choices=FAULTS, help="inject a fault after --fault-after simulated seconds")
+    parser.add_argument('--fault-after', type=float, default=60)
+    parser.add_argument('--link', help="also make a symlink to the pty (single unit only)")
+    parser.add_argument('--report', type=float, default=10, help="seconds between status lines, 0 to disable")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--sd-dir', help="directory served as the SD card (sd_list/sd_read commands)")
+    args = parser.parse_args(argv)
+
+    units = [VirtualThermocycler(frame_rate=args.rate, speed=args.speed, offer_seq=not args.no_seq,
+                                 offer_binary=not args.no_binary, cycles=args.cycles, seed=args.seed,
+                                 sd_dir=args.sd_dir)
+             for _ in range(args.count)]
+    for unit in units:
+        print(f"Virtual thermocycler on {unit.open()}")
+        unit.start()
+    if args.link and len(units) == 1:
+        if os.path.islink(args.link):
+            os.remove(args.link)
+        os.symlink(units[0].port, args.link)
+        print(f"Linked {args.link} -> {units[0].port}")
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+
+    programs_started = set()
+    faults_injected = set()
+    next_report = time.monotonic() + args.report
+    while not stop.wait(0.1):
+        for index, unit in enumerate(units):
+            if args.program and index not in programs_started and unit.phase == 'run':
+                unit.start_program()
+                programs_started.add(index)
+            if args.fault and index not in faults_injected and unit.phase == 'run' and unit.clock >= args.fault_after:
+                unit.inject_fault(args.fault)
+                faults_injected.add(index)
+        if args.report and time.monotonic() >= next_report:
+            next_report += args.report
+            for unit in units:
+                print(f"{unit.port}: {unit.phase} t={unit.clock:.0f}s block={unit.model.block:.2f} "
+                      f"cap={unit.model.cap:.2f} target={unit.target_block:.1f} frames={unit.stats['frames']} "
+                      f"commands={unit.stats['commands']} dropped={unit.stats['bytes_dropped']}B")
+
+    for unit in units:
+        unit.close()
+    if args.link and os.path.islink(args.link):
+        os.remove(args.link)
+
+
+if __name__ == "__main__":
+    main()
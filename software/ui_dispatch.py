@@ -0,0 +1,112 @@
+import collections
+import time
+
+from metrics import Histogram
+
+
+#hands work from background threads to the Tk main loop
+#deque.append/popleft are atomic in CPython, so producers never take a lock,
+#the main loop drains everything queued so far in one batch every `interval_ms`
+class UIDispatcher:
+
+    def __init__(self, root, interval_ms=50, max_batch=5000):
+        self.root = root
+        self.interval_ms = interval_ms
+        self.max_batch = max_batch
+        self._queue = collections.deque()
+        self._flush_hooks = []
+        self._after_id = None
+        self.stats = {'batches': 0, 'calls': 0, 'max_batch': 0, 'last_lag_ms': 0.0}
+        self.lag = Histogram()  # ms the first call of each batch waited in the queue
+        self.batch_time = Histogram()  # ms spent running each batch
+
+    #safe to call from any thread
+    def post(self, func, *args):
+        self._queue.append((time.perf_counter(), func, args))
+
+    #functions called after every batch (e.g. console flush)
+    def add_flush_hook(self, func):
+        self._flush_hooks.append(func)
+
+    def pending(self):
+        return len(self._queue)
+
+    def start(self):
+        if self._after_id is None:
+            self._after_id = self.root.after(self.interval_ms, self._drain)
+
+    def stop(self):
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+
+    def _drain(self):
+        queue = self._queue
+        count = 0
+        lag = 0.0
+        start = time.perf_counter()
+        while queue and count < self.max_batch:
+            posted, func, args = queue.popleft()
+            if count == 0:
+                lag = (time.perf_counter() - posted) * 1000
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"UI callback {getattr(func, '__name__', func)} failed: {e}")
+            count += 1
+
+        for hook in self._flush_hooks:
+            hook()
+
+        if count:
+            stats = self.stats
+            stats['batches'] += 1
+            stats['calls'] += count
+            stats['max_batch'] = max(stats['max_batch'], count)
+            stats['last_lag_ms'] = lag
+            self.lag.record(lag)
+            self.batch_time.record((time.perf_counter() - start) * 1000)
+
+        self._after_id = self.root.after(self.interval_ms, self._drain)
+
+
+#ScrolledText console with a line limit, text can be written from any thread
+#and is inserted in one go when the dispatcher flushes, the oldest lines are trimmed
+class BoundedConsole:
+
+    def __init__(self, text_widget, dispatcher, max_lines=5000):
+        self.text = text_widget
+        self.max_lines = max_lines
+        self._pending = collections.deque()
+        dispatcher.add_flush_hook(self.flush)
+
+    #safe to call from any thread
+    def write(self, chars, tag=None):
+        self._pending.append((chars, tag))
+
+    def flush(self):
+        pending = self._pending
+        if not pending:
+            return
+
+        #merge consecutive chunks with the same tag into a single insert argument
+        args = []
+        last_tag = object()
+        while pending:
+            chars, tag = pending.popleft()
+            if tag == last_tag:
+                args[-2] += chars
+            else:
+                args.extend((chars, tag or ()))
+                last_tag = tag
+
+        text = self.text
+        text.config(state='normal')
+        text.insert('end', *args)
+
+        lines = int(text.index('end-1c').split('.')[0])
+        if lines > self.max_lines:
+            text.delete('1.0', f"{lines - self.max_lines + 1}.0")
+
+        text.see('end')
+        text.config(state='disabled')
@@ -0,0 +1,70 @@
+from frame_decoder import FRAME_SCHEMA, FLOAT, BOOL, PAIR
+
+PANEL_PRECISION = 1  # decimals shown for the float fields, changes below this never reach the UI
+
+
+#model of the live variables panel: frames only update the last value of every key (update() is
+#called for every frame), the UI asks for changes() at its own refresh rate and gets the text of the
+#keys whose displayed text differs from what it shows, so widget updates follow how much the
+#telemetry changes and not the frame rate
+#floats are shown with `precision` decimals, so sensor noise below that does not count as a change
+class PanelModel:
+
+    def __init__(self, precision=PANEL_PRECISION, schema=FRAME_SCHEMA):
+        self.precision = precision
+        self.shown = {}  # key -> text on the panel
+        self._latest = {}  # key -> last value received
+        self._dirty = False
+        self._formats = {key: self._formatter(kind) for key, kind in schema}
+        self.stats = {'frames': 0, 'refreshes': 0, 'changes': 0}
+
+    #called for every frame, keeps the last value per key
+    def update(self, frame):
+        self._latest.update(frame)
+        self._dirty = True
+        self.stats['frames'] += 1
+
+    #{key: text} of the keys whose text changed since the previous call, in arrival order for new keys
+    def changes(self):
+        if not self._dirty:
+            return {}
+        self._dirty = False
+        changed = {}
+        shown = self.shown
+        formats = self._formats
+        for key, value in self._latest.items():
+            fmt = formats.get(key)
+            text = fmt(key, value) if fmt is not None else self._format_other(key, value)
+            if shown.get(key) != text:
+                shown[key] = text
+                changed[key] = text
+        stats = self.stats
+        stats['refreshes'] += 1
+        stats['changes'] += len(changed)
+        return changed
+
+    def clear(self):
+        self.shown.clear()
+        self._latest.clear()
+        self._dirty = False
+
+    def _formatter(self, kind):
+        if kind == FLOAT:
+            return self._format_float
+        if kind == BOOL:
+            return lambda key, value: f"{key}: {bool(value)}"
+        if kind == PAIR:
+            return lambda key, value: f"{key}: [{value[0]}, {value[1]}]" if value else f"{key}: {value}"
+        return lambda key, value: f"{key}: {value}"
+
+    def _format_float(self, key, value):
+        try:
+            return f"{key}: {value:.{self.precision}f}"
+        except (TypeError, ValueError):
+            return f"{key}: {value}"
+
+    #keys outside the schema (newer firmware): floats at the panel precision, the rest as received
+    def _format_other(self, key, value):
+        if isinstance(value, float):
+            return self._format_float(key, value)
+        return f"{key}: {value}"